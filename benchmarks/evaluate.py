@@ -0,0 +1,360 @@
+"""Score parser configurations against the hand-labelled gold set.
+
+Every CV with a label file in benchmarks/gold/ is parsed by each parser
+configuration, and the name, dob, exhibition entries and exhibition titles
+found are scored for precision and recall next to the wall time and the AWS
+calls each configuration needs. A faster mode is worth having only when its
+scores hold:
+
+    python benchmarks/evaluate.py --mode record
+    python benchmarks/evaluate.py --configs baseline merge
+
+AWS responses are kept in a fixture store (benchmarks/fixtures/ by default).
+``--mode record`` calls AWS, or ``AWS_ENDPOINT_URL``, and stores every
+response and the Textract OCR of each CV; ``--mode replay``, the default,
+answers every call from the store and fails on a call that was never
+recorded, so runs are repeatable and free. Replayed calls return at once, so
+wall time is the time spent in the parser itself. Without recorded OCR the
+text layer of the PDF stands in for Textract.
+
+Labels list every exhibition of a section in order as ``[year, title]``,
+with a null title for entries that only name a venue. Titles are compared
+in lowercase without punctuation or parenthesised notes, so "The Archibald
+Prize (Finalist)" matches "The Archibald Prize".
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).parent.parent.resolve()
+
+sys.path.insert(0, str(PROJECT_ROOT))
+
+GOLD_FOLDER = PROJECT_ROOT / "benchmarks" / "gold"
+FIXTURES_FOLDER = PROJECT_ROOT / "benchmarks" / "fixtures"
+CVS_FOLDER = PROJECT_ROOT / ".freelancer"
+
+SECTIONS = ["solo_exhibitions", "group_exhibitions"]
+
+FIELDS = ["name", "dob", "entries", "titles"]
+
+# environment of every configuration, deterministic and without side effects
+COMMON = {
+    "COMPREHEND_BATCH_WINDOW_MS": "0",
+    "CLASSIFIER_AUDIT_RATE": "0",
+    "GAZETTEER_ENABLED": "0",
+    "RATE_LIMIT_ENABLED": "0",
+    "CHECKPOINTS_ENABLED": "0",
+    "LAYOUT_FURNITURE_ENABLED": "0",
+    "LOG_LEVEL": "WARNING",
+}
+
+# parser configurations by name, as environment overrides
+CONFIGURATIONS = {
+    "baseline": {"LAYOUT_MERGE_ENABLED": "0", "CLASSIFIER_ENABLED": "0"},
+    "merge": {"LAYOUT_MERGE_ENABLED": "1", "CLASSIFIER_ENABLED": "0"},
+    "classifier": {"LAYOUT_MERGE_ENABLED": "0", "CLASSIFIER_ENABLED": "1"},
+    "merge+classifier": {"LAYOUT_MERGE_ENABLED": "1", "CLASSIFIER_ENABLED": "1"},
+    "furniture": {
+        "LAYOUT_MERGE_ENABLED": "1",
+        "LAYOUT_FURNITURE_ENABLED": "1",
+        "CLASSIFIER_ENABLED": "0",
+    },
+}
+
+
+class FixtureMissing(Exception):
+    pass
+
+
+class FixtureStore:
+    """Recorded AWS responses, keyed by operation and parameters.
+
+    Attached to a client, it answers calls from the store before they are
+    sent (``replay``) or stores the response of every call that was sent
+    (``record``, which also answers calls already recorded).
+    """
+
+    def __init__(self, folder, mode="replay"):
+        self.folder = Path(folder)
+        self.mode = mode
+        self.path = self.folder / "aws.jsonl"
+        self.responses = {}
+
+        if self.path.is_file():
+            with open(self.path) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self.responses[entry["key"]] = entry["response"]
+
+    @staticmethod
+    def key(operation, params):
+        text = json.dumps([operation, params], sort_keys=True)
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def attach(self, client):
+        service = client.meta.service_model.service_id.hyphenize()
+        events = client.meta.events
+
+        events.register("before-parameter-build.%s" % service, self.before_build)
+        events.register("before-call.%s" % service, self.before_call)
+        events.register("after-call.%s" % service, self.after_call)
+
+    def before_build(self, params, model, context, **kwargs):
+        context["fixture_key"] = self.key(model.name, params)
+
+    def before_call(self, model, context, **kwargs):
+        response = self.responses.get(context["fixture_key"])
+
+        if response is not None:
+            context["fixture_replayed"] = True
+            return Replayed(), response
+
+        if self.mode == "replay":
+            raise FixtureMissing(
+                "%s was never recorded, run with --mode record." % model.name
+            )
+
+    def after_call(self, parsed, context, **kwargs):
+        if self.mode != "record" or context.get("fixture_replayed"):
+            return
+
+        response = {k: v for k, v in parsed.items() if k != "ResponseMetadata"}
+        self.responses[context["fixture_key"]] = response
+
+        self.folder.mkdir(parents=True, exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(json.dumps({"key": context["fixture_key"], "response": response}))
+            f.write("\n")
+
+
+class Replayed:
+    """HTTP response of a call answered from the store."""
+
+    status_code = 200
+    headers = {}
+
+
+def textract_blocks(path):
+    """OCR a CV with Textract, as the parser does."""
+
+    from core.aws.s3 import ensure_bucket, upload_file
+    from core.aws.textract import get_blocks, start_job
+
+    from config import AWS_BUCKET_NAME
+
+    file_hash = hashlib.md5(path.read_bytes()).hexdigest()
+    object_name = "tmp/%s.pdf" % file_hash
+
+    ensure_bucket(bucket=AWS_BUCKET_NAME)
+    upload_file(file_path=str(path), bucket=AWS_BUCKET_NAME, object_name=object_name)
+    return get_blocks(start_job(bucket=AWS_BUCKET_NAME, object_name=object_name))
+
+
+def load_blocks(path, fixtures, mode):
+    """OCR of a CV from the store, recorded or from the PDF text layer."""
+
+    recorded = Path(fixtures) / "textract" / (path.stem + ".json")
+
+    if recorded.is_file():
+        return json.loads(recorded.read_text())
+
+    if mode == "record":
+        blocks = textract_blocks(path)
+        recorded.parent.mkdir(parents=True, exist_ok=True)
+        recorded.write_text(json.dumps(blocks))
+        return blocks
+
+    from layout import pdf_blocks
+
+    return pdf_blocks(path)
+
+
+def run_configuration(paths, fixtures, mode):
+    """Parse CVs in this process, as configured by its environment.
+
+    Returns:
+        dict: Results by CV, parse seconds and AWS calls by operation.
+    """
+
+    from core.aws import get_client
+    from core.classifier import get_cascade
+    from core.process import Parser
+
+    calls = Counter()
+
+    def count(model, **kwargs):
+        calls[model.name] += 1
+
+    # counted before the store answers them
+    get_client("comprehend").meta.events.register("before-call.comprehend", count)
+
+    if mode != "live":
+        store = FixtureStore(fixtures, mode)
+        store.attach(get_client("comprehend"))
+
+    # don't train on evaluation runs
+    cascade = get_cascade()
+    if cascade:
+        cascade.outcomes_path = Path(os.devnull)
+
+    results = {}
+    wall = 0
+
+    for path in paths:
+        blocks = load_blocks(path, fixtures, mode)
+
+        start = time.perf_counter()
+        results[path.name] = Parser().process_blocks(blocks)
+        wall += time.perf_counter() - start
+
+    return {"results": results, "wall": wall, "calls": dict(calls)}
+
+
+def normalize(text):
+    text = re.sub(r"\([^)]*\)", " ", str(text).lower())
+    return " ".join(re.sub(r"[^\w]+", " ", text).split())
+
+
+def counts(result):
+    """Expected or predicted values of every scored field."""
+
+    entries = Counter()
+    titles = Counter()
+
+    for section in SECTIONS:
+        for row in result.get(section, []):
+            year, title = (row["year"], row["title"]) if isinstance(row, dict) else row
+
+            entries[(section, year)] += 1
+            if title:
+                titles[(section, year, normalize(title))] += 1
+
+    return {
+        "name": Counter([normalize(result["name"])] if result.get("name") else []),
+        "dob": Counter([str(result["dob"])] if result.get("dob") else []),
+        "entries": entries,
+        "titles": titles,
+    }
+
+
+def score(gold, results):
+    """Precision and recall of every field over all CVs.
+
+    Returns:
+        dict: ``matched``, ``predicted``, ``expected``, ``precision`` and
+            ``recall`` by field.
+    """
+
+    totals = {field: Counter() for field in FIELDS}
+
+    for name, labels in gold.items():
+        expected = counts(labels)
+        predicted = counts(results.get(name, {}))
+
+        for field in FIELDS:
+            totals[field]["matched"] += sum(
+                (expected[field] & predicted[field]).values()
+            )
+            totals[field]["predicted"] += sum(predicted[field].values())
+            totals[field]["expected"] += sum(expected[field].values())
+
+    scores = {}
+    for field, total in totals.items():
+        scores[field] = dict(
+            total,
+            precision=(
+                total["matched"] / total["predicted"] if total["predicted"] else None
+            ),
+            recall=total["matched"] / total["expected"] if total["expected"] else None,
+        )
+
+    return scores
+
+
+def ratio(value):
+    return "   -" if value is None else "%.2f" % value
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--configs",
+        nargs="+",
+        choices=sorted(CONFIGURATIONS),
+        default=["baseline", "merge"],
+    )
+    parser.add_argument(
+        "--mode", choices=["replay", "record", "live"], default="replay"
+    )
+    parser.add_argument("--fixtures", default=str(FIXTURES_FOLDER))
+    parser.add_argument("--gold", default=str(GOLD_FOLDER))
+    parser.add_argument("--cvs", default=str(CVS_FOLDER))
+    parser.add_argument("--output", help="Write scores and results as JSON.")
+    parser.add_argument("--run", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    gold = {}
+    for label_path in sorted(Path(args.gold).glob("*.json")):
+        labels = json.loads(label_path.read_text())
+        gold[labels["file"]] = labels
+
+    paths = [Path(args.cvs) / name for name in gold]
+
+    # a configuration, run in its own process by the one below
+    if args.run:
+        print(json.dumps(run_configuration(paths, args.fixtures, args.mode)))
+        sys.exit()
+
+    report = {}
+    print(
+        "%-18s %-9s %5s %5s %5s %5s %8s %7s"
+        % ("config", "field", "prec", "rec", "match", "gold", "wall", "calls")
+    )
+
+    for name in args.configs:
+        env = dict(os.environ, **COMMON)
+        env.update(CONFIGURATIONS[name])
+
+        # replayed calls never reach aws, but clients still need a region
+        if args.mode == "replay" and not env.get("AWS_REGION_NAME"):
+            env["AWS_REGION_NAME"] = "us-east-1"
+
+        process = subprocess.run(
+            [sys.executable, __file__, "--run", name]
+            + ["--mode", args.mode, "--fixtures", args.fixtures]
+            + ["--gold", args.gold, "--cvs", args.cvs],
+            env=env,
+            stdout=subprocess.PIPE,
+            check=True,
+        )
+        run = json.loads(process.stdout.decode())
+        run["scores"] = score(gold, run["results"])
+        report[name] = run
+
+        for i, field in enumerate(FIELDS):
+            s = run["scores"][field]
+            print(
+                "%-18s %-9s %5s %5s %5d %5d %8s %7s"
+                % (
+                    name if i == 0 else "",
+                    field,
+                    ratio(s["precision"]),
+                    ratio(s["recall"]),
+                    s["matched"],
+                    s["expected"],
+                    "%.2fs" % run["wall"] if i == 0 else "",
+                    sum(run["calls"].values()) if i == 0 else "",
+                )
+            )
+
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2))
@@ -0,0 +1,363 @@
+"""Measure what layout cleanups save and how accurate they are.
+
+Every CV is parsed twice, without and with continuation lines merged (or
+page headers and footers dropped, with ``--compare furniture``), and the
+lines sent to classification, the rows without a title and the Comprehend
+calls made are compared. CVs are ``textract.json`` files, or PDFs whose text
+layer is turned into LINE blocks with their position on the page:
+
+    python benchmarks/layout.py .freelancer/*.pdf
+    python benchmarks/layout.py --wrap 50 .freelancer/kate.pdf
+    python benchmarks/layout.py --compare furniture --add-furniture .freelancer/*.pdf
+
+Comprehend is served by benchmarks/stub_aws.py unless ``--endpoint`` is given.
+``--wrap`` wraps every line longer than that many characters over several
+lines, as a narrow column would, so the merged entries can be scored against
+the lines they came from. ``--add-furniture`` adds a gallery header and a
+page number footer to every page, as gallery CVs have.
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).parent.parent.resolve()
+
+sys.path.insert(0, str(PROJECT_ROOT))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def pdf_blocks(path):
+    """LINE blocks of the text layer of a PDF, positioned like Textract's."""
+
+    from pypdf import PdfReader
+
+    blocks = []
+
+    for number, page in enumerate(PdfReader(str(path)).pages, start=1):
+        width, height = float(page.mediabox.width), float(page.mediabox.height)
+        chunks = []
+
+        def visit(text, cm, tm, font, size):
+            text = text.replace("\n", " ")
+            if not text.strip():
+                return
+
+            # text matrix in page space
+            a, b, c, d, e, f = cm
+            matrix = [
+                tm[0] * a + tm[1] * c,
+                tm[0] * b + tm[1] * d,
+                tm[2] * a + tm[3] * c,
+                tm[2] * b + tm[3] * d,
+                tm[4] * a + tm[5] * c + e,
+                tm[4] * b + tm[5] * d + f,
+            ]
+            size = size * (abs(matrix[3]) or 1)
+            chunks.append((matrix[4], matrix[5], size, text))
+
+        page.extract_text(visitor_text=visit)
+
+        # chunks on the same baseline make a line
+        lines = []
+        for x, y, size, text in sorted(chunks, key=lambda c: (-round(c[1]), c[0])):
+            if lines and abs(lines[-1]["y"] - y) < size * 0.3:
+                line = lines[-1]
+                line["text"] += text
+                line["right"] = max(line["right"], x + len(text) * size * 0.5)
+            else:
+                lines.append(
+                    {
+                        "y": y,
+                        "size": size,
+                        "left": x,
+                        "right": x + len(text) * size * 0.5,
+                        "text": text,
+                    }
+                )
+
+        for line in lines:
+            if not line["text"].strip():
+                continue
+
+            blocks.append(
+                {
+                    "BlockType": "LINE",
+                    "Id": uuid.uuid4().hex,
+                    "Page": number,
+                    "Text": " ".join(line["text"].split()),
+                    "Geometry": {
+                        "BoundingBox": {
+                            "Left": line["left"] / width,
+                            "Top": (height - line["y"] - line["size"]) / height,
+                            "Width": (line["right"] - line["left"]) / width,
+                            "Height": line["size"] / height,
+                        }
+                    },
+                }
+            )
+
+    return blocks
+
+
+def wrap_blocks(blocks, width):
+    """Wrap long lines into continuation lines with a hanging indent.
+
+    Returns:
+        tuple: The wrapped blocks and the text of every original line.
+    """
+
+    wrapped = []
+    entries = []
+
+    for b in blocks:
+        box = b["Geometry"]["BoundingBox"]
+        words = b["Text"].split()
+        entries.append(b["Text"])
+
+        lines = [[]]
+        for word in words:
+            if lines[-1] and len(" ".join(lines[-1] + [word])) > width:
+                lines.append([])
+            lines[-1].append(word)
+
+        for i, line in enumerate(lines):
+            text = " ".join(line)
+            wrapped.append(
+                dict(
+                    b,
+                    Id=uuid.uuid4().hex,
+                    Text=text,
+                    Geometry={
+                        "BoundingBox": {
+                            "Left": box["Left"] + (0.04 if i else 0),
+                            "Top": box["Top"] + i * box["Height"] * 1.15,
+                            "Width": box["Width"] * len(text) / len(b["Text"]),
+                            "Height": box["Height"],
+                        }
+                    },
+                )
+            )
+
+    return wrapped, entries
+
+
+def add_furniture(blocks):
+    """Add a gallery header and a page number footer to every page."""
+
+    pages = sorted({b.get("Page", 1) for b in blocks})
+    furnished = []
+
+    def line(page, text, top):
+        return {
+            "BlockType": "LINE",
+            "Id": uuid.uuid4().hex,
+            "Page": page,
+            "Text": text,
+            "Geometry": {
+                "BoundingBox": {"Left": 0.1, "Top": top, "Width": 0.5, "Height": 0.01}
+            },
+        }
+
+    for page in pages:
+        furnished.append(line(page, "Example Gallery, 12 Example Street, Sydney", 0.02))
+        furnished += [b for b in blocks if b.get("Page", 1) == page]
+        furnished.append(line(page, "Page %d of %d" % (page, len(pages)), 0.97))
+
+    return furnished
+
+
+def parse(blocks, **options):
+    """Parse blocks counting the Comprehend calls made."""
+
+    from core.aws import get_client
+    from core.process import Parser
+
+    calls = []
+    handler = lambda **kwargs: calls.append(1)  # noqa: E731
+
+    client = get_client("comprehend")
+    client.meta.events.register("after-call.comprehend", handler)
+
+    try:
+        result = Parser(**options).process_blocks(blocks)
+    finally:
+        client.meta.events.unregister("after-call.comprehend", handler)
+
+    rows = result["solo_exhibitions"] + result["group_exhibitions"]
+
+    return {
+        "rows": len(rows),
+        "titled": sum(1 for r in rows if r["title"]),
+        "untitled": sum(1 for r in rows if r["title"] is None),
+        "calls": len(calls),
+    }
+
+
+def score_merge(blocks, entries):
+    """Share of original lines rebuilt exactly, and merges that joined two."""
+
+    from core.layout import merge_continuations
+
+    merged = [b["Text"] for b in merge_continuations(blocks)]
+    expected = set(entries)
+
+    return {
+        "entries": len(entries),
+        "unwrapped": sum(1 for b in blocks if b["Text"] in expected),
+        "rebuilt": sum(1 for text in merged if text in expected),
+        "over_merged": sum(
+            1
+            for b in merge_continuations(blocks)
+            if b.get("MergedIds") and b["Text"] not in expected
+        ),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("paths", nargs="+", help="textract.json or PDF files.")
+    parser.add_argument("--wrap", type=int, help="Wrap lines at this many characters.")
+    parser.add_argument("--compare", choices=["merge", "furniture"], default="merge")
+    parser.add_argument(
+        "--add-furniture",
+        action="store_true",
+        help="Add a header and footer to every page.",
+    )
+    parser.add_argument("--endpoint", help="AWS endpoint, the stub by default.")
+    args = parser.parse_args()
+
+    stub = None
+    endpoint = args.endpoint
+
+    if not endpoint:
+        port = free_port()
+        stub = subprocess.Popen(
+            [
+                sys.executable,
+                str(PROJECT_ROOT / "benchmarks" / "stub_aws.py"),
+                "--port",
+                str(port),
+                "--comprehend-latency",
+                "0",
+            ]
+        )
+        endpoint = "http://127.0.0.1:%d" % port
+        os.environ.update(AWS_ACCESS_KEY_ID="layout", AWS_SECRET_ACCESS_KEY="layout")
+        time.sleep(1)
+
+    # one call per request, decided by comprehend alone
+    os.environ.update(
+        AWS_ENDPOINT_URL=endpoint,
+        AWS_REGION_NAME=os.getenv("AWS_REGION_NAME") or "us-east-1",
+        COMPREHEND_BATCH_WINDOW_MS="0",
+        CLASSIFIER_ENABLED="0",
+        GAZETTEER_ENABLED="0",
+        RATE_LIMIT_ENABLED="0",
+        LOG_LEVEL="WARNING",
+    )
+
+    # parser options without and with the cleanup compared
+    if args.compare == "merge":
+        options = {"drop_furniture": False}
+        off, on = dict(options, merge_lines=False), dict(options, merge_lines=True)
+    else:
+        off, on = {"drop_furniture": False}, {"drop_furniture": True}
+
+    totals = {}
+    print(
+        "%-24s %6s %6s %13s %13s %13s"
+        % (
+            "cv",
+            "lines",
+            "merged" if args.compare == "merge" else "drop",
+            "rows",
+            "untitled",
+            "calls",
+        )
+    )
+
+    try:
+        for path in args.paths:
+            path = Path(path)
+            if path.suffix == ".pdf":
+                blocks = pdf_blocks(path)
+            else:
+                blocks = json.loads(path.read_text())
+
+            blocks = [b for b in blocks if b["BlockType"] == "LINE"]
+            entries = None
+            if args.wrap:
+                blocks, entries = wrap_blocks(blocks, args.wrap)
+            if args.add_furniture:
+                blocks = add_furniture(blocks)
+
+            before = parse(blocks, **off)
+            after = parse(blocks, **on)
+
+            from core.layout import merge_continuations, remove_furniture
+
+            if args.compare == "merge":
+                removed = len(blocks) - len(merge_continuations(blocks))
+            else:
+                removed = len(remove_furniture(blocks)[1])
+
+            print(
+                "%-24s %6d %6d %13s %13s %13s"
+                % (
+                    path.name[:24],
+                    len(blocks),
+                    removed,
+                    "%d -> %d" % (before["rows"], after["rows"]),
+                    "%d -> %d" % (before["untitled"], after["untitled"]),
+                    "%d -> %d" % (before["calls"], after["calls"]),
+                )
+            )
+
+            for name in ["rows", "untitled", "calls"]:
+                totals.setdefault(name, [0, 0])
+                totals[name][0] += before[name]
+                totals[name][1] += after[name]
+            totals["removed"] = totals.get("removed", 0) + removed
+
+            if entries:
+                score = score_merge(blocks, entries)
+                for name, value in score.items():
+                    totals[name] = totals.get(name, 0) + value
+
+        print(
+            "%-24s %6s %6s %13s %13s %13s"
+            % (
+                "total",
+                "",
+                totals["removed"],
+                *("%d -> %d" % tuple(totals[n]) for n in ["rows", "untitled", "calls"]),
+            )
+        )
+
+        if args.wrap:
+            print(
+                "Entries whole: %d -> %d of %d, over-merged: %d"
+                % (
+                    totals["unwrapped"],
+                    totals["rebuilt"],
+                    totals["entries"],
+                    totals["over_merged"],
+                )
+            )
+
+    finally:
+        if stub:
+            stub.terminate()
+            stub.wait()
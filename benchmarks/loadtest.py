@@ -0,0 +1,283 @@
+"""Load test the web and socket tier with simulated browser sessions.
+
+Each session uploads a sample CV from ``.freelancer/`` to ``/save``, opens a
+socket, sends ``job:start`` and waits for the first job message and for
+``job:done``. Sessions run at every concurrency level in turn. By default
+the app and a stub of AWS (benchmarks/stub_aws.py) are started with the
+given latencies:
+
+    python benchmarks/loadtest.py --concurrency 1 5 10 20 --textract-duration 2
+
+Pass ``--url`` to test an app that is already running instead.
+"""
+
+import argparse
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+import socketio
+
+PROJECT_ROOT = Path(__file__).parent.parent.resolve()
+
+SAMPLES = sorted((PROJECT_ROOT / ".freelancer").glob("*.pdf"))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for(url, timeout=30):
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.2)
+
+    raise RuntimeError("%s did not start." % url)
+
+
+def percentile(values, p):
+    """Nearest rank percentile, None without values."""
+
+    if not values:
+        return None
+
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def session(url, sample, timeout):
+    """Run one browser session.
+
+    Returns:
+        dict: Seconds to upload, to the first job message and to ``job:done``,
+            and the error if the session failed.
+    """
+
+    result = {"upload": None, "first": None, "done": None, "error": None}
+
+    # unique content, so every session is a new cv to the app
+    binary = sample.read_bytes() + b"\n%% loadtest " + uuid.uuid4().hex.encode()
+
+    start = time.perf_counter()
+
+    try:
+        response = requests.post(
+            url + "/save",
+            data={"url": ""},
+            files={"cv": (sample.name, binary, "application/pdf")},
+            allow_redirects=False,
+            timeout=timeout,
+        )
+        if response.status_code != 302:
+            raise RuntimeError("Upload returned %d." % response.status_code)
+
+        result["upload"] = time.perf_counter() - start
+        filename = response.headers["Location"].rstrip("/").split("/")[-1]
+
+        client = socketio.Client()
+        first = threading.Event()
+        done = threading.Event()
+        status = {}
+
+        def on_message(data):
+            if not first.is_set():
+                result["first"] = time.perf_counter() - start
+                first.set()
+
+        def on_done(data):
+            status.update(data)
+            result["done"] = time.perf_counter() - start
+            done.set()
+
+        client.on("job:message", on_message)
+        client.on("job:batch", on_message)
+        client.on("job:done", on_done)
+
+        client.connect(url, transports=["websocket"], wait_timeout=timeout)
+        try:
+            client.emit("job:start", {"filename": filename})
+
+            if not done.wait(timeout):
+                raise RuntimeError("Timed out waiting for job:done.")
+        finally:
+            client.disconnect()
+
+        if "processed" not in status.get("status", ""):
+            raise RuntimeError(status.get("status", "No status."))
+
+    except Exception as e:
+        result["error"] = str(e)
+
+    return result
+
+
+def seconds(report, name, percentiles):
+    return "/".join(
+        (
+            "%.2f" % report["%s_p%d" % (name, p)]
+            if report["%s_p%d" % (name, p)] is not None
+            else "-"
+        )
+        for p in percentiles
+    )
+
+
+def run_level(url, concurrency, sessions, timeout):
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [
+            executor.submit(session, url, random.choice(SAMPLES), timeout)
+            for _ in range(sessions)
+        ]
+        results = [f.result() for f in futures]
+
+    report = {"concurrency": concurrency, "sessions": sessions}
+    report["error_rate"] = sum(1 for r in results if r["error"]) / sessions
+    report["errors"] = sorted({r["error"] for r in results if r["error"]})
+
+    for name in ["upload", "first", "done"]:
+        values = [r[name] for r in results if r[name] is not None]
+        for p in [50, 90, 99]:
+            report["%s_p%d" % (name, p)] = percentile(values, p)
+
+    return report
+
+
+def start_app(args, folder):
+    """Start the AWS stub and the app, returning the app url and processes."""
+
+    stub_port, app_port = free_port(), free_port()
+
+    stub = subprocess.Popen(
+        [
+            sys.executable,
+            str(PROJECT_ROOT / "benchmarks" / "stub_aws.py"),
+            "--port",
+            str(stub_port),
+            "--s3-latency",
+            str(args.s3_latency),
+            "--textract-latency",
+            str(args.textract_latency),
+            "--comprehend-latency",
+            str(args.comprehend_latency),
+            "--textract-duration",
+            str(args.textract_duration),
+        ]
+    )
+
+    env = dict(
+        os.environ,
+        PYTHONPATH=str(PROJECT_ROOT),
+        AWS_ENDPOINT_URL="http://127.0.0.1:%d" % stub_port,
+        AWS_ACCESS_KEY_ID="loadtest",
+        AWS_SECRET_ACCESS_KEY="loadtest",
+        AWS_REGION_NAME="us-east-1",
+        AWS_BUCKET_NAME="loadtest",
+        CACHE_FOLDER=str(folder),
+        TEXTRACT_POLL_INTERVAL="0.5",
+        RATE_LIMIT_ENABLED="1" if args.rate_limit else "0",
+        PAGE_REUSE_ENABLED="1" if args.page_reuse else "0",
+        LOG_LEVEL="WARNING",
+    )
+
+    app = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            "import app; from core.aws.s3 import ensure_bucket; "
+            "ensure_bucket(bucket='loadtest'); "
+            "app.socketio.run(app.app, port=%d, allow_unsafe_werkzeug=True)" % app_port,
+        ],
+        cwd=str(PROJECT_ROOT / "web"),
+        env=env,
+    )
+
+    url = "http://127.0.0.1:%d" % app_port
+    wait_for(url)
+
+    return url, [app, stub]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="Test a running app instead.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 5, 10])
+    parser.add_argument(
+        "--sessions", type=int, default=2, help="Sessions per concurrent user."
+    )
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--s3-latency", type=float, default=0.02)
+    parser.add_argument("--textract-latency", type=float, default=0.1)
+    parser.add_argument("--comprehend-latency", type=float, default=0.05)
+    parser.add_argument("--textract-duration", type=float, default=2.0)
+    parser.add_argument("--rate-limit", action="store_true")
+    parser.add_argument("--page-reuse", action="store_true")
+    parser.add_argument("--json", help="Also write the results to this file.")
+    args = parser.parse_args()
+
+    processes = []
+
+    with tempfile.TemporaryDirectory() as folder:
+        try:
+            url = args.url
+            if not url:
+                url, processes = start_app(args, folder)
+
+            reports = []
+            print(
+                "%5s %8s %7s %17s %17s %17s"
+                % (
+                    "users",
+                    "sessions",
+                    "errors",
+                    "upload p50/p90",
+                    "first p50/p90",
+                    "done p50/p90/p99",
+                )
+            )
+
+            for concurrency in args.concurrency:
+                report = run_level(
+                    url, concurrency, concurrency * args.sessions, args.timeout
+                )
+                reports.append(report)
+
+                print(
+                    "%5d %8d %6.0f%% %17s %17s %17s"
+                    % (
+                        concurrency,
+                        report["sessions"],
+                        report["error_rate"] * 100,
+                        seconds(report, "upload", [50, 90]),
+                        seconds(report, "first", [50, 90]),
+                        seconds(report, "done", [50, 90, 99]),
+                    )
+                )
+                for error in report["errors"]:
+                    print("      error:", error)
+
+            if args.json:
+                with open(args.json, "w") as f:
+                    json.dump(reports, f, indent=2)
+
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
@@ -0,0 +1,127 @@
+"""Measure job throughput as job workers are added.
+
+Workers are started against a local broker and run simulated jobs that wait
+like AWS calls and burn CPU like parsing, publishing their messages through
+the broker as real jobs do. Jobs count as done when their ``job:done`` emit
+reaches the broker, i.e. when any web process could forward it to a client:
+
+    python benchmarks/scaling.py --workers 1 2 4 --jobs 40
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).parent.parent.resolve()
+
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from core import cancel  # noqa: E402
+from core.broker import Broker, LocalQueue  # noqa: E402
+
+
+def simulated_job(job, events):
+    """Job handler that stands in for parsing a CV."""
+
+    steps = int(os.getenv("SIMULATED_STEPS", "4"))
+    latency = float(os.getenv("SIMULATED_LATENCY", "0.05"))
+    cpu = float(os.getenv("SIMULATED_CPU", "0.01"))
+
+    for step in range(steps):
+        cancel.sleep(latency)
+
+        end = time.process_time() + cpu
+        while time.process_time() < end:
+            pass
+
+        events.publish(
+            {"code": "welp", "service": "script", "status": "Step %d." % step}
+        )
+
+
+def measure(workers, jobs, threads, env):
+    with tempfile.TemporaryDirectory() as folder:
+        path = Path(folder) / "broker.sqlite"
+        url = "sqlite://" + str(path)
+
+        done = []
+        finished = threading.Event()
+
+        def listen():
+            for body in Broker(path).subscribe("socketio"):
+                if json.loads(body).get("event") == "job:done":
+                    done.append(time.perf_counter())
+                    if len(done) == jobs:
+                        finished.set()
+                        return
+
+        threading.Thread(target=listen, daemon=True).start()
+
+        processes = [
+            subprocess.Popen(
+                [
+                    sys.executable,
+                    "-m",
+                    "core.worker",
+                    "--url",
+                    url,
+                    "--threads",
+                    str(threads),
+                    "--handler",
+                    "benchmarks.scaling:simulated_job",
+                ],
+                cwd=str(PROJECT_ROOT),
+                env=dict(env, PYTHONPATH=str(PROJECT_ROOT)),
+            )
+            for _ in range(workers)
+        ]
+
+        try:
+            # let the workers start before timing
+            time.sleep(3)
+
+            queue = LocalQueue(url)
+            start = time.perf_counter()
+            for number in range(jobs):
+                queue.put({"filename": "job-%d" % number})
+
+            if not finished.wait(timeout=600):
+                raise RuntimeError("Only %d of %d jobs finished." % (len(done), jobs))
+
+            return jobs / (max(done) - start)
+
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--jobs", type=int, default=40)
+    parser.add_argument("--threads", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--cpu", type=float, default=0.01)
+    args = parser.parse_args()
+
+    env = dict(
+        os.environ,
+        SIMULATED_LATENCY=str(args.latency),
+        SIMULATED_CPU=str(args.cpu),
+        LOG_LEVEL="WARNING",
+    )
+
+    baseline = None
+    print("%7s %10s %8s" % ("workers", "jobs/s", "speedup"))
+
+    for workers in args.workers:
+        throughput = measure(workers, args.jobs, args.threads, env)
+        baseline = baseline or throughput
+        print("%7d %10.1f %7.1fx" % (workers, throughput, throughput / baseline))
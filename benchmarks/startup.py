@@ -0,0 +1,70 @@
+"""Measure how long it takes to start the web app and the CLI.
+
+Each target is imported in a fresh interpreter several times and the median
+is reported. Pass ``--ref`` to also measure another git revision, e.g. the
+commit before clients and heavy modules were made lazy:
+
+    python benchmarks/startup.py --ref HEAD~1
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).parent.parent.resolve()
+
+# web/app.py is started as a script, so it imports with web/ on the path
+TARGETS = {
+    "web/app.py": "import sys; sys.path.insert(0, 'web'); import app",
+    "core/process.py": "import core.process",
+}
+
+
+def measure(root, code, runs):
+    env = dict(os.environ, PYTHONPATH=str(root))
+    timings = []
+
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=str(root), env=env, check=True)
+        timings.append(time.perf_counter() - start)
+
+    return statistics.median(timings)
+
+
+def report(label, root, runs):
+    for target, code in TARGETS.items():
+        print(
+            "%-10s %-16s %7.0f ms" % (label, target, measure(root, code, runs) * 1000)
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--ref", help="Git revision to compare against.")
+    args = parser.parse_args()
+
+    if args.ref:
+        with tempfile.TemporaryDirectory() as folder:
+            subprocess.run(
+                ["git", "worktree", "add", "--detach", folder, args.ref],
+                cwd=str(PROJECT_ROOT),
+                check=True,
+                capture_output=True,
+            )
+            try:
+                report(args.ref, Path(folder), args.runs)
+            finally:
+                subprocess.run(
+                    ["git", "worktree", "remove", "--force", folder],
+                    cwd=str(PROJECT_ROOT),
+                    check=True,
+                )
+
+    report("current", PROJECT_ROOT, args.runs)
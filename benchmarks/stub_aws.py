@@ -0,0 +1,356 @@
+"""Serve the S3, Textract and Comprehend calls of the app from memory.
+
+Every call waits for a configurable latency before it is answered, so load
+tests measure the app rather than AWS. Textract jobs finish after a set
+duration and detect the text layer of the PDF; Comprehend tags years,
+names, titles and places with simple rules. Point the app at it with:
+
+    python benchmarks/stub_aws.py --port 4566
+    AWS_ENDPOINT_URL=http://127.0.0.1:4566 python web/app.py
+"""
+
+import argparse
+import hashlib
+import io
+import json
+import re
+import threading
+import time
+import uuid
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+from xml.sax.saxutils import escape
+
+# objects by bucket and key, multipart uploads by id, textract jobs by id
+buckets = {}
+uploads = {}
+jobs = {}
+lock = threading.Lock()
+
+latency = {"s3": 0.0, "textract": 0.0, "comprehend": 0.0}
+textract_duration = 1.0
+
+
+def detect_lines(binary):
+    """Textract LINE blocks of the text layer of a PDF."""
+
+    from pypdf import PdfReader
+
+    blocks = []
+
+    for number, page in enumerate(PdfReader(io.BytesIO(binary)).pages, start=1):
+        lines = [l.strip() for l in (page.extract_text() or "").splitlines()]
+        lines = [l for l in lines if l]
+
+        for i, line in enumerate(lines):
+            top = i / max(len(lines), 1)
+            blocks.append(
+                {
+                    "BlockType": "LINE",
+                    "Id": uuid.uuid4().hex,
+                    "Page": number,
+                    "Text": line,
+                    "Confidence": 99.0,
+                    "Geometry": {
+                        "BoundingBox": {
+                            "Left": 0.1,
+                            "Top": top,
+                            "Width": 0.8,
+                            "Height": 0.9 / max(len(lines), 1),
+                        }
+                    },
+                }
+            )
+
+    return blocks
+
+
+def detect_entities(text):
+    entities = []
+
+    def add(kind, match, group=0):
+        entities.append(
+            {
+                "Type": kind,
+                "Text": match.group(group),
+                "Score": 0.9,
+                "BeginOffset": match.start(group),
+                "EndOffset": match.end(group),
+            }
+        )
+
+    title = re.match(r"Title: (.+?) \((\d{4})\)", text)
+    if title:
+        add("TITLE", title, 1)
+
+    for year in re.finditer(r"(?:19|20)\d{2}", text):
+        add("DATE", year)
+
+    name = re.search(r"\b[A-Z][a-z]+ [A-Z][a-z]+\b", text)
+    if name and not title:
+        add("PERSON", name)
+
+    place = re.search(r", ([A-Z][^,()]*)$", text)
+    if place:
+        add("LOCATION", place, 1)
+
+    return entities
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def reply(self, status=200, body=b"", headers=None, content_type="text/xml"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def reply_json(self, data, status=200):
+        self.reply(status, json.dumps(data).encode(), content_type="application/json")
+
+    def error(self, status, code):
+        body = "<Error><Code>%s</Code><Message>%s</Message></Error>" % (code, code)
+        self.reply(status, body.encode())
+
+    # json protocol services, the operation is in the target header
+
+    def do_POST(self):
+        target = self.headers.get("X-Amz-Target")
+
+        if target is None:
+            return self.s3()
+
+        service, operation = target.split(".")
+        data = json.loads(self.body() or b"{}")
+
+        if service.startswith("Textract"):
+            time.sleep(latency["textract"])
+            return self.textract(operation, data)
+
+        time.sleep(latency["comprehend"])
+        return self.comprehend(operation, data)
+
+    def textract(self, operation, data):
+        if operation == "StartDocumentTextDetection":
+            location = data["DocumentLocation"]["S3Object"]
+            job_id = uuid.uuid4().hex
+            with lock:
+                binary = buckets.get(location["Bucket"], {}).get(location["Name"])
+                jobs[job_id] = {
+                    "binary": binary,
+                    "ready": time.time() + textract_duration,
+                }
+            return self.reply_json({"JobId": job_id})
+
+        job = jobs.get(data.get("JobId"))
+        if job is None:
+            return self.reply_json(
+                {"__type": "InvalidJobIdException", "message": "Unknown job."}, 400
+            )
+
+        if time.time() < job["ready"]:
+            return self.reply_json({"JobStatus": "IN_PROGRESS"})
+
+        if job["binary"] is None:
+            return self.reply_json({"JobStatus": "FAILED"})
+
+        if "blocks" not in job:
+            job["blocks"] = detect_lines(job["binary"])
+
+        return self.reply_json({"JobStatus": "SUCCEEDED", "Blocks": job["blocks"]})
+
+    def comprehend(self, operation, data):
+        if operation == "BatchDetectEntities":
+            return self.reply_json(
+                {
+                    "ResultList": [
+                        {"Index": i, "Entities": detect_entities(text)}
+                        for i, text in enumerate(data["TextList"])
+                    ],
+                    "ErrorList": [],
+                }
+            )
+
+        return self.reply_json({"Entities": detect_entities(data["Text"])})
+
+    # s3 with path style addressing
+
+    def do_GET(self):
+        self.s3()
+
+    def do_HEAD(self):
+        self.s3()
+
+    def do_PUT(self):
+        self.s3()
+
+    def do_DELETE(self):
+        self.s3()
+
+    def s3(self):
+        time.sleep(latency["s3"])
+
+        # read the body first, keep-alive connections carry the next request
+        binary = self.body()
+
+        url = urlparse(self.path)
+        query = parse_qs(url.query, keep_blank_values=True)
+        bucket, _, key = unquote(url.path).lstrip("/").partition("/")
+        objects = buckets.get(bucket)
+
+        if not key:
+            if self.command == "PUT":
+                buckets.setdefault(bucket, {})
+                return self.reply()
+            if objects is None:
+                return self.error(404, "NoSuchBucket")
+            if self.command == "HEAD":
+                return self.reply()
+            return self.list_objects(objects, query.get("prefix", [""])[0])
+
+        if objects is None:
+            return self.error(404, "NoSuchBucket")
+
+        if self.command == "POST":
+            if "uploads" in query:
+                upload_id = uuid.uuid4().hex
+                uploads[upload_id] = {}
+                return self.reply(
+                    body=(
+                        "<InitiateMultipartUploadResult><Bucket>%s</Bucket>"
+                        "<Key>%s</Key><UploadId>%s</UploadId>"
+                        "</InitiateMultipartUploadResult>"
+                        % (escape(bucket), escape(key), upload_id)
+                    ).encode()
+                )
+
+            parts = uploads.pop(query["uploadId"][0])
+            objects[key] = b"".join(parts[n] for n in sorted(parts))
+            return self.reply(
+                body=(
+                    '<CompleteMultipartUploadResult><Key>%s</Key><ETag>"%s"</ETag>'
+                    "</CompleteMultipartUploadResult>"
+                    % (escape(key), hashlib.md5(objects[key]).hexdigest())
+                ).encode()
+            )
+
+        if self.command == "PUT":
+            if "uploadId" in query:
+                uploads[query["uploadId"][0]][int(query["partNumber"][0])] = binary
+                etag = hashlib.md5(binary).hexdigest()
+                return self.reply(headers={"ETag": '"%s"' % etag})
+
+            source = self.headers.get("x-amz-copy-source")
+            if source:
+                source_bucket, _, source_key = (
+                    unquote(source).lstrip("/").partition("/")
+                )
+                binary = buckets.get(source_bucket, {}).get(source_key)
+                if binary is None:
+                    return self.error(404, "NoSuchKey")
+                objects[key] = binary
+                return self.reply(
+                    body=(
+                        '<CopyObjectResult><ETag>"%s"</ETag></CopyObjectResult>'
+                        % hashlib.md5(binary).hexdigest()
+                    ).encode()
+                )
+
+            # conditional writes, e.g. of manifests
+            with lock:
+                current = objects.get(key)
+                if_match = self.headers.get("If-Match")
+                if_none_match = self.headers.get("If-None-Match")
+
+                if if_none_match == "*" and current is not None:
+                    return self.error(412, "PreconditionFailed")
+                if if_match and (
+                    current is None
+                    or if_match.strip('"') != hashlib.md5(current).hexdigest()
+                ):
+                    return self.error(412, "PreconditionFailed")
+
+                objects[key] = binary
+
+            return self.reply(
+                headers={"ETag": '"%s"' % hashlib.md5(binary).hexdigest()}
+            )
+
+        if self.command == "DELETE":
+            if "uploadId" in query:
+                uploads.pop(query["uploadId"][0], None)
+            else:
+                objects.pop(key, None)
+            return self.reply(204)
+
+        binary = objects.get(key)
+        if binary is None:
+            return self.error(404, "NoSuchKey")
+
+        headers = {
+            "ETag": '"%s"' % hashlib.md5(binary).hexdigest(),
+            "Last-Modified": formatdate(usegmt=True),
+        }
+
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(binary) - 1
+            headers["Content-Range"] = "bytes %d-%d/%d" % (start, end, len(binary))
+            return self.reply(206, binary[start : end + 1], headers, "application/pdf")
+
+        return self.reply(200, binary, headers, "application/pdf")
+
+    def list_objects(self, objects, prefix):
+        contents = "".join(
+            '<Contents><Key>%s</Key><Size>%d</Size><ETag>"%s"</ETag>'
+            "<LastModified>2020-01-01T00:00:00.000Z</LastModified></Contents>"
+            % (escape(key), len(binary), hashlib.md5(binary).hexdigest())
+            for key, binary in sorted(objects.items())
+            if key.startswith(prefix)
+        )
+        self.reply(
+            body=(
+                "<ListBucketResult><Prefix>%s</Prefix><IsTruncated>false</IsTruncated>"
+                "%s</ListBucketResult>" % (escape(prefix), contents)
+            ).encode()
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=4566)
+    parser.add_argument("--s3-latency", type=float, default=0.02)
+    parser.add_argument("--textract-latency", type=float, default=0.1)
+    parser.add_argument("--comprehend-latency", type=float, default=0.05)
+    parser.add_argument(
+        "--textract-duration",
+        type=float,
+        default=2.0,
+        help="Seconds before a text detection job succeeds.",
+    )
+    args = parser.parse_args()
+
+    latency.update(
+        s3=args.s3_latency,
+        textract=args.textract_latency,
+        comprehend=args.comprehend_latency,
+    )
+    textract_duration = args.textract_duration
+
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), Handler)
+    server.daemon_threads = True
+    server.serve_forever()
@@ -0,0 +1,141 @@
+"""Serve CV pages like gallery websites do, to crawl without the internet.
+
+Page ``/cv/{n}.html`` lists exhibitions of artist ``n`` and ``/cv/{n}.pdf``
+serves the same CV as a PDF. Pages answer conditional requests with their
+ETag and Last-Modified unless ``--no-validators`` is given, and pages embed
+a per-request script token, like the cache busters of real sites. POST
+``/touch/{n}`` changes the text of a CV. Crawl it with:
+
+    python benchmarks/stub_web.py --port 8001 --pages 20
+    python -m core.crawl --url http://127.0.0.1:8001/cv/1.html
+"""
+
+import argparse
+import io
+import threading
+import time
+import uuid
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# revision and change time of every page, requests served by path
+pages = {}
+served = {}
+lock = threading.Lock()
+
+validators = True
+
+
+def cv_text(number, revision):
+    lines = ["Artist %d" % number, "Born 1970, Sydney", "Solo Exhibitions"]
+    lines += [
+        "%d Exhibition %d, Gallery %d, Melbourne" % (2020 - i, i, number)
+        for i in range(revision + 3)
+    ]
+    return lines
+
+
+def cv_html(number, revision):
+    items = "".join("<li>%s</li>" % line for line in cv_text(number, revision))
+    return (
+        "<html><head><script>var token = '%s';</script></head>"
+        "<body><ul>%s</ul></body></html>" % (uuid.uuid4().hex, items)
+    ).encode()
+
+
+def cv_pdf(number, revision):
+    from pypdf import PdfWriter
+    from pypdf.generic import DecodedStreamObject, NameObject
+
+    writer = PdfWriter()
+    page = writer.add_blank_page(width=595, height=842)
+
+    text = "".join(
+        "BT /F1 12 Tf 50 %d Td (%s) Tj ET\n" % (800 - 16 * i, line)
+        for i, line in enumerate(cv_text(number, revision))
+    )
+    stream = DecodedStreamObject()
+    stream.set_data(text.encode())
+    page[NameObject("/Contents")] = writer._add_object(stream)
+
+    out = io.BytesIO()
+    writer.write(out)
+    return out.getvalue()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body=b"", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        number = self.page_number("/touch/")
+        if number is None:
+            return self.reply(404)
+
+        with lock:
+            revision, _ = pages[number]
+            pages[number] = (revision + 1, time.time())
+
+        self.reply(204)
+
+    def do_GET(self):
+        with lock:
+            served[self.path] = served.get(self.path, 0) + 1
+
+        number = self.page_number("/cv/")
+        if number is None:
+            return self.reply(404)
+
+        revision, changed = pages[number]
+        etag = '"%d-%d"' % (number, revision)
+        headers = {}
+
+        if validators:
+            headers = {"ETag": etag, "Last-Modified": formatdate(changed, usegmt=True)}
+
+            if self.headers.get("If-None-Match") == etag:
+                return self.reply(304, headers=headers)
+
+        if self.path.endswith(".pdf"):
+            body = cv_pdf(number, revision)
+            headers["Content-Type"] = "application/pdf"
+        else:
+            body = cv_html(number, revision)
+            headers["Content-Type"] = "text/html; charset=utf-8"
+
+        self.reply(200, body, headers)
+
+    def page_number(self, prefix):
+        if not self.path.startswith(prefix):
+            return None
+
+        name = self.path[len(prefix) :].split(".")[0]
+        if not name.isdigit() or int(name) not in pages:
+            return None
+
+        return int(name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--no-validators", action="store_true")
+    args = parser.parse_args()
+
+    validators = not args.no_validators
+    pages.update({n: (0, time.time()) for n in range(1, args.pages + 1)})
+
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), Handler)
+    server.daemon_threads = True
+    server.serve_forever()
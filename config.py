@@ -1,3 +1,4 @@
+import json
 import os
 from pathlib import Path
 
@@ -26,4 +27,246 @@ load_dotenv(ENV_LOCAL_PATH, override=True)
 AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
 AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 AWS_REGION_NAME = os.getenv("AWS_REGION_NAME")
-AWS_BUCKET_NAME = os.getenv("AWS_BUCKET_NAME")
\ No newline at end of file
+AWS_BUCKET_NAME = os.getenv("AWS_BUCKET_NAME")
+
+###########
+# LOGGING #
+###########
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
+##########
+# EVENTS #
+##########
+
+# seconds between batched socket frames
+EVENT_FLUSH_INTERVAL = float(os.getenv("EVENT_FLUSH_INTERVAL", "0.5"))
+
+# messages kept per job so reconnecting clients can catch up
+EVENT_REPLAY_SIZE = int(os.getenv("EVENT_REPLAY_SIZE", "1000"))
+
+# jobs kept in the replay buffer before the oldest is dropped
+EVENT_REPLAY_JOBS = int(os.getenv("EVENT_REPLAY_JOBS", "100"))
+
+#########
+# CACHE #
+#########
+
+# local state such as indexes, models and checkpoints
+CACHE_FOLDER = Path(os.getenv("CACHE_FOLDER", str(PROJECT_ROOT / ".cache")))
+
+#############
+# GAZETTEER #
+#############
+
+GAZETTEER_ENABLED = os.getenv("GAZETTEER_ENABLED", "1") == "1"
+GAZETTEER_PATH = CACHE_FOLDER / "gazetteer.json"
+
+# times a venue or place must be seen before it is trusted
+GAZETTEER_MIN_COUNT = int(os.getenv("GAZETTEER_MIN_COUNT", "2"))
+
+# seconds between checks of the bucket for new parsed results
+GAZETTEER_REFRESH_INTERVAL = int(os.getenv("GAZETTEER_REFRESH_INTERVAL", "3600"))
+
+##########
+# SEARCH #
+##########
+
+SEARCH_INDEX_PATH = CACHE_FOLDER / "search.json"
+
+# seconds between checks of the bucket for new parsed results
+SEARCH_REFRESH_INTERVAL = int(os.getenv("SEARCH_REFRESH_INTERVAL", "300"))
+
+# most results a query returns at once
+SEARCH_MAX_LIMIT = int(os.getenv("SEARCH_MAX_LIMIT", "1000"))
+
+##############
+# CLASSIFIER #
+##############
+
+CLASSIFIER_ENABLED = os.getenv("CLASSIFIER_ENABLED", "1") == "1"
+CLASSIFIER_MODEL_PATH = CACHE_FOLDER / "classifier.json"
+
+# Comprehend decisions recorded as training data
+CLASSIFIER_OUTCOMES_PATH = CACHE_FOLDER / "comprehend-outcomes.jsonl"
+
+# lines predicted below this probability are sent to Comprehend
+CLASSIFIER_THRESHOLD = float(os.getenv("CLASSIFIER_THRESHOLD", "0.9"))
+
+# fraction of confident lines also sent to Comprehend to measure agreement
+CLASSIFIER_AUDIT_RATE = float(os.getenv("CLASSIFIER_AUDIT_RATE", "0.05"))
+
+#########
+# PAGES #
+#########
+
+# reuse OCR of pages already seen in earlier versions of a CV
+PAGE_REUSE_ENABLED = os.getenv("PAGE_REUSE_ENABLED", "1") == "1"
+
+##########
+# LAYOUT #
+##########
+
+# merge lines wrapped from the one above before exhibitions are classified
+LAYOUT_MERGE_ENABLED = os.getenv("LAYOUT_MERGE_ENABLED", "1") == "1"
+
+# drop headers and footers repeated across the pages of a CV before parsing
+LAYOUT_FURNITURE_ENABLED = os.getenv("LAYOUT_FURNITURE_ENABLED", "1") == "1"
+
+###############
+# CHECKPOINTS #
+###############
+
+# resume failed jobs from the last completed stage and classified line
+CHECKPOINTS_ENABLED = os.getenv("CHECKPOINTS_ENABLED", "1") == "1"
+
+# seconds of classification progress a worker that dies can lose
+CHECKPOINT_INTERVAL = float(os.getenv("CHECKPOINT_INTERVAL", "10"))
+
+##################
+# AWS CONNECTION #
+##################
+
+# connections kept open per client, shared by all threads of a process
+AWS_MAX_POOL_CONNECTIONS = int(os.getenv("AWS_MAX_POOL_CONNECTIONS", "50"))
+
+# attempts per call, retried with the adaptive (client side throttling) mode
+AWS_MAX_ATTEMPTS = int(os.getenv("AWS_MAX_ATTEMPTS", "5"))
+
+# endpoint of every service, e.g. LocalStack or the load test stub
+AWS_ENDPOINT_URL = os.getenv("AWS_ENDPOINT_URL") or None
+
+# seconds between Textract job status checks
+TEXTRACT_POLL_INTERVAL = float(os.getenv("TEXTRACT_POLL_INTERVAL", "5"))
+
+###############
+# RATE LIMITS #
+###############
+
+# share request rates of comprehend and textract between workers
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+RATE_LIMIT_PATH = CACHE_FOLDER / "ratelimit.sqlite"
+
+# requests per second by operation, e.g. {"DetectEntities": 20}
+RATE_LIMITS = json.loads(os.getenv("RATE_LIMITS", "{}"))
+
+##############
+# COMPREHEND #
+##############
+
+# milliseconds to collect detect_entities requests into one batch call, 0 disables
+COMPREHEND_BATCH_WINDOW_MS = float(os.getenv("COMPREHEND_BATCH_WINDOW_MS", "5"))
+
+###########
+# UPLOADS #
+###########
+
+# largest accepted CV in bytes
+UPLOAD_MAX_SIZE = int(os.getenv("UPLOAD_MAX_SIZE", str(50 * 1024 * 1024)))
+
+# bytes buffered in memory per multipart upload part (S3 minimum is 5MB)
+UPLOAD_PART_SIZE = int(os.getenv("UPLOAD_PART_SIZE", str(8 * 1024 * 1024)))
+
+# bytes of web cvs and parsed pdfs kept in web/static/uploads
+UPLOADS_BUDGET = int(os.getenv("UPLOADS_BUDGET", str(2 * 1024 * 1024 * 1024)))
+
+#############
+# ARTIFACTS #
+#############
+
+# results served by the web app, stored by content
+ARTIFACT_CACHE_FOLDER = CACHE_FOLDER / "artifacts"
+
+# seconds before the web app checks whether a result that can be re-parsed changed
+ARTIFACT_REVALIDATE = int(os.getenv("ARTIFACT_REVALIDATE", "60"))
+
+# seconds browsers may use a result that can be re-parsed without revalidating
+ARTIFACT_MAX_AGE = int(os.getenv("ARTIFACT_MAX_AGE", "86400"))
+
+# bytes of artifacts kept in the local cache
+ARTIFACT_CACHE_BUDGET = int(
+    os.getenv("ARTIFACT_CACHE_BUDGET", str(2 * 1024 * 1024 * 1024))
+)
+
+# seconds between sweeps of local files over their budget
+LOCAL_SWEEP_INTERVAL = float(os.getenv("LOCAL_SWEEP_INTERVAL", "300"))
+
+# seconds a local file is kept after its last use, however full the folder
+LOCAL_MIN_AGE = float(os.getenv("LOCAL_MIN_AGE", "3600"))
+
+###########
+# SCALING #
+###########
+
+# queue shared by the web and job workers: empty runs jobs in the web process,
+# `sqlite://` uses a local broker for a single host, or a redis:// or amqp:// url
+MESSAGE_QUEUE = os.getenv("MESSAGE_QUEUE", "")
+
+# local broker database used by `sqlite://`
+BROKER_PATH = CACHE_FOLDER / "broker.sqlite"
+
+# socket.io async mode (threading, eventlet or gevent), detected when empty
+SOCKETIO_ASYNC_MODE = os.getenv("SOCKETIO_ASYNC_MODE") or None
+
+# jobs a worker process runs at the same time
+JOB_THREADS = int(os.getenv("JOB_THREADS", "4"))
+
+# seconds a job keeps running after its last client disconnected, so a
+# reloading page can rejoin it
+JOB_CANCEL_GRACE = float(os.getenv("JOB_CANCEL_GRACE", "10"))
+
+#############
+# PROFILING #
+#############
+
+# profile every job, single jobs can also ask for it with a `profile` flag
+PROFILE_JOBS = os.getenv("PROFILE_JOBS", "0") == "1"
+
+# seconds between stack samples of a profiled job
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+
+############
+# CRAWLING #
+############
+
+# fetch state of every crawled source, validators and content hashes
+CRAWL_STATE_PATH = CACHE_FOLDER / "crawl.sqlite"
+
+# sources crawled at the same time, across all hosts
+CRAWL_WORKERS = int(os.getenv("CRAWL_WORKERS", "8"))
+
+# requests a single host gets at the same time
+CRAWL_HOST_CONCURRENCY = int(os.getenv("CRAWL_HOST_CONCURRENCY", "1"))
+
+# seconds between the start of two requests to the same host
+CRAWL_HOST_DELAY = float(os.getenv("CRAWL_HOST_DELAY", "2"))
+
+# seconds before a fetch gives up
+CRAWL_TIMEOUT = float(os.getenv("CRAWL_TIMEOUT", "30"))
+
+CRAWL_USER_AGENT = os.getenv("CRAWL_USER_AGENT", "artbiogs-crawler/1.0")
+
+#######
+# API #
+#######
+
+# most CVs a single bulk submission or status poll may list
+API_MAX_JOBS = int(os.getenv("API_MAX_JOBS", "500"))
+
+# largest bulk submission in bytes, every CV in it is limited to UPLOAD_MAX_SIZE
+API_MAX_SIZE = int(os.getenv("API_MAX_SIZE", str(1024 * 1024 * 1024)))
+
+# url every finished api job is posted to, none when empty
+API_CALLBACK_URL = os.getenv("API_CALLBACK_URL", "")
+
+# key the callback body is signed with, unsigned when empty
+API_CALLBACK_SECRET = os.getenv("API_CALLBACK_SECRET", "")
+
+# attempts after the first failed callback, with exponential backoff
+API_CALLBACK_RETRIES = int(os.getenv("API_CALLBACK_RETRIES", "3"))
+
+# seconds before a callback gives up
+API_CALLBACK_TIMEOUT = float(os.getenv("API_CALLBACK_TIMEOUT", "10"))
+
+# callbacks posted at once, apart from the jobs
+API_CALLBACK_THREADS = int(os.getenv("API_CALLBACK_THREADS", "4"))
@@ -0,0 +1,260 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+
+from core import metrics
+from core.aws.s3 import download_file_etag, file_etag
+from core.logs import get_logger
+
+from config import (
+    ARTIFACT_CACHE_BUDGET,
+    ARTIFACT_CACHE_FOLDER,
+    ARTIFACT_REVALIDATE,
+    AWS_BUCKET_NAME,
+    LOCAL_MIN_AGE,
+    LOCAL_SWEEP_INTERVAL,
+)
+
+logger = get_logger(__name__)
+
+# artifacts that never change for a file hash, the cv and its ocr
+IMMUTABLE = {"pdf", "textract", "original", "textract_copy"}
+
+# object versions remembered
+MAX_VERSIONS = 10000
+
+
+class LocalStore:
+    """Files kept on local disk within a size budget.
+
+    Files are named by a hash and kept in subfolders named by its first two
+    characters, so no folder grows large. The modification time of a file is
+    its last use: files are touched when they are found, and a sweep deletes
+    the least recently used ones while the folder is over its ``budget``.
+    A file is only deleted once unused for ``min_age`` seconds and when
+    ``in_bucket`` confirms a copy of it is stored in S3; files at the top of
+    the folder, from before it was sharded, are swept the same way.
+    """
+
+    def __init__(
+        self,
+        name,
+        folder,
+        budget,
+        in_bucket=lambda path: True,
+        min_age=LOCAL_MIN_AGE,
+    ):
+        self.name = name
+        self.folder = folder
+        self.budget = budget
+        self.in_bucket = in_bucket
+        self.min_age = min_age
+
+    def path(self, filename):
+        return self.folder / filename[:2] / filename
+
+    def touch(self, path):
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+    def find(self, filename):
+        """Get the path of a stored file, None if there is no such file."""
+
+        for path in [self.path(filename), self.folder / filename]:
+            if path.is_file():
+                self.touch(path)
+                return path
+
+        return None
+
+    def add(self, file_path, filename):
+        """Move a file into the store.
+
+        Returns:
+            Path: Where the file is stored.
+        """
+
+        path = self.path(filename)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(file_path, path)
+
+        return path
+
+    def files(self):
+        """Stored files and their stat, skipping downloads in progress."""
+
+        if not self.folder.is_dir():
+            return
+
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    with os.scandir(entry.path) as shard:
+                        for file in shard:
+                            if file.is_file() and not file.name.endswith(".tmp"):
+                                yield file.path, file.stat()
+                elif entry.is_file() and not entry.name.endswith(".tmp"):
+                    yield entry.path, entry.stat()
+
+    def sweep(self):
+        """Delete the least recently used files while over the budget.
+
+        Returns:
+            dict: Bytes ``used`` after the sweep, files ``evicted`` and
+                bytes ``freed``.
+        """
+
+        files = sorted(self.files(), key=lambda file: file[1].st_mtime)
+        used = sum(stat.st_size for _, stat in files)
+        evicted = freed = 0
+        now = time.time()
+
+        for path, stat in files:
+            # the rest were used more recently
+            if used <= self.budget or now - stat.st_mtime < self.min_age:
+                break
+
+            if not self.in_bucket(Path(path)):
+                continue
+
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+            used -= stat.st_size
+            freed += stat.st_size
+            evicted += 1
+
+        metrics.gauge("disk_%s_bytes" % self.name, used)
+        metrics.gauge("disk_%s_files" % self.name, len(files) - evicted)
+        metrics.increment("disk_%s_evicted" % self.name, evicted)
+
+        if evicted:
+            logger.info(
+                "Local files evicted.",
+                extra={"store": self.name, "files": evicted, "bytes": freed},
+            )
+
+        if used > self.budget:
+            logger.warning(
+                "Local files over budget.",
+                extra={"store": self.name, "bytes": used, "budget": self.budget},
+            )
+
+        return {"used": used, "evicted": evicted, "freed": freed}
+
+
+def sweep_in_background(stores, interval=LOCAL_SWEEP_INTERVAL):
+    """Sweep local stores every ``interval`` seconds, starting now."""
+
+    def sweep():
+        while True:
+            for store in stores:
+                try:
+                    store.sweep()
+                except Exception:
+                    logger.exception("Local sweep failed.", extra={"store": store.name})
+
+            time.sleep(interval)
+
+    threading.Thread(target=sweep, daemon=True).start()
+
+
+class ArtifactCache:
+    """Local copies of stored artifacts, addressed by their content.
+
+    Objects are downloaded once and kept under their S3 ETag, so every
+    version of an object is a separate file and a file never changes once
+    written. Which version an object is at is remembered in memory: forever
+    for immutable artifacts, and for ``revalidate`` seconds for results that
+    are replaced when a CV is re-parsed. Copies are kept within ``budget``
+    bytes, the least recently used are deleted by sweeps of :attr:`store`.
+    """
+
+    def __init__(
+        self,
+        folder=ARTIFACT_CACHE_FOLDER,
+        bucket=AWS_BUCKET_NAME,
+        revalidate=ARTIFACT_REVALIDATE,
+        budget=ARTIFACT_CACHE_BUDGET,
+    ):
+        self.folder = folder
+        self.bucket = bucket
+        self.revalidate = revalidate
+
+        # every copy is of an object in the bucket
+        self.store = LocalStore("artifacts", folder, budget)
+
+        # etag and check time by object name, least recently used first
+        self.versions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def path(self, etag):
+        return self.store.path(etag)
+
+    def remember(self, object_name, etag):
+        with self.lock:
+            self.versions[object_name] = (etag, time.monotonic())
+            self.versions.move_to_end(object_name)
+
+            while len(self.versions) > MAX_VERSIONS:
+                self.versions.popitem(last=False)
+
+    def version(self, object_name, immutable):
+        with self.lock:
+            etag, checked = self.versions.get(object_name, (None, 0))
+
+        if etag and (immutable or time.monotonic() - checked < self.revalidate):
+            return etag
+
+        if etag:
+            etag = file_etag(bucket=self.bucket, object_name=object_name)
+            self.remember(object_name, etag)
+
+        return etag
+
+    def get(self, object_name, immutable=False):
+        """Get the local copy of an object, downloading it when needed.
+
+        Args:
+            object_name (str): Key of the object.
+            immutable (bool, optional): The object never changes.
+
+        Returns:
+            tuple: Path of the copy and the ETag of its version.
+        """
+
+        etag = self.version(object_name, immutable)
+
+        if etag and self.path(etag).is_file():
+            self.store.touch(self.path(etag))
+            return self.path(etag), etag
+
+        # name the copy after the version actually downloaded
+        self.folder.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.folder / ("%s.tmp" % uuid.uuid4().hex)
+
+        try:
+            etag = download_file_etag(
+                bucket=self.bucket, object_name=object_name, file_path=tmp_path
+            )
+            self.path(etag).parent.mkdir(parents=True, exist_ok=True)
+            tmp_path.replace(self.path(etag))
+        finally:
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+        self.remember(object_name, etag)
+        logger.debug("Artifact cached.", extra={"key": object_name, "etag": etag})
+
+        return self.path(etag), etag
+
+
+# process-wide instance
+artifact_cache = ArtifactCache()
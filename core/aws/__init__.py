@@ -0,0 +1,74 @@
+import os
+import threading
+
+from config import (
+    AWS_ACCESS_KEY_ID,
+    AWS_ENDPOINT_URL,
+    AWS_MAX_ATTEMPTS,
+    AWS_MAX_POOL_CONNECTIONS,
+    AWS_REGION_NAME,
+    AWS_SECRET_ACCESS_KEY,
+    RATE_LIMIT_ENABLED,
+)
+
+# clients by (service, process id)
+clients = {}
+clients_lock = threading.Lock()
+
+
+def get_client(service):
+    """Get the shared client of an AWS service, creating it on first use.
+
+    boto3 is only imported here, so importing the ``core.aws`` modules is
+    cheap. Clients are thread-safe and shared by every thread of a process;
+    a forked process builds its own.
+
+    Args:
+        service (str): Service name, e.g. ``s3``.
+
+    Returns:
+        botocore.client.BaseClient: The client.
+    """
+
+    key = (service, os.getpid())
+    client = clients.get(key)
+
+    if client is not None:
+        return client
+
+    with clients_lock:
+        if key not in clients:
+            import boto3
+            from botocore.config import Config
+
+            config = Config(
+                max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+                tcp_keepalive=True,
+                retries={"mode": "adaptive", "max_attempts": AWS_MAX_ATTEMPTS},
+                # buckets as hostnames only resolve on AWS itself
+                s3={"addressing_style": "path"} if AWS_ENDPOINT_URL else None,
+            )
+
+            client = boto3.session.Session().client(
+                service,
+                aws_access_key_id=AWS_ACCESS_KEY_ID,
+                aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+                region_name=AWS_REGION_NAME,
+                endpoint_url=AWS_ENDPOINT_URL,
+                config=config,
+            )
+
+            # trace calls of profiled jobs
+            from core import profile
+
+            profile.register(client)
+
+            # share request rates with the other workers
+            if RATE_LIMIT_ENABLED:
+                from core.aws.ratelimit import rate_limiter
+
+                rate_limiter.register(client)
+
+            clients[key] = client
+
+        return clients[key]
@@ -1,19 +1,136 @@
+import queue
 import re
-
-import boto3
-
-from config import AWS_ACCESS_KEY_ID, AWS_REGION_NAME, AWS_SECRET_ACCESS_KEY
-
-comprehend = boto3.client(
-    "comprehend",
-    aws_access_key_id=AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-    region_name=AWS_REGION_NAME,
-)
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from core import metrics
+from core.aws import get_client
+from core.aws.ratelimit import BATCH, INTERACTIVE, current_priority, priority
+from core.classifier import get_cascade
+from core.gazetteer import get_gazetteer
+from core.profile import current_profile
+
+from config import COMPREHEND_BATCH_WINDOW_MS
+
+
+class EntityDetectionError(Exception):
+    pass
+
+
+class EntityBatcher:
+    """Send the detect_entities requests of concurrent jobs as batch calls.
+
+    Requests are collected for ``window`` seconds after the first one arrives,
+    or until 25 (the BatchDetectEntities maximum) are waiting, and sent as one
+    ``batch_detect_entities`` call. Every caller gets its own result through a
+    future. A lone request is sent with ``detect_entities``, which has a
+    higher quota.
+    """
+
+    MAX_BATCH = 25
+
+    # BatchDetectEntities accepts up to 5000 bytes per text
+    MAX_BYTES = 5000
+
+    def __init__(self, window=COMPREHEND_BATCH_WINDOW_MS / 1000, workers=4):
+        self.window = window
+        self.workers = workers
+        self.queue = queue.Queue()
+        self.thread = None
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.executor = ThreadPoolExecutor(max_workers=self.workers)
+                self.thread = threading.Thread(target=self.collect, daemon=True)
+                self.thread.start()
+
+    def submit(self, text):
+        future = Future()
+        self.start()
+        self.queue.put((text, current_priority.get(), future))
+        return future
+
+    def collect(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.window
+
+            while len(batch) < self.MAX_BATCH:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self.executor.submit(self.send, batch)
+
+    def send(self, batch):
+        metrics.observe("comprehend.batch_fill", len(batch) / self.MAX_BATCH)
+
+        # interactive callers in the batch keep their priority
+        level = INTERACTIVE if any(p == INTERACTIVE for _, p, _ in batch) else BATCH
+        client = get_client("comprehend")
+
+        try:
+            with priority(level):
+                if len(batch) == 1:
+                    text, _, future = batch[0]
+                    future.set_result(
+                        client.detect_entities(Text=text, LanguageCode="en")
+                    )
+                    return
+
+                response = client.batch_detect_entities(
+                    TextList=[text for text, _, _ in batch], LanguageCode="en"
+                )
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for result in response["ResultList"]:
+            batch[result["Index"]][2].set_result({"Entities": result["Entities"]})
+
+        for error in response["ErrorList"]:
+            batch[error["Index"]][2].set_exception(
+                EntityDetectionError(error["ErrorCode"], error["ErrorMessage"])
+            )
+
+
+# process-wide instance
+batcher = EntityBatcher()
+
+
+def detect_entities(text):
+    # batch with requests of other jobs when enabled
+    if batcher.window > 0 and len(text.encode()) <= EntityBatcher.MAX_BYTES:
+        start = time.perf_counter()
+        result = batcher.submit(text).result()
+
+        # the batch call is made on the batcher thread, trace the wait here
+        profile = current_profile.get()
+        if profile is not None:
+            profile.record(
+                "comprehend",
+                "DetectEntities (batched)",
+                start,
+                time.perf_counter() - start,
+            )
+
+        return result
+
+    return get_client("comprehend").detect_entities(Text=text, LanguageCode="en")
 
 
 def ExtractName(text):
-    response = comprehend.detect_entities(Text=text, LanguageCode="en")
+    response = detect_entities(text)
     entities = response["Entities"]
 
     if not entities:
@@ -45,6 +162,8 @@ class ExtractExhibition:
     def __init__(self, **config):
         self.delimeter = config.get("delimeter") or ","
         self.maxDelimeters = config.get("maxDelimeters") or 3
+        self.gazetteer = config.get("gazetteer", get_gazetteer)
+        self.cascade = config["cascade"] if "cascade" in config else get_cascade()
 
     def clean(self):
         self.year = self.year.strip()
@@ -53,8 +172,14 @@ class ExtractExhibition:
         ]
 
     def has_location(self, text):
+        # known venues and places are answered locally, loaded on first use
+        if callable(self.gazetteer):
+            self.gazetteer = self.gazetteer()
+        if self.gazetteer and self.gazetteer.has_location(text[-1]):
+            return True
+
         fooling_ml_text = "{location}".format(location=", ".join(text))
-        response = comprehend.detect_entities(Text=fooling_ml_text, LanguageCode="en")
+        response = detect_entities(fooling_ml_text)
         entities = response["Entities"]
 
         # print("Location Entities:", entities)
@@ -72,7 +197,7 @@ class ExtractExhibition:
 
     def is_other(self, text):
         fooling_ml_text = "{text}".format(text=text)
-        response = comprehend.detect_entities(Text=fooling_ml_text, LanguageCode="en")
+        response = detect_entities(fooling_ml_text)
         entities = response["Entities"]
 
         if not entities:
@@ -89,7 +214,7 @@ class ExtractExhibition:
         fooling_ml_text = "Title: {title} ({year})".format(
             year=self.year, title=text[0]
         )
-        response = comprehend.detect_entities(Text=fooling_ml_text, LanguageCode="en")
+        response = detect_entities(fooling_ml_text)
         entities = response["Entities"]
 
         # print ('Title Entities:', entities)
@@ -109,7 +234,7 @@ class ExtractExhibition:
         fooling_ml_text = "Title: {title} ({year}), {location}".format(
             year=self.year, title=text[0], location=", ".join(text[1:])
         )
-        response = comprehend.detect_entities(Text=fooling_ml_text, LanguageCode="en")
+        response = detect_entities(fooling_ml_text)
         entities = response["Entities"]
 
         if not entities:
@@ -124,6 +249,24 @@ class ExtractExhibition:
         return False
 
     def process(self, year, text):
+        # try the local classifier first
+        if self.cascade:
+            return self.cascade.process(self, year, text)
+
+        return self.detect(year, text)
+
+    def decide(self, year, text, label):
+        self.year = year
+        self.text = text
+
+        self.clean()
+
+        if label == "title":
+            return self.text[0]
+
+        return False if label == "false" else None
+
+    def detect(self, year, text):
         self.year = year
         self.text = text
 
@@ -0,0 +1,248 @@
+import contextlib
+import contextvars
+import os
+import sqlite3
+import threading
+import time
+
+from core import metrics
+from core.logs import get_logger
+
+from config import RATE_LIMIT_PATH, RATE_LIMITS
+
+logger = get_logger(__name__)
+
+# default requests per second by operation, the AWS default quotas
+DEFAULT_RATES = {
+    "DetectEntities": 20,
+    "BatchDetectEntities": 10,
+    "StartDocumentTextDetection": 1,
+    "GetDocumentTextDetection": 5,
+}
+
+THROTTLING_CODES = [
+    "LimitExceededException",
+    "ProvisionedThroughputExceededException",
+    "RequestLimitExceeded",
+    "Throttling",
+    "ThrottlingException",
+    "TooManyRequestsException",
+]
+
+# AIMD: halve the rate on throttling, add a little back on every success
+DECREASE_FACTOR = 0.5
+INCREASE_STEP = 0.05
+MIN_RATE = 0.2
+
+# seconds a waiter counts as waiting after its last poll
+HEARTBEAT = 1.0
+
+# jobs someone is waiting on go first, batch work yields to them
+INTERACTIVE = "interactive"
+BATCH = "batch"
+
+current_priority = contextvars.ContextVar("priority", default=INTERACTIVE)
+
+
+@contextlib.contextmanager
+def priority(level):
+    """Run the calls made inside the block with the given priority."""
+
+    token = current_priority.set(level)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+class RateLimiter:
+    """Token buckets per AWS operation, shared by every process on the host.
+
+    Bucket state lives in a SQLite database so threads and worker processes
+    draw from the same buckets. The rate of an operation is halved when AWS
+    throttles it and grows back additively on success, up to its quota.
+    Batch callers wait while any interactive caller is waiting.
+    """
+
+    def __init__(self, path=RATE_LIMIT_PATH, rates=None):
+        self.path = path
+        self.rates = dict(DEFAULT_RATES, **RATE_LIMITS) if rates is None else rates
+        self.local = threading.local()
+
+    def connect(self):
+        if getattr(self.local, "pid", None) != os.getpid():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+
+            db = sqlite3.connect(str(self.path), timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS buckets (operation TEXT PRIMARY KEY, "
+                "rate REAL, tokens REAL, updated REAL, throttles INTEGER DEFAULT 0)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS waiters (id TEXT PRIMARY KEY, "
+                "operation TEXT, priority TEXT, heartbeat REAL)"
+            )
+
+            self.local.db = db
+            self.local.pid = os.getpid()
+
+        return self.local.db
+
+    @contextlib.contextmanager
+    def transaction(self):
+        db = self.connect()
+        db.execute("BEGIN IMMEDIATE")
+
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+
+        db.execute("COMMIT")
+
+    def refill(self, db, operation, now):
+        row = db.execute(
+            "SELECT rate, tokens, updated FROM buckets WHERE operation = ?",
+            (operation,),
+        ).fetchone()
+
+        if row is None:
+            row = (self.rates[operation], self.rates[operation], now)
+            db.execute(
+                "INSERT INTO buckets (operation, rate, tokens, updated) "
+                "VALUES (?, ?, ?, ?)",
+                (operation,) + row,
+            )
+
+        rate, tokens, updated = row
+        tokens = min(max(rate, 1), tokens + (now - updated) * rate)
+
+        return rate, tokens
+
+    def acquire(self, operation):
+        """Wait for a token of an operation.
+
+        Returns:
+            float: Seconds waited.
+        """
+
+        if operation not in self.rates:
+            return 0
+
+        level = current_priority.get()
+        waiter = "%d-%d" % (os.getpid(), threading.get_ident())
+        start = time.monotonic()
+
+        while True:
+            with self.transaction() as db:
+                now = time.time()
+                rate, tokens = self.refill(db, operation, now)
+
+                yielding = (
+                    level != INTERACTIVE
+                    and db.execute(
+                        "SELECT COUNT(*) FROM waiters WHERE operation = ? "
+                        "AND priority = ? AND heartbeat > ?",
+                        (operation, INTERACTIVE, now - HEARTBEAT),
+                    ).fetchone()[0]
+                )
+
+                acquired = tokens >= 1 and not yielding
+                if acquired:
+                    tokens -= 1
+
+                db.execute(
+                    "UPDATE buckets SET tokens = ?, updated = ? WHERE operation = ?",
+                    (tokens, now, operation),
+                )
+
+                if acquired:
+                    db.execute("DELETE FROM waiters WHERE id = ?", (waiter,))
+                    break
+
+                db.execute(
+                    "INSERT OR REPLACE INTO waiters VALUES (?, ?, ?, ?)",
+                    (waiter, operation, level, now),
+                )
+
+            # sleep until the next token is due
+            time.sleep(min(max((1 - tokens) / rate, 0.01), HEARTBEAT / 4))
+
+        waited = time.monotonic() - start
+        metrics.observe("ratelimit.%s.wait" % operation, waited)
+
+        return waited
+
+    def throttled(self, operation):
+        if operation not in self.rates:
+            return
+
+        with self.transaction() as db:
+            rate, _ = self.refill(db, operation, time.time())
+            rate = max(MIN_RATE, rate * DECREASE_FACTOR)
+            db.execute(
+                "UPDATE buckets SET rate = ?, tokens = 0, updated = ?, "
+                "throttles = throttles + 1 WHERE operation = ?",
+                (rate, time.time(), operation),
+            )
+
+        metrics.increment("ratelimit.%s.throttles" % operation)
+        metrics.gauge("ratelimit.%s.rate" % operation, rate)
+        logger.warning("Throttled.", extra={"operation": operation, "rate": rate})
+
+    def succeeded(self, operation):
+        if operation not in self.rates:
+            return
+
+        self.connect().execute(
+            "UPDATE buckets SET rate = MIN(?, rate + ?) WHERE operation = ? "
+            "AND rate < ?",
+            (self.rates[operation], INCREASE_STEP, operation, self.rates[operation]),
+        )
+
+    def stats(self):
+        """Get the shared state of every bucket.
+
+        Returns:
+            dict: Current rate and total throttles by operation.
+        """
+
+        rows = (
+            self.connect()
+            .execute("SELECT operation, rate, throttles FROM buckets")
+            .fetchall()
+        )
+
+        return {
+            op: {"rate": rate, "throttles": throttles} for op, rate, throttles in rows
+        }
+
+    # botocore event handlers, the operation is the last part of the event name
+
+    def before_send(self, event_name, **kwargs):
+        self.acquire(event_name.rsplit(".", 1)[-1])
+
+    def needs_retry(self, event_name, response=None, **kwargs):
+        if response is None:
+            return
+
+        code = response[1].get("Error", {}).get("Code")
+        if code in THROTTLING_CODES:
+            self.throttled(event_name.rsplit(".", 1)[-1])
+
+    def after_call(self, event_name, http_response=None, **kwargs):
+        if http_response is not None and http_response.status_code < 300:
+            self.succeeded(event_name.rsplit(".", 1)[-1])
+
+    def register(self, client):
+        """Rate limit every attempt of every call made with a boto3 client."""
+
+        client.meta.events.register("before-send", self.before_send)
+        client.meta.events.register("needs-retry", self.needs_retry)
+        client.meta.events.register("after-call", self.after_call)
+
+
+# process-wide instance
+rate_limiter = RateLimiter()
@@ -1,19 +1,15 @@
 from pathlib import Path
 
-import boto3
-from botocore.errorfactory import ClientError
+from core.aws import get_client
 
-from config import AWS_ACCESS_KEY_ID, AWS_REGION_NAME, AWS_SECRET_ACCESS_KEY
-
-s3 = boto3.client(
-    "s3",
-    aws_access_key_id=AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-    region_name=AWS_REGION_NAME,
-)
+from config import AWS_REGION_NAME
 
 
 def create_bucket(bucket):
+    from botocore.exceptions import ClientError
+
+    s3 = get_client("s3")
+
     try:
         s3.create_bucket(
             Bucket=bucket,
@@ -25,18 +21,127 @@ def create_bucket(bucket):
     return True
 
 
+def ensure_bucket(bucket):
+    """Create a bucket unless it already exists. Run once at startup.
+
+    Returns:
+        bool: True if the bucket was created.
+    """
+
+    from botocore.exceptions import ClientError
+
+    s3 = get_client("s3")
+
+    try:
+        s3.head_bucket(Bucket=bucket)
+    except ClientError:
+        return create_bucket(bucket)
+
+    return False
+
+
 def upload_text(text, bucket, object_name):
+    s3 = get_client("s3")
     text_encoded = text.encode()
     response = s3.put_object(
         Body=text_encoded,
         Bucket=bucket,
         Key=object_name,
-        ACL="public-read",
         ContentType="application/json",
     )
     return response
 
 
+class WriteConflict(Exception):
+    pass
+
+
+def upload_text_if(text, bucket, object_name, etag=None):
+    """Write a text file only if it is still the version read before.
+
+    Args:
+        etag (str, optional): ETag of the version read, None to only create
+            the file.
+
+    Raises:
+        WriteConflict: The file changed, or was created, since.
+
+    Returns:
+        str: ETag of the written file.
+    """
+
+    from botocore.exceptions import ClientError
+
+    condition = {"IfMatch": '"%s"' % etag} if etag else {"IfNoneMatch": "*"}
+
+    try:
+        response = get_client("s3").put_object(
+            Body=text.encode(),
+            Bucket=bucket,
+            Key=object_name,
+            ContentType="application/json",
+            **condition,
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] in [
+            "PreconditionFailed",
+            "ConditionalRequestConflict",
+            "412",
+            "409",
+        ]:
+            raise WriteConflict(object_name)
+        raise
+
+    return response["ETag"].strip('"')
+
+
+def upload_binary(binary, bucket, object_name, content_type="application/pdf"):
+    s3 = get_client("s3")
+    response = s3.put_object(
+        Body=binary,
+        Bucket=bucket,
+        Key=object_name,
+        ContentType=content_type,
+    )
+    return response
+
+
+def start_multipart(bucket, object_name, content_type="application/pdf"):
+    s3 = get_client("s3")
+    response = s3.create_multipart_upload(
+        Bucket=bucket, Key=object_name, ContentType=content_type
+    )
+    return response["UploadId"]
+
+
+def upload_part(binary, bucket, object_name, upload_id, number):
+    s3 = get_client("s3")
+    response = s3.upload_part(
+        Body=binary,
+        Bucket=bucket,
+        Key=object_name,
+        UploadId=upload_id,
+        PartNumber=number,
+    )
+    return {"ETag": response["ETag"], "PartNumber": number}
+
+
+def complete_multipart(bucket, object_name, upload_id, parts):
+    s3 = get_client("s3")
+    response = s3.complete_multipart_upload(
+        Bucket=bucket,
+        Key=object_name,
+        UploadId=upload_id,
+        MultipartUpload={"Parts": parts},
+    )
+    return response
+
+
+def abort_multipart(bucket, object_name, upload_id):
+    s3 = get_client("s3")
+    s3.abort_multipart_upload(Bucket=bucket, Key=object_name, UploadId=upload_id)
+
+
 def upload_file(file_path, bucket, object_name=None):
     """Upload a file to an S3 bucket
 
@@ -49,6 +154,8 @@ def upload_file(file_path, bucket, object_name=None):
         bool: True if file was uploaded, else False
     """
 
+    s3 = get_client("s3")
+
     # If S3 object_name was not specified, use file_path
     if object_name is None:
         object_name = Path(file_path).name
@@ -62,13 +169,46 @@ def upload_file(file_path, bucket, object_name=None):
         file_path,
         bucket,
         object_name,
-        ExtraArgs={"ACL": "public-read", "ContentType": "application/pdf"},
+        ExtraArgs={"ContentType": "application/pdf"},
     )
 
     return True
 
 
+def download_file(bucket, object_name, file_path):
+    s3 = get_client("s3")
+    s3.download_file(bucket, object_name, str(file_path))
+    return file_path
+
+
+def download_file_etag(bucket, object_name, file_path, chunk_size=1024 * 1024):
+    """Download an object and tell which version of it was downloaded.
+
+    Returns:
+        str: ETag of the downloaded object, without quotes.
+    """
+
+    s3 = get_client("s3")
+    response = s3.get_object(Bucket=bucket, Key=object_name)
+
+    with open(file_path, "wb") as f:
+        for chunk in response["Body"].iter_chunks(chunk_size):
+            f.write(chunk)
+
+    return response["ETag"].strip('"')
+
+
+def file_etag(bucket, object_name):
+    s3 = get_client("s3")
+    response = s3.head_object(Bucket=bucket, Key=object_name)
+    return response["ETag"].strip('"')
+
+
 def exists_file(bucket, object_name):
+    from botocore.exceptions import ClientError
+
+    s3 = get_client("s3")
+
     try:
         s3.head_object(Bucket=bucket, Key=object_name)
     except ClientError:
@@ -77,17 +217,86 @@ def exists_file(bucket, object_name):
     return True
 
 
+def delete_file(bucket, object_name):
+    s3 = get_client("s3")
+    s3.delete_object(Bucket=bucket, Key=object_name)
+
+
+def presigned_url(bucket, object_name, expires=3600):
+    s3 = get_client("s3")
+    return s3.generate_presigned_url(
+        "get_object",
+        Params={"Bucket": bucket, "Key": object_name},
+        ExpiresIn=expires,
+    )
+
+
 def copy_file(source, bucket, object_name):
-    response = s3.copy_object(CopySource=source, Bucket=bucket, Key=object_name,)
+    s3 = get_client("s3")
+    response = s3.copy_object(
+        CopySource=source,
+        Bucket=bucket,
+        Key=object_name,
+    )
     return response
 
 
+def list_files(bucket, prefix=""):
+    """List all objects under a prefix, following pagination.
+
+    Args:
+        bucket (str): Bucket to list.
+        prefix (str, optional): Key prefix. Defaults to the whole bucket.
+
+    Yields:
+        dict: Object summaries with ``Key``, ``ETag``, ``Size`` and ``LastModified``.
+    """
+
+    s3 = get_client("s3")
+    paginator = s3.get_paginator("list_objects_v2")
+
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        yield from page.get("Contents", [])
+
+
 def read_file(bucket, object_name):
-    response = s3.get_object(Bucket=bucket, Key=object_name,)
+    s3 = get_client("s3")
+    response = s3.get_object(
+        Bucket=bucket,
+        Key=object_name,
+    )
     text = response["Body"].read().decode("utf-8")
     return text
 
 
+def read_file_etag(bucket, object_name):
+    """Read a text file and its ETag, both None if it does not exist."""
+
+    from botocore.exceptions import ClientError
+
+    try:
+        response = get_client("s3").get_object(Bucket=bucket, Key=object_name)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ["NoSuchKey", "404"]:
+            return None, None
+        raise
+
+    return response["Body"].read().decode("utf-8"), response["ETag"].strip('"')
+
+
+def read_file_if_exists(bucket, object_name):
+    """Read a text file, or None if it does not exist, in one round trip."""
+
+    from botocore.exceptions import ClientError
+
+    try:
+        return read_file(bucket=bucket, object_name=object_name)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ["NoSuchKey", "404"]:
+            return None
+        raise
+
+
 if __name__ == "__main__":
     # upload = upload_file(
     #     "/home/skd/Work/bot-python-cvs/.freelancer/cvs/kate/kate-1.pdf", "textract-cvs"
@@ -1,29 +1,24 @@
-import time
 from math import ceil, sqrt
 
-import boto3
+from core import cancel
+from core.aws import get_client
+from core.logs import get_logger
 
-from config import AWS_ACCESS_KEY_ID, AWS_REGION_NAME, AWS_SECRET_ACCESS_KEY
+from config import TEXTRACT_POLL_INTERVAL
 
-client = boto3.client(
-    "textract",
-    aws_access_key_id=AWS_ACCESS_KEY_ID,
-    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-    region_name=AWS_REGION_NAME,
-)
+logger = get_logger(__name__)
 
 
-def log(service, message, meta=None):
-    print({"service": service, "message": message, "meta": meta})
-
-
-def process_file(bucket, object_name):
-
-    response = client.start_document_text_detection(
+def start_job(bucket, object_name):
+    response = get_client("textract").start_document_text_detection(
         DocumentLocation={"S3Object": {"Bucket": bucket, "Name": object_name}}
     )
 
-    job_id = response["JobId"]
+    return response["JobId"]
+
+
+def get_blocks(job_id):
+    client = get_client("textract")
     job_status = "IN_PROGRESS"
 
     # wait for job to complete
@@ -32,9 +27,10 @@ def process_file(bucket, object_name):
         response = client.get_document_text_detection(JobId=job_id)
         job_status = response["JobStatus"]
 
-        log("textract", "Job status.", job_status)
+        logger.debug("Job status.", extra={"service": "textract", "meta": job_status})
 
-        time.sleep(5)
+        # a cancelled job stops waiting, the job id stays valid for a retry
+        cancel.sleep(TEXTRACT_POLL_INTERVAL)
 
     # wait for pages
     blocks = []
@@ -51,5 +47,10 @@ def process_file(bucket, object_name):
     return blocks
 
 
+def process_file(bucket, object_name):
+    job_id = start_job(bucket=bucket, object_name=object_name)
+    return get_blocks(job_id)
+
+
 if __name__ == "__main__":
     process_file(bucket="artbiogs-staging", object_name="kate-1.pdf")
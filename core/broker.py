@@ -0,0 +1,288 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+from urllib.parse import urlparse
+
+from socketio import KombuManager, PubSubManager, RedisManager
+
+from config import BROKER_PATH, MESSAGE_QUEUE
+
+# seconds between polls of the local broker
+POLL_INTERVAL = 0.05
+
+# seconds published messages are kept for slow subscribers
+RETENTION = 60
+
+# queue jobs are sent to
+JOB_QUEUE = "artbiogs-jobs"
+
+# channel every worker hears job cancellations on
+CANCEL_CHANNEL = "artbiogs-cancel"
+
+
+class Broker:
+    """Publish/subscribe channels and work queues in a SQLite database.
+
+    A stand-in for Redis or RabbitMQ when every process runs on one host,
+    e.g. in development and load tests. Subscribers poll for messages newer
+    than the last one they saw; queue messages are taken by one consumer.
+    """
+
+    def __init__(self, path=BROKER_PATH):
+        self.path = Path(path)
+        self.local = threading.local()
+
+    def connect(self):
+        if getattr(self.local, "pid", None) != os.getpid():
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+
+            db = sqlite3.connect(str(self.path), timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY "
+                "AUTOINCREMENT, channel TEXT, body TEXT, created REAL)"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS queue (id INTEGER PRIMARY KEY "
+                "AUTOINCREMENT, name TEXT, body TEXT)"
+            )
+
+            self.local.db = db
+            self.local.pid = os.getpid()
+
+        return self.local.db
+
+    def publish(self, channel, body):
+        db = self.connect()
+        cursor = db.execute(
+            "INSERT INTO messages (channel, body, created) VALUES (?, ?, ?)",
+            (channel, body, time.time()),
+        )
+
+        # prune now and then instead of on every message
+        if cursor.lastrowid % 100 == 0:
+            db.execute(
+                "DELETE FROM messages WHERE created < ?", (time.time() - RETENTION,)
+            )
+
+    def subscribe(self, channel):
+        """Yield messages published on a channel from now on."""
+
+        db = self.connect()
+        last = db.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0]
+
+        while True:
+            rows = db.execute(
+                "SELECT id, body FROM messages WHERE id > ? AND channel = ? "
+                "ORDER BY id",
+                (last, channel),
+            ).fetchall()
+
+            for last, body in rows:
+                yield body
+
+            if not rows:
+                time.sleep(POLL_INTERVAL)
+
+    def put(self, name, body):
+        self.connect().execute(
+            "INSERT INTO queue (name, body) VALUES (?, ?)", (name, body)
+        )
+
+    def get(self, name, timeout=None):
+        """Take the oldest message of a queue.
+
+        Returns:
+            str: Message body, None if the queue stayed empty for ``timeout``.
+        """
+
+        db = self.connect()
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            db.execute("BEGIN IMMEDIATE")
+            row = db.execute(
+                "SELECT id, body FROM queue WHERE name = ? ORDER BY id LIMIT 1",
+                (name,),
+            ).fetchone()
+            if row:
+                db.execute("DELETE FROM queue WHERE id = ?", (row[0],))
+            db.execute("COMMIT")
+
+            if row:
+                return row[1]
+
+            if deadline is not None and time.monotonic() > deadline:
+                return None
+
+            time.sleep(POLL_INTERVAL)
+
+
+def broker_path(url):
+    """Database path of a `sqlite:///path` url, the default for `sqlite://`."""
+
+    path = urlparse(url).path
+    return Path(path) if path else BROKER_PATH
+
+
+class RelayMixin:
+    """Keeps the job messages workers emit through the queue for replay.
+
+    Only frames emitted to the room of the job they name are kept, not the
+    ones web processes send to a single client, e.g. to catch it up.
+    """
+
+    def _handle_emit(self, message):
+        from core.events import RELAY_ROOM, relay
+
+        # emits carry their arguments as a list
+        data = message.get("data")
+        if isinstance(data, list) and len(data) == 1:
+            data = data[0]
+
+        room = message.get("room")
+        if isinstance(data, dict) and room in (RELAY_ROOM, data.get("job")):
+            relay(data.get("job"), message.get("event"), data)
+
+        super()._handle_emit(message)
+
+
+class SQLiteManager(PubSubManager):
+    """Socket.IO client manager that shares emits through the local broker."""
+
+    name = "sqlite"
+
+    def __init__(
+        self, url="sqlite://", channel="socketio", write_only=False, logger=None
+    ):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.broker = Broker(broker_path(url))
+
+    def _publish(self, data):
+        self.broker.publish(self.channel, json.dumps(data))
+
+    def _listen(self):
+        yield from self.broker.subscribe(self.channel)
+
+
+def client_manager(url=MESSAGE_QUEUE, write_only=False):
+    """Socket.IO client manager for a message queue url.
+
+    Write only managers let job workers emit to clients connected to any web
+    process. The others keep the job messages they relay from workers, so a
+    client reconnecting to any web process can be caught up.
+
+    Returns:
+        PubSubManager: The manager, None without a message queue.
+    """
+
+    if not url:
+        return None
+
+    if url.startswith("sqlite:"):
+        manager = SQLiteManager
+    elif url.startswith("redis:"):
+        manager = RedisManager
+    else:
+        manager = KombuManager
+
+    # web processes keep what they relay, for clients that reconnect
+    if not write_only:
+        manager = type("Relay" + manager.__name__, (RelayMixin, manager), {})
+
+    return manager(url, write_only=write_only)
+
+
+class LocalQueue:
+    def __init__(self, url, name=JOB_QUEUE):
+        self.broker = Broker(broker_path(url))
+        self.name = name
+
+    def put(self, job):
+        self.broker.put(self.name, json.dumps(job))
+
+    def get(self, timeout=None):
+        body = self.broker.get(self.name, timeout=timeout)
+        return json.loads(body) if body is not None else None
+
+    def cancel(self, job_id):
+        self.broker.publish(CANCEL_CHANNEL, job_id)
+
+    def cancelled(self):
+        """Yield the ids of jobs cancelled from now on."""
+
+        yield from self.broker.subscribe(CANCEL_CHANNEL)
+
+
+class KombuQueue:
+    def __init__(self, url, name=JOB_QUEUE):
+        from kombu import Connection
+
+        self.url = url
+        self.queue = Connection(url).SimpleQueue(name)
+
+        # kombu connections aren't thread safe, while web processes submit
+        # from socket handlers and api threads at once
+        self.lock = threading.Lock()
+
+    def put(self, job):
+        with self.lock:
+            self.queue.put(job, serializer="json")
+
+    def get(self, timeout=None):
+        with self.lock:
+            try:
+                message = self.queue.get(block=True, timeout=timeout)
+            except self.queue.Empty:
+                return None
+
+            message.ack()
+
+        return message.payload
+
+    def cancel(self, job_id):
+        from kombu import Connection, Exchange
+
+        exchange = Exchange(CANCEL_CHANNEL, type="fanout")
+
+        with Connection(self.url) as connection:
+            connection.Producer().publish(
+                job_id, exchange=exchange, declare=[exchange], serializer="json"
+            )
+
+    def cancelled(self):
+        """Yield the ids of jobs cancelled from now on."""
+
+        from kombu import Connection, Exchange, Queue
+
+        # every worker binds its own queue to the fanout exchange
+        queue = Queue(
+            "%s-%s" % (CANCEL_CHANNEL, uuid.uuid4().hex),
+            Exchange(CANCEL_CHANNEL, type="fanout"),
+            exclusive=True,
+            auto_delete=True,
+        )
+
+        with Connection(self.url) as connection:
+            with connection.SimpleQueue(queue) as cancellations:
+                while True:
+                    message = cancellations.get(block=True)
+                    message.ack()
+                    yield message.payload
+
+
+def job_queue(url=MESSAGE_QUEUE):
+    """Queue web processes submit jobs to and job workers take them from.
+
+    Returns:
+        LocalQueue: Or a KombuQueue for redis:// and amqp:// urls.
+    """
+
+    if url.startswith("sqlite:"):
+        return LocalQueue(url)
+
+    return KombuQueue(url)
@@ -0,0 +1,100 @@
+import contextlib
+import contextvars
+import threading
+import time
+
+from core.logs import get_logger
+
+logger = get_logger(__name__)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class CancelToken:
+    """Cancellation flag of one job, checked cooperatively.
+
+    Code running for the job raises :class:`JobCancelled` at its checkpoints
+    once the token is cancelled. Blocking work that cannot check, such as a
+    subprocess, registers a callback that interrupts it.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+    def cancel(self):
+        with self.lock:
+            self.event.set()
+            callbacks = list(self.callbacks)
+
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                logger.exception("Cancel callback failed.")
+
+    def check(self):
+        if self.event.is_set():
+            raise JobCancelled()
+
+    def sleep(self, seconds):
+        if self.event.wait(seconds):
+            raise JobCancelled()
+
+    @contextlib.contextmanager
+    def on_cancel(self, callback):
+        with self.lock:
+            self.callbacks.append(callback)
+            cancelled = self.event.is_set()
+
+        if cancelled:
+            callback()
+
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.callbacks.remove(callback)
+
+
+# token of the job running in the current context
+current_token = contextvars.ContextVar("cancel_token", default=None)
+
+
+def checkpoint():
+    """Stop the current job here if it was cancelled."""
+
+    token = current_token.get()
+    if token is not None:
+        token.check()
+
+
+def sleep(seconds):
+    """Sleep, waking up early to stop the current job if it is cancelled."""
+
+    token = current_token.get()
+    if token is not None:
+        token.sleep(seconds)
+    else:
+        time.sleep(seconds)
+
+
+@contextlib.contextmanager
+def on_cancel(callback):
+    """Call ``callback`` if the current job is cancelled inside the block."""
+
+    token = current_token.get()
+
+    if token is None:
+        yield
+        return
+
+    with token.on_cancel(callback):
+        yield
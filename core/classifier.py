@@ -0,0 +1,339 @@
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+import zlib
+from collections import defaultdict
+
+from core import metrics
+from core.aws.s3 import list_files, read_file
+from core.gazetteer import PARSED_JSON_KEY
+from core.logs import get_logger
+
+from config import (
+    AWS_BUCKET_NAME,
+    CLASSIFIER_AUDIT_RATE,
+    CLASSIFIER_ENABLED,
+    CLASSIFIER_MODEL_PATH,
+    CLASSIFIER_OUTCOMES_PATH,
+    CLASSIFIER_THRESHOLD,
+)
+
+logger = get_logger(__name__)
+
+# outcomes of ExtractExhibition.process: a title, None or False
+LABELS = ["title", "none", "false"]
+
+# size of the hashed feature space
+FEATURES = 2**18
+
+
+def label_of(outcome):
+    if outcome is None:
+        return "none"
+    if outcome is False:
+        return "false"
+    return "title"
+
+
+def features(text):
+    """Hash a line into sparse feature indexes.
+
+    Uses word unigrams and bigrams, character trigrams and a few shape
+    features (fragment count, trailing punctuation). crc32 is used instead of
+    ``hash`` so indexes are stable across processes.
+    """
+
+    text = text.strip()
+    lowered = text.lower()
+    words = re.findall(r"[^\W_]+", lowered)
+
+    names = ["w:" + w for w in words]
+    names += ["b:%s %s" % pair for pair in zip(words, words[1:])]
+    names += ["c:" + lowered[i : i + 3] for i in range(len(lowered) - 2)]
+    names += [
+        "fragments:%d" % min(text.count(","), 4),
+        "words:%d" % min(len(words), 8),
+        "end:%s" % (text[-1:] if text[-1:] in ",.;:" else "-"),
+        "upper:%s" % (text[:1].isupper()),
+    ]
+
+    return {zlib.crc32(name.encode()) % FEATURES for name in names}
+
+
+class Model:
+    """Multinomial logistic regression over hashed features."""
+
+    def __init__(self, weights=None, bias=None, version=None):
+        self.weights = weights or {label: defaultdict(float) for label in LABELS}
+        self.bias = bias or {label: 0.0 for label in LABELS}
+        self.version = version
+
+    def probabilities(self, indexes):
+        scores = {
+            label: self.bias[label]
+            + sum(self.weights[label].get(i, 0.0) for i in indexes)
+            for label in LABELS
+        }
+        top = max(scores.values())
+        exps = {label: math.exp(score - top) for label, score in scores.items()}
+        total = sum(exps.values())
+        return {label: value / total for label, value in exps.items()}
+
+    def predict(self, text):
+        """Predict the outcome of a line.
+
+        Returns:
+            tuple: Predicted label and its probability.
+        """
+
+        probabilities = self.probabilities(features(text))
+        label = max(probabilities, key=probabilities.get)
+        return label, probabilities[label]
+
+    def fit(self, examples, epochs=8, rate=0.2, l2=1e-6):
+        """Train with stochastic gradient descent.
+
+        Args:
+            examples (list): ``(text, label)`` tuples.
+        """
+
+        examples = [(features(text), label) for text, label in examples]
+
+        for epoch in range(epochs):
+            random.shuffle(examples)
+            step = rate / (1 + epoch)
+
+            for indexes, label in examples:
+                probabilities = self.probabilities(indexes)
+
+                for target in LABELS:
+                    gradient = probabilities[target] - (target == label)
+                    self.bias[target] -= step * gradient
+                    weights = self.weights[target]
+                    for i in indexes:
+                        weights[i] -= step * (gradient + l2 * weights[i])
+
+        self.version = time.strftime("%Y%m%d%H%M%S")
+
+    def save(self, path=CLASSIFIER_MODEL_PATH):
+        data = {
+            "version": self.version,
+            "bias": self.bias,
+            "weights": {
+                label: {
+                    str(i): round(w, 5) for i, w in weights.items() if abs(w) > 1e-4
+                }
+                for label, weights in self.weights.items()
+            },
+        }
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(data))
+        tmp_path.replace(path)
+
+    @classmethod
+    def load(cls, path=CLASSIFIER_MODEL_PATH):
+        data = json.loads(path.read_text())
+        weights = {
+            label: {int(i): w for i, w in weights.items()}
+            for label, weights in data["weights"].items()
+        }
+        return cls(weights=weights, bias=data["bias"], version=data["version"])
+
+
+class Cascade:
+    """Decide lines locally and escalate uncertain ones to Comprehend.
+
+    Every escalated decision is appended to the outcomes file so the next
+    training run learns from it. A random ``audit_rate`` of the confident
+    lines is also sent to Comprehend to measure how often both agree.
+    """
+
+    def __init__(
+        self,
+        model,
+        threshold=CLASSIFIER_THRESHOLD,
+        audit_rate=CLASSIFIER_AUDIT_RATE,
+        outcomes_path=CLASSIFIER_OUTCOMES_PATH,
+    ):
+        self.model = model
+        self.threshold = threshold
+        self.audit_rate = audit_rate
+        self.outcomes_path = outcomes_path
+        self.lock = threading.Lock()
+
+    def process(self, extractor, year, text):
+        label, probability = self.model.predict(text)
+        metrics.increment("cascade.lines")
+
+        # confident, answer locally
+        if probability >= self.threshold and random.random() >= self.audit_rate:
+            metrics.increment("cascade.local")
+            metrics.increment("cascade.latency_saved", metrics.mean("cascade.remote"))
+            return extractor.decide(year, text, label)
+
+        start = time.perf_counter()
+        outcome = extractor.detect(year, text)
+        metrics.observe("cascade.remote", time.perf_counter() - start)
+
+        if probability >= self.threshold:
+            metrics.increment("cascade.audited")
+            if label == label_of(outcome):
+                metrics.increment("cascade.agreed")
+        else:
+            metrics.increment("cascade.escalated")
+
+        self.record(year, text, outcome)
+
+        return outcome
+
+    def record(self, year, text, outcome):
+        line = json.dumps({"year": year, "text": text, "label": label_of(outcome)})
+
+        with self.lock:
+            self.outcomes_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.outcomes_path, "a") as f:
+                f.write(line + "\n")
+
+
+def cascade_report():
+    """Summarize cascade metrics of this process.
+
+    Returns:
+        dict: Escalation rate, agreement rate and seconds of Comprehend saved.
+    """
+
+    counters = metrics.snapshot()["counters"]
+    lines = counters.get("cascade.lines", 0)
+    audited = counters.get("cascade.audited", 0)
+
+    return {
+        "lines": int(lines),
+        "escalation_rate": (
+            counters.get("cascade.escalated", 0) / lines if lines else None
+        ),
+        "agreement_rate": (
+            counters.get("cascade.agreed", 0) / audited if audited else None
+        ),
+        "latency_saved": counters.get("cascade.latency_saved", 0),
+    }
+
+
+# process-wide instance, and the modification time of the model it holds
+cascade = None
+cascade_mtime = None
+cascade_lock = threading.Lock()
+
+
+def get_cascade():
+    """Get the shared cascade, with the model last trained.
+
+    A model trained while the process runs is loaded the next time the
+    cascade is asked for, so results record the version that decided them.
+
+    Returns:
+        Cascade: The shared instance, or None if disabled or not trained yet.
+    """
+
+    global cascade, cascade_mtime
+
+    if not CLASSIFIER_ENABLED:
+        return None
+
+    try:
+        mtime = CLASSIFIER_MODEL_PATH.stat().st_mtime_ns
+    except OSError:
+        return None
+
+    with cascade_lock:
+        if mtime == cascade_mtime:
+            return cascade
+
+        cascade_mtime = mtime
+
+        try:
+            model = Model.load()
+        except (OSError, ValueError, KeyError):
+            # keep deciding with the model already loaded
+            logger.exception("Classifier could not be loaded.")
+            return cascade
+
+        if cascade is None:
+            cascade = Cascade(model)
+        elif model.version != cascade.model.version:
+            cascade.model = model
+        else:
+            return cascade
+
+        logger.info("Classifier loaded.", extra={"version": model.version})
+
+    return cascade
+
+
+def collect_examples(bucket=AWS_BUCKET_NAME):
+    """Gather labelled lines from recorded outcomes and archived results.
+
+    Results parsed with the classifier active (``meta.classifier``) are skipped
+    so the model never learns from its own guesses.
+    """
+
+    examples = []
+
+    if CLASSIFIER_OUTCOMES_PATH.is_file():
+        with open(CLASSIFIER_OUTCOMES_PATH) as f:
+            for line in f:
+                outcome = json.loads(line)
+                examples.append((outcome["text"], outcome["label"]))
+
+    for obj in list_files(bucket=bucket, prefix="cvs/"):
+        if not PARSED_JSON_KEY.match(obj["Key"]):
+            continue
+
+        result = json.loads(read_file(bucket=bucket, object_name=obj["Key"]))
+
+        if result.get("meta", {}).get("classifier"):
+            continue
+
+        for slug in ["solo_exhibitions", "group_exhibitions"]:
+            for exhibition in result.get(slug, []):
+                examples.append((exhibition["original"], label_of(exhibition["title"])))
+
+    return examples
+
+
+def train(threshold=CLASSIFIER_THRESHOLD, holdout=0.1):
+    examples = collect_examples()
+    random.shuffle(examples)
+
+    split = int(len(examples) * holdout)
+    test, train_examples = examples[:split], examples[split:]
+
+    model = Model()
+    model.fit(train_examples)
+
+    # evaluate coverage and accuracy at the threshold
+    confident = correct = 0
+    for text, label in test:
+        predicted, probability = model.predict(text)
+        if probability >= threshold:
+            confident += 1
+            correct += predicted == label
+
+    model.save()
+
+    print("Examples:", len(examples))
+    print("Answered locally:", confident / len(test) if test else None)
+    print("Accuracy when local:", correct / confident if confident else None)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train the exhibition classifier.")
+    parser.add_argument("--threshold", type=float, default=CLASSIFIER_THRESHOLD)
+    args = parser.parse_args()
+
+    train(threshold=args.threshold)
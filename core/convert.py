@@ -1,12 +1,13 @@
 import base64
 import json
 import os
+import subprocess
 import sys
 
-import pdfkit
-from selenium import webdriver
-from selenium.webdriver.chrome.options import Options
-from webdriver_manager.chrome import ChromeDriverManager
+from core import cancel
+
+# selenium, webdriver_manager and pdfkit are imported where they are used so
+# importing this module (and the web app) stays fast
 
 
 # Devtools handler
@@ -24,6 +25,10 @@ def send_devtools(driver, cmd, params={}):
 
 # Convert webpage to pdf
 def web2pdf(url, path):
+    from selenium import webdriver
+    from selenium.webdriver.chrome.options import Options
+    from webdriver_manager.chrome import ChromeDriverManager
+
     webdriver_options = Options()
     webdriver_options.add_argument("--headless")
     webdriver_options.add_argument("--disable-gpu")
@@ -31,9 +36,6 @@ def web2pdf(url, path):
         ChromeDriverManager().install(), options=webdriver_options
     )
 
-    # load url
-    browser.get(url)
-
     # ! BUG: Setting print options is not working!
     print_options = {
         # "landscape": False,
@@ -42,8 +44,22 @@ def web2pdf(url, path):
         # "preferCSSPageSize": True,
     }
 
-    result = send_devtools(browser, "Page.printToPDF", print_options)
-    browser.quit()
+    # closing chrome interrupts the page load of a cancelled job
+    try:
+        with cancel.on_cancel(browser.quit):
+            # load url
+            browser.get(url)
+
+            result = send_devtools(browser, "Page.printToPDF", print_options)
+    except Exception:
+        cancel.checkpoint()
+        raise
+    finally:
+        # chrome is closed however the page load ends, a cancel closed it already
+        try:
+            browser.quit()
+        except Exception:
+            pass
 
     # save file
     with open(path, "wb") as f:
@@ -54,6 +70,8 @@ def web2pdf(url, path):
 
 # Convert html to pdf
 def html2pdf(html, path):
+    import pdfkit
+
     WKHTMLTOPDF_PATH = os.environ.get("WKHTMLTOPDF_PATH")
 
     # decide wkhtmltopdf path
@@ -62,7 +80,24 @@ def html2pdf(html, path):
     else:
         configuration = pdfkit.configuration()
 
-    pdfkit.from_string(html, path, configuration=configuration)
+    kit = pdfkit.PDFKit(html, "string", configuration=configuration)
+    process = subprocess.Popen(
+        kit.command(str(path)),
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=kit.environ,
+    )
+
+    # kill wkhtmltopdf when the job is cancelled
+    with cancel.on_cancel(process.kill):
+        stdout, stderr = process.communicate(input=html.encode("utf-8"))
+
+    cancel.checkpoint()
+    kit.handle_error(
+        process.returncode, (stderr or stdout or b"").decode("utf-8", errors="replace")
+    )
+
     return path
 
 
@@ -0,0 +1,390 @@
+import argparse
+import csv
+import hashlib
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from email.message import Message
+from pathlib import Path
+from urllib.parse import urlparse
+
+from core.logs import get_logger
+
+from config import (
+    CRAWL_HOST_CONCURRENCY,
+    CRAWL_HOST_DELAY,
+    CRAWL_STATE_PATH,
+    CRAWL_TIMEOUT,
+    CRAWL_USER_AGENT,
+    CRAWL_WORKERS,
+    PROJECT_ROOT,
+)
+
+logger = get_logger(__name__)
+
+SOURCES_PATH = PROJECT_ROOT / ".freelancer" / "artists.csv"
+
+# sources are html line breaks between urls and notes
+SOURCE_SEPARATOR = re.compile(r"<br\s*/?>|\n")
+
+# markup that changes without the cv changing
+IGNORED_MARKUP = re.compile(
+    r"<(script|style|noscript)\b.*?</\1\s*>|<!--.*?-->", re.IGNORECASE | re.DOTALL
+)
+TAG = re.compile(r"<[^>]+>")
+WHITESPACE = re.compile(r"\s+")
+
+# seconds a host is left alone after asking to slow down without saying how long
+DEFAULT_RETRY_AFTER = 60
+
+
+def read_sources(path=SOURCES_PATH):
+    """Read the source urls of the artists CSV.
+
+    Sources hold one or more urls separated by ``<br />``, some without a
+    scheme, mixed with notes such as "CV sent from the gallery." which are
+    skipped.
+
+    Returns:
+        list: One dict per url with the ``url`` and the ``artists`` listing it.
+    """
+
+    sources = {}
+
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        for row in csv.DictReader(f):
+            for url in SOURCE_SEPARATOR.split(row.get("source") or ""):
+                url = url.strip()
+
+                if url.startswith("www."):
+                    url = "http://" + url
+                if not re.match(r"https?://[^/\s]+", url):
+                    continue
+
+                source = sources.setdefault(url, {"url": url, "artists": []})
+                source["artists"].append(row["artist_id"])
+
+    return list(sources.values())
+
+
+def is_pdf(content_type, body):
+    return content_type == "application/pdf" or body.startswith(b"%PDF")
+
+
+def content_hash(body, content_type):
+    """Hash the content of a page, ignoring markup, scripts and whitespace.
+
+    PDFs are hashed as they are.
+    """
+
+    message = Message()
+    message["Content-Type"] = content_type or ""
+
+    if not is_pdf(message.get_content_type(), body):
+        text = body.decode(message.get_param("charset") or "utf-8", errors="replace")
+        text = TAG.sub(" ", IGNORED_MARKUP.sub(" ", text))
+        body = WHITESPACE.sub(" ", text).strip().encode("utf-8")
+
+    return hashlib.md5(body).hexdigest()
+
+
+class HostLimiter:
+    """Politeness limits per host.
+
+    At most ``concurrency`` requests run against a host at a time, and their
+    starts are at least ``delay`` seconds apart. A host that answers 429 or 503
+    is left alone for as long as it asks.
+    """
+
+    def __init__(self, concurrency=CRAWL_HOST_CONCURRENCY, delay=CRAWL_HOST_DELAY):
+        self.concurrency = concurrency
+        self.delay = delay
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def host(self, name):
+        with self.lock:
+            if name not in self.hosts:
+                self.hosts[name] = {
+                    "semaphore": threading.Semaphore(self.concurrency),
+                    "next": 0,
+                }
+            return self.hosts[name]
+
+    @contextmanager
+    def slot(self, name):
+        host = self.host(name)
+
+        with host["semaphore"]:
+            with self.lock:
+                now = time.monotonic()
+                start = max(now, host["next"])
+                host["next"] = start + self.delay
+
+            time.sleep(start - now)
+            yield
+
+    def back_off(self, name, seconds):
+        host = self.host(name)
+
+        with self.lock:
+            host["next"] = max(host["next"], time.monotonic() + seconds)
+
+
+class CrawlState:
+    """Validators and content hashes of crawled sources in a SQLite database."""
+
+    COLUMNS = ["url", "etag", "last_modified", "content_hash", "file_hash", "fetched"]
+
+    def __init__(self, path=CRAWL_STATE_PATH):
+        self.path = Path(path)
+        self.local = threading.local()
+
+    def connect(self):
+        if getattr(self.local, "db", None) is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+
+            db = sqlite3.connect(str(self.path), timeout=30, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS sources (url TEXT PRIMARY KEY, "
+                "etag TEXT, last_modified TEXT, content_hash TEXT, file_hash TEXT, "
+                "fetched REAL)"
+            )
+
+            self.local.db = db
+
+        return self.local.db
+
+    def get(self, url):
+        row = (
+            self.connect()
+            .execute(
+                "SELECT %s FROM sources WHERE url = ?" % ", ".join(self.COLUMNS),
+                (url,),
+            )
+            .fetchone()
+        )
+
+        return dict(zip(self.COLUMNS, row)) if row else None
+
+    def save(self, url, **fields):
+        record = dict(self.get(url) or {}, **fields, url=url, fetched=time.time())
+
+        self.connect().execute(
+            "INSERT OR REPLACE INTO sources (%s) VALUES (%s)"
+            % (", ".join(self.COLUMNS), ", ".join("?" * len(self.COLUMNS))),
+            [record.get(column) for column in self.COLUMNS],
+        )
+
+
+def fetch(url, known=None, timeout=CRAWL_TIMEOUT):
+    """Get a url, conditionally when its validators are ``known``.
+
+    Returns:
+        dict: ``status``, ``body``, ``content_type``, ``etag``,
+            ``last_modified`` and ``retry_after`` of the response.
+    """
+
+    request = urllib.request.Request(url, headers={"User-Agent": CRAWL_USER_AGENT})
+
+    if known and known.get("etag"):
+        request.add_header("If-None-Match", known["etag"])
+    if known and known.get("last_modified"):
+        request.add_header("If-Modified-Since", known["last_modified"])
+
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            status, headers, body = response.status, response.headers, response.read()
+    except urllib.error.HTTPError as e:
+        status, headers, body = e.code, e.headers, b""
+
+    retry_after = headers.get("Retry-After")
+
+    return {
+        "status": status,
+        "body": body,
+        "content_type": headers.get("Content-Type"),
+        "etag": headers.get("ETag"),
+        "last_modified": headers.get("Last-Modified"),
+        "retry_after": (
+            int(retry_after) if retry_after and retry_after.isdigit() else None
+        ),
+    }
+
+
+def render_source(url, response, path):
+    """Write the PDF of a fetched source, rendering web pages in Chrome."""
+
+    from core.convert import web2pdf
+
+    if is_pdf(response["content_type"], response["body"]):
+        Path(path).write_bytes(response["body"])
+    else:
+        web2pdf(url, str(path))
+
+    return path
+
+
+def process_source(source, path):
+    """Parse the rendered CV of a source.
+
+    Returns:
+        str: MD5 of the parsed file.
+    """
+
+    from core.process import Parser
+
+    result = Parser(meta={"source": source["url"]}).process_cv(str(path))
+
+    return result["meta"]["hash"]
+
+
+def crawl_source(
+    source,
+    state,
+    limiter,
+    render=render_source,
+    process=process_source,
+    dry_run=False,
+):
+    """Fetch one source and parse it if it changed since the last crawl.
+
+    Returns:
+        str: ``unchanged``, ``changed``, ``new`` or ``failed``.
+    """
+
+    url = source["url"]
+    host = urlparse(url).netloc.lower()
+    known = state.get(url)
+
+    with tempfile.TemporaryDirectory() as folder:
+        # the host slot is held while chrome loads the page from the same host
+        with limiter.slot(host):
+            response = fetch(url, known)
+
+            if response["status"] in (429, 503):
+                limiter.back_off(host, response["retry_after"] or DEFAULT_RETRY_AFTER)
+
+            if response["status"] == 304:
+                if not dry_run:
+                    state.save(url)
+                return "unchanged"
+
+            if response["status"] != 200:
+                logger.warning(
+                    "Source fetch failed.",
+                    extra={"url": url, "status": response["status"]},
+                )
+                return "failed"
+
+            digest = content_hash(response["body"], response["content_type"])
+            validators = {
+                "etag": response["etag"],
+                "last_modified": response["last_modified"],
+            }
+
+            # served without validators, or only the markup changed
+            if known and known["file_hash"] and known["content_hash"] == digest:
+                if not dry_run:
+                    state.save(url, **validators)
+                return "unchanged"
+
+            outcome = "changed" if known else "new"
+            if dry_run:
+                return outcome
+
+            path = render(url, response, Path(folder) / "cv.pdf")
+
+        file_hash = process(source, path)
+
+    # saved last, so a source that failed to parse is retried next time
+    state.save(url, content_hash=digest, file_hash=file_hash, **validators)
+    logger.info("Source parsed.", extra={"url": url, "hash": file_hash})
+
+    return outcome
+
+
+def crawl(
+    sources, state=None, limiter=None, workers=CRAWL_WORKERS, dry_run=False, **handlers
+):
+    """Crawl sources concurrently, within the politeness limits of each host.
+
+    Every source is fetched with the ETag and Last-Modified of the last fetch,
+    and the text of changed pages is hashed, so a page that was not modified,
+    or only changed its markup, is neither rendered to PDF nor sent to
+    Textract again. Requests to the same host are spaced out and limited in
+    number.
+
+    Args:
+        sources (list): Sources from :func:`read_sources`.
+        workers (int, optional): Sources crawled at the same time.
+        dry_run (bool, optional): Only report which sources changed.
+        handlers: ``render`` and ``process`` replacements, see
+            :func:`crawl_source`.
+
+    Returns:
+        dict: Urls by outcome.
+    """
+
+    state = state or CrawlState()
+    limiter = limiter or HostLimiter()
+    outcomes = {"new": [], "changed": [], "unchanged": [], "failed": []}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                crawl_source, source, state, limiter, dry_run=dry_run, **handlers
+            ): source["url"]
+            for source in sources
+        }
+
+        for future in as_completed(futures):
+            url = futures[future]
+
+            try:
+                outcome = future.result()
+            except Exception:
+                logger.exception("Source crawl failed.", extra={"url": url})
+                outcome = "failed"
+
+            outcomes[outcome].append(url)
+
+    logger.info(
+        "Crawl finished.",
+        extra={name: len(urls) for name, urls in outcomes.items()},
+    )
+
+    return outcomes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Crawl the web CVs of artist sources and parse the changed ones."
+    )
+    parser.add_argument("--sources", default=str(SOURCES_PATH))
+    parser.add_argument("--url", action="append", help="Crawl only this url.")
+    parser.add_argument("--workers", type=int, default=CRAWL_WORKERS)
+    parser.add_argument("--host-concurrency", type=int, default=CRAWL_HOST_CONCURRENCY)
+    parser.add_argument("--host-delay", type=float, default=CRAWL_HOST_DELAY)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    sources = read_sources(args.sources)
+    if args.url:
+        sources = [{"url": url, "artists": []} for url in args.url]
+
+    outcomes = crawl(
+        sources,
+        limiter=HostLimiter(args.host_concurrency, args.host_delay),
+        workers=args.workers,
+        dry_run=args.dry_run,
+    )
+
+    print(", ".join("%s: %d" % (name, len(urls)) for name, urls in outcomes.items()))
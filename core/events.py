@@ -0,0 +1,192 @@
+import threading
+import time
+from collections import OrderedDict, deque
+
+from config import EVENT_FLUSH_INTERVAL, EVENT_REPLAY_JOBS, EVENT_REPLAY_SIZE
+
+# high frequency codes sent together in batched frames
+COALESCED_CODES = ["welp", "artist:exhibition"]
+
+# events of jobs run by workers that web processes keep
+RELAYED_EVENTS = ["job:message", "job:batch", "job:done"]
+
+# room web processes tell each other about jobs on, which no client joins
+RELAY_ROOM = "artbiogs-relay"
+
+# events on the relay room, with the ``job`` they are about
+PRESENCE_EVENTS = ["job:submitted", "job:watch", "job:unwatch"]
+
+# replay buffers by job id, oldest job first
+jobs = OrderedDict()
+jobs_lock = threading.Lock()
+
+
+class JobBuffer:
+    """Bounded history of the messages published for one job."""
+
+    def __init__(self, size=EVENT_REPLAY_SIZE):
+        self.messages = deque(maxlen=size)
+        self.seq = 0
+        self.done = None
+
+        # queue id of a job run by a worker, and clients waiting on it in
+        # every web process
+        self.task_id = None
+        self.watchers = set()
+
+
+def get_buffer(job_id, create=False):
+    with jobs_lock:
+        buffer = jobs.get(job_id)
+
+        if buffer is None and create:
+            buffer = jobs[job_id] = JobBuffer()
+
+            # forget the oldest jobs
+            while len(jobs) > EVENT_REPLAY_JOBS:
+                jobs.popitem(last=False)
+
+        return buffer
+
+
+def discard(job_id):
+    with jobs_lock:
+        jobs.pop(job_id, None)
+
+
+def replay(job_id, since=0):
+    """Get the buffered messages of a job a client has not seen yet.
+
+    Args:
+        job_id (str): Job identifier.
+        since (int, optional): Last sequence number the client received.
+
+    Returns:
+        tuple: Missed messages and the ``job:done`` payload (None if running).
+    """
+
+    buffer = get_buffer(job_id)
+
+    if buffer is None:
+        return [], None
+
+    with jobs_lock:
+        messages = [m for m in buffer.messages if m["seq"] > since]
+
+    return messages, buffer.done
+
+
+def relay(job_id, event, data):
+    """Keep a message a worker emitted for a job, as the web process relays it.
+
+    Workers keep their replay buffers in their own process, so web processes
+    keep one of every job they relay for their clients that reconnect. A
+    failed job is kept with its failure, a new start submits it again.
+
+    Web processes also tell each other, on ``RELAY_ROOM``, which jobs they
+    queued (``job:submitted``) and which clients wait on them (``job:watch``
+    and ``job:unwatch``), so a job is queued once and only cancelled once no
+    client of any web process waits on it.
+    """
+
+    if job_id is None or event not in RELAYED_EVENTS + PRESENCE_EVENTS:
+        return
+
+    buffer = get_buffer(job_id, create=True)
+
+    with jobs_lock:
+        if event == "job:submitted":
+            buffer.messages.clear()
+            buffer.seq = 0
+            buffer.done = None
+            buffer.task_id = data.get("id")
+        elif event == "job:watch":
+            buffer.watchers.add(data["sid"])
+        elif event == "job:unwatch":
+            buffer.watchers.discard(data["sid"])
+        elif event == "job:done":
+            buffer.done = data
+        else:
+            messages = data["messages"] if event == "job:batch" else [data]
+
+            for message in messages:
+                buffer.messages.append(message)
+                buffer.seq = max(buffer.seq, message.get("seq", 0))
+
+
+class EventChannel:
+    """Publish job messages to a socket, coalescing high frequency ones.
+
+    Messages with a code in ``coalesce`` are held and sent as a single
+    ``job:batch`` frame at most every ``interval`` seconds; a timer armed by
+    the first held message sends them when nothing else is published, e.g.
+    while Textract runs. Any other message first flushes the held ones so the
+    client sees them in order. Every message gets a sequence number and is
+    kept in the job's replay buffer.
+    """
+
+    def __init__(self, emit, job_id, interval=None, coalesce=None):
+        self.emit = emit
+        self.job_id = job_id
+        self.interval = EVENT_FLUSH_INTERVAL if interval is None else interval
+        self.coalesce = COALESCED_CODES if coalesce is None else coalesce
+
+        self.buffer = get_buffer(job_id, create=True)
+        self.pending = []
+        self.flushed_at = time.monotonic()
+
+        # sends held messages nobody else flushes, and keeps frames in order
+        self.timer = None
+        self.lock = threading.RLock()
+
+    def publish(self, message):
+        with jobs_lock:
+            self.buffer.seq += 1
+            message = dict(message, seq=self.buffer.seq)
+            self.buffer.messages.append(message)
+
+        with self.lock:
+            # batch high frequency messages
+            if message["code"] in self.coalesce:
+                self.pending.append(message)
+
+                wait = self.interval - (time.monotonic() - self.flushed_at)
+                if wait <= 0:
+                    self.flush()
+                elif self.timer is None:
+                    self.timer = threading.Timer(wait, self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+
+                return
+
+            self.flush()
+            self.emit("job:message", dict(message, job=self.job_id))
+
+    def flush(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+            self.flushed_at = time.monotonic()
+
+            if not self.pending:
+                return
+
+            self.emit("job:batch", {"job": self.job_id, "messages": self.pending})
+            self.pending = []
+
+    def close(self, status, failed=False):
+        self.flush()
+
+        done = {"job": self.job_id, "status": status}
+        if failed:
+            done["failed"] = True
+        self.emit("job:done", done)
+
+        # failed jobs are not replayed so a retry runs them again
+        if failed:
+            discard(self.job_id)
+        else:
+            self.buffer.done = done
@@ -0,0 +1,307 @@
+import argparse
+import csv
+import gzip
+import json
+import re
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from core.aws.s3 import list_files, read_file
+from core.logs import get_logger
+
+from config import AWS_BUCKET_NAME
+
+logger = get_logger(__name__)
+
+# parsed results in the archive, `cvs/{hash}/parsed.json` or `cvs/{hash} ({name})/…`
+PARSED_JSON_KEY = re.compile(r"^cvs/([0-9a-f]{32})[^/]*/parsed\.json$")
+
+# folder names start with the file md5
+PREFIXES = ["cvs/%x" % i for i in range(16)]
+
+SECTIONS = ["solo_exhibitions", "group_exhibitions"]
+
+COLUMNS = ["hash", "name", "dob", "year", "title", "original", "type"]
+
+# hashes in the dataset, next to the partitions
+STATE_FILE = "_export.json"
+
+# partition of exhibitions without a year, as hive names it
+NO_YEAR = "__HIVE_DEFAULT_PARTITION__"
+
+# rows of a partition written together as one row group
+ROW_GROUP_ROWS = 10000
+
+# rows held in memory across partitions before all of them are written
+MAX_BUFFERED_ROWS = 100000
+
+
+def list_results(bucket=AWS_BUCKET_NAME, workers=16):
+    """List parsed results, one paginated listing per prefix in parallel.
+
+    A hash stored under more than one folder counts once, by its newest copy.
+
+    Returns:
+        dict: Object summaries by hash.
+    """
+
+    def list_prefix(prefix):
+        return [
+            obj
+            for obj in list_files(bucket=bucket, prefix=prefix)
+            if PARSED_JSON_KEY.match(obj["Key"])
+        ]
+
+    results = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for listed in executor.map(list_prefix, PREFIXES):
+            for obj in listed:
+                file_hash = PARSED_JSON_KEY.match(obj["Key"]).group(1)
+                known = results.get(file_hash)
+
+                if known is None or obj["LastModified"] > known["LastModified"]:
+                    results[file_hash] = obj
+
+    return results
+
+
+def exhibition_rows(file_hash, result):
+    """Flatten a parsed result into ``(year, row)`` pairs."""
+
+    for section in SECTIONS:
+        for exhibition in result.get(section, []):
+            year = str(exhibition.get("year") or "")
+            year = int(year) if year.isdigit() else None
+
+            yield (
+                NO_YEAR if year is None else str(year),
+                {
+                    "hash": file_hash,
+                    "name": result.get("name"),
+                    "dob": result.get("dob"),
+                    "year": year,
+                    "title": exhibition.get("title"),
+                    "original": exhibition.get("original"),
+                    "type": section,
+                },
+            )
+
+
+def read_results(objects, bucket=AWS_BUCKET_NAME, workers=16):
+    """Read parsed results in parallel, in order.
+
+    At most a few reads per worker are in flight, so memory stays bounded
+    however many results there are.
+
+    Yields:
+        tuple: Hash and parsed result, None when it could not be read.
+    """
+
+    def read(obj):
+        try:
+            return json.loads(read_file(bucket=bucket, object_name=obj["Key"]))
+        except ValueError:
+            logger.warning("Skipping unreadable result.", extra={"key": obj["Key"]})
+            return None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        window = workers * 4
+
+        for start in range(0, len(objects), window):
+            batch = objects[start : start + window]
+            for (file_hash, obj), result in zip(
+                batch, executor.map(read, [obj for _, obj in batch])
+            ):
+                yield file_hash, result
+
+
+class ParquetPartition:
+    """Parquet file of one partition, written a row group at a time."""
+
+    suffix = ".parquet"
+
+    def __init__(self, path, compression):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        # years are typed as readers infer them from the partition names
+        self.schema = pa.schema(
+            [
+                (column, pa.int32() if column == "year" else pa.string())
+                for column in COLUMNS
+            ]
+        )
+        self.writer = pq.ParquetWriter(str(path), self.schema, compression=compression)
+
+    def write(self, rows):
+        self.writer.write_table(self.pa.Table.from_pylist(rows, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+class CsvPartition:
+    """Gzipped CSV file of one partition."""
+
+    suffix = ".csv.gz"
+
+    def __init__(self, path, compression):
+        self.file = gzip.open(str(path), "wt", newline="", encoding="utf-8")
+        self.writer = csv.DictWriter(self.file, fieldnames=COLUMNS)
+        self.writer.writeheader()
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+FORMATS = {"parquet": ParquetPartition, "csv": CsvPartition}
+
+
+def export(
+    folder,
+    output_format="parquet",
+    compression="zstd",
+    bucket=AWS_BUCKET_NAME,
+    workers=16,
+):
+    """Append the results not exported yet to a partitioned dataset.
+
+    Rows hold the hash, name and dob of the result and the year, title,
+    original line and type of the exhibition. Files are partitioned by
+    exhibition year in the hive layout (``year=2018/part-….parquet``) and hold
+    the year too, for readers of single files. Parquet needs the ``pyarrow``
+    package, ``csv`` writes gzipped CSV instead.
+
+    Files are written with a temporary suffix and renamed, and the exported
+    hashes saved, only once every result of the run was written, so an
+    interrupted run leaves the dataset as it was.
+
+    Args:
+        folder (str): Dataset folder.
+        output_format (str, optional): ``parquet`` or ``csv``.
+        compression (str, optional): Parquet codec. Defaults to zstd.
+        workers (int, optional): Parallel listings and reads.
+
+    Returns:
+        dict: Results and rows exported by this run.
+    """
+
+    folder = Path(folder)
+    state_path = folder / STATE_FILE
+
+    state = json.loads(state_path.read_text()) if state_path.is_file() else {}
+    exported = state.get("hashes", {})
+
+    if exported and state.get("format", output_format) != output_format:
+        raise ValueError("%s holds a %s dataset." % (folder, state["format"]))
+    if exported and state.get("columns") != COLUMNS:
+        raise ValueError("%s holds other columns, export to a new folder." % folder)
+
+    listed = list_results(bucket=bucket, workers=workers)
+    pending = sorted(
+        (file_hash, obj)
+        for file_hash, obj in listed.items()
+        if file_hash not in exported
+    )
+
+    logger.info(
+        "Export started.",
+        extra={"total": len(listed), "pending": len(pending), "folder": str(folder)},
+    )
+
+    # leftovers of an interrupted run
+    for path in folder.glob("*/*.tmp"):
+        path.unlink()
+
+    partition_class = FORMATS[output_format]
+    run = "%s-%s" % (time.strftime("%Y%m%d%H%M%S"), uuid.uuid4().hex[:8])
+    partitions = {}
+    buffers = {}
+    rows = 0
+
+    def flush(everything=False):
+        for year, buffer in list(buffers.items()):
+            if not everything and len(buffer) < ROW_GROUP_ROWS:
+                continue
+
+            if year not in partitions:
+                path = folder / ("year=%s" % year)
+                path.mkdir(parents=True, exist_ok=True)
+                path = path / ("part-%s%s.tmp" % (run, partition_class.suffix))
+                partitions[year] = (path, partition_class(path, compression))
+
+            partitions[year][1].write(buffer)
+            del buffers[year]
+
+    start = time.monotonic()
+    done = []
+
+    try:
+        for file_hash, result in read_results(pending, bucket=bucket, workers=workers):
+            if result is None:
+                continue
+
+            for year, row in exhibition_rows(file_hash, result):
+                buffers.setdefault(year, []).append(row)
+                rows += 1
+
+            flush(sum(map(len, buffers.values())) >= MAX_BUFFERED_ROWS)
+
+            done.append(file_hash)
+
+            if len(done) % 1000 == 0:
+                logger.info(
+                    "Export progress.",
+                    extra={
+                        "done": len(done),
+                        "pending": len(pending),
+                        "rate": len(done) / (time.monotonic() - start),
+                    },
+                )
+
+        flush(everything=True)
+
+    finally:
+        for path, partition in partitions.values():
+            partition.close()
+
+    # publish the run
+    for path, _ in partitions.values():
+        path.rename(path.with_suffix(""))
+
+    exported.update((file_hash, listed[file_hash]["ETag"]) for file_hash in done)
+    folder.mkdir(parents=True, exist_ok=True)
+    state_path.write_text(
+        json.dumps({"format": output_format, "columns": COLUMNS, "hashes": exported})
+    )
+
+    logger.info("Export finished.", extra={"results": len(done), "rows": rows})
+
+    return {"results": len(done), "rows": rows}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export parsed exhibitions as a partitioned dataset."
+    )
+    parser.add_argument("folder", help="Dataset folder, appended to when it exists.")
+    parser.add_argument("--format", choices=sorted(FORMATS), default="parquet")
+    parser.add_argument("--compression", default="zstd", help="Parquet codec.")
+    parser.add_argument("--workers", type=int, default=16)
+    args = parser.parse_args()
+
+    outcome = export(
+        args.folder,
+        output_format=args.format,
+        compression=args.compression,
+        workers=args.workers,
+    )
+
+    print("Results:", outcome["results"], "Rows:", outcome["rows"])
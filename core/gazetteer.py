@@ -0,0 +1,324 @@
+import json
+import re
+import threading
+import time
+from collections import Counter, deque
+
+from core.aws.s3 import list_files, read_file
+from core.logs import get_logger
+
+from config import (
+    AWS_BUCKET_NAME,
+    GAZETTEER_ENABLED,
+    GAZETTEER_MIN_COUNT,
+    GAZETTEER_PATH,
+    GAZETTEER_REFRESH_INTERVAL,
+)
+
+logger = get_logger(__name__)
+
+# parsed results in the archive, `cvs/{name}/parsed.json`
+PARSED_JSON_KEY = re.compile(r"^cvs/[^/]+/parsed\.json$")
+
+
+def tokenize(text):
+    """Split text into lowercase word tokens, dropping punctuation."""
+    return tuple(re.findall(r"[^\W_]+", text.lower()))
+
+
+def exhibition_fragments(exhibition, delimeter=","):
+    """Split an exhibition line into its title and the venue/place fragments.
+
+    Args:
+        exhibition (dict): Exhibition result with ``original`` and ``title``.
+        delimeter (str, optional): Fragment delimeter. Defaults to ",".
+
+    Returns:
+        tuple: Title fragment and list of the following fragments.
+    """
+
+    fragments = [f.strip() for f in exhibition.get("original", "").split(delimeter)]
+    fragments = [f for f in fragments if tokenize(f)]
+
+    if not fragments:
+        return None, []
+
+    return fragments[0], fragments[1:]
+
+
+class Automaton:
+    """Aho-Corasick automaton matching token sequences inside a token list."""
+
+    def __init__(self, phrases):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+
+        # build trie
+        for phrase in phrases:
+            node = 0
+            for token in phrase:
+                if token not in self.goto[node]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[node][token] = len(self.goto) - 1
+                node = self.goto[node][token]
+            self.output[node].append(phrase)
+
+        # build failure links breadth first
+        queue = deque(self.goto[0].values())
+
+        while queue:
+            node = queue.popleft()
+
+            for token, child in self.goto[node].items():
+                queue.append(child)
+
+                fail = self.fail[node]
+                while fail and token not in self.goto[fail]:
+                    fail = self.fail[fail]
+
+                self.fail[child] = self.goto[fail].get(token, 0)
+                if self.fail[child] == child:
+                    self.fail[child] = 0
+                self.output[child] += self.output[self.fail[child]]
+
+    def search(self, tokens):
+        node = 0
+
+        for token in tokens:
+            while node and token not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(token, 0)
+
+            yield from self.output[node]
+
+
+class Gazetteer:
+    """Index of venues and places named in previously parsed CVs.
+
+    Fragments following a detected title (``Flinders Lane Gallery``,
+    ``Melbourne``) are counted per source ``parsed.json``. Fragments seen at
+    least ``min_count`` times, and more often as a place than as a title, are
+    trusted and compiled into an :class:`Automaton`. Sources are tracked by
+    ETag, so re-parsed results replace their old counts instead of adding to
+    them.
+
+    The automaton is compiled again after each refresh and swapped in whole,
+    lookups meanwhile use the previous one.
+    """
+
+    def __init__(self, path=GAZETTEER_PATH, min_count=GAZETTEER_MIN_COUNT):
+        self.path = path
+        self.min_count = min_count
+
+        self.sources = {}
+        self.places = Counter()
+        self.titles = Counter()
+
+        self.automaton = None
+        self.refreshed_at = 0
+        self.refreshing = False
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    def add_result(self, key, result, etag=None):
+        """Index (or re-index) the exhibitions of one parsed result."""
+
+        places = Counter()
+        titles = Counter()
+
+        for slug in ["solo_exhibitions", "group_exhibitions"]:
+            for exhibition in result.get(slug, []):
+                # only lines with a title are split reliably
+                if not exhibition.get("title"):
+                    continue
+
+                title, fragments = exhibition_fragments(exhibition)
+                titles[" ".join(tokenize(title))] += 1
+                for fragment in fragments:
+                    places[" ".join(tokenize(fragment))] += 1
+
+        with self.lock:
+            self.remove(key)
+            self.sources[key] = {
+                "etag": etag,
+                "places": dict(places),
+                "titles": dict(titles),
+            }
+            self.places.update(places)
+            self.titles.update(titles)
+
+    def remove(self, key):
+        with self.lock:
+            source = self.sources.pop(key, None)
+
+            if source is None:
+                return
+
+            self.places.subtract(source["places"])
+            self.titles.subtract(source["titles"])
+            self.places += Counter()
+            self.titles += Counter()
+
+    def refresh(self, bucket=AWS_BUCKET_NAME):
+        """Index parsed results in the bucket that are new or changed.
+
+        Returns:
+            int: Number of results (re-)indexed.
+        """
+
+        indexed = 0
+
+        for obj in list_files(bucket=bucket, prefix="cvs/"):
+            key = obj["Key"]
+
+            if not PARSED_JSON_KEY.match(key):
+                continue
+
+            source = self.sources.get(key)
+            if source and source["etag"] == obj["ETag"]:
+                continue
+
+            try:
+                result = json.loads(read_file(bucket=bucket, object_name=key))
+            except ValueError:
+                logger.warning("Skipping unreadable result.", extra={"key": key})
+                continue
+
+            self.add_result(key, result, etag=obj["ETag"])
+            indexed += 1
+
+        if indexed or self.automaton is None:
+            self.compile()
+
+        self.refreshed_at = time.time()
+
+        if indexed:
+            self.save()
+
+        logger.info(
+            "Gazetteer refreshed.",
+            extra={"indexed": indexed, "entries": len(self.confident())},
+        )
+
+        return indexed
+
+    def confident(self):
+        with self.lock:
+            return [
+                phrase
+                for phrase, count in self.places.items()
+                if count >= self.min_count and count > self.titles.get(phrase, 0)
+            ]
+
+    def compile(self):
+        """Build the automaton of confident entries and swap it in."""
+
+        automaton = Automaton(p.split(" ") for p in self.confident())
+
+        with self.lock:
+            self.automaton = automaton
+
+    def has_location(self, text):
+        """Check whether a fragment names a known venue or place.
+
+        Args:
+            text (str): Fragment to check.
+
+        Returns:
+            bool: True on a confident match, None when the index can't tell,
+                e.g. before its automaton was first compiled.
+        """
+
+        automaton = self.automaton
+        if automaton is None:
+            return None
+
+        found = any(True for _ in automaton.search(tokenize(text)))
+
+        with self.lock:
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        return True if found else None
+
+    def load(self):
+        if not self.path.is_file():
+            return
+
+        with open(self.path) as f:
+            data = json.load(f)
+
+        with self.lock:
+            for key, source in data.get("sources", {}).items():
+                self.sources[key] = source
+                self.places.update(source["places"])
+                self.titles.update(source["titles"])
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        with self.lock:
+            data = json.dumps({"sources": self.sources})
+
+        # replace atomically so readers never see a partial file
+        tmp_path = self.path.with_suffix(".tmp")
+        tmp_path.write_text(data)
+        tmp_path.replace(self.path)
+
+
+# process-wide instance
+gazetteer = None
+gazetteer_lock = threading.Lock()
+
+
+def refresh_in_background(index):
+    try:
+        index.refresh()
+    except Exception:
+        # keep answering from what is already indexed
+        logger.exception("Gazetteer refresh failed.")
+        index.refreshed_at = time.time()
+    finally:
+        index.refreshing = False
+
+
+def get_gazetteer():
+    """Get the shared gazetteer, refreshing it in the background when stale.
+
+    Returns:
+        Gazetteer: The shared instance, or None if disabled. It can't tell
+            venues and places until its first refresh finished.
+    """
+
+    global gazetteer
+
+    if not GAZETTEER_ENABLED:
+        return None
+
+    with gazetteer_lock:
+        if gazetteer is None:
+            gazetteer = Gazetteer()
+            gazetteer.load()
+
+        stale = time.time() - gazetteer.refreshed_at >= GAZETTEER_REFRESH_INTERVAL
+
+        if stale and not gazetteer.refreshing:
+            gazetteer.refreshing = True
+            threading.Thread(
+                target=refresh_in_background, args=(gazetteer,), daemon=True
+            ).start()
+
+    return gazetteer
+
+
+if __name__ == "__main__":
+    index = Gazetteer()
+    index.load()
+    index.refresh()
+    print("Known venues and places:", len(index.confident()))
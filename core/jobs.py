@@ -0,0 +1,169 @@
+import hashlib
+import hmac
+import json
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from core import metrics
+from core.aws.s3 import read_file_if_exists, upload_text
+from core.logs import get_logger
+
+from config import (
+    API_CALLBACK_RETRIES,
+    API_CALLBACK_SECRET,
+    API_CALLBACK_THREADS,
+    API_CALLBACK_TIMEOUT,
+    API_CALLBACK_URL,
+    AWS_BUCKET_NAME,
+)
+
+logger = get_logger(__name__)
+
+# callbacks are posted apart from the jobs, whose slots retries would hold
+callbacks = ThreadPoolExecutor(
+    max_workers=API_CALLBACK_THREADS, thread_name_prefix="callback"
+)
+
+# records of jobs submitted through the api, in the bucket so whichever web
+# process or worker runs a job can update it and any web process can answer
+# a poll for it
+JOB_RECORD = "jobs/{id}.json"
+
+# statuses of a job that will not change anymore
+FINISHED = {"done", "failed", "cancelled"}
+
+# published results of a finished job, by their name in the results folder
+RESULTS = ["parsed.json", "parsed.pdf", "cv.pdf", "textract.json"]
+
+
+def new_job(file_hash=None, url=None, name=None):
+    """Create the record of a job for a CV uploaded to S3 or a url.
+
+    Its status goes from ``queued`` to ``running`` and then to ``done``,
+    ``failed`` or ``cancelled``.
+
+    Returns:
+        dict: The record, not saved yet.
+    """
+
+    return {
+        "id": uuid.uuid4().hex,
+        "status": "queued",
+        "source": {"file": name} if file_hash else {"url": url},
+        "hash": file_hash,
+        "name": None,
+        "message": None,
+        "submitted": time.time(),
+        "finished": None,
+        "results": None,
+    }
+
+
+def save_job(record, bucket=AWS_BUCKET_NAME):
+    upload_text(
+        text=json.dumps(record),
+        bucket=bucket,
+        object_name=JOB_RECORD.format(id=record["id"]),
+    )
+
+
+def get_job(job_id, bucket=AWS_BUCKET_NAME):
+    """Get the record of a job, None if there is no such job."""
+
+    text = read_file_if_exists(bucket=bucket, object_name=JOB_RECORD.format(id=job_id))
+    return json.loads(text) if text is not None else None
+
+
+def update_job(job_id, bucket=AWS_BUCKET_NAME, **fields):
+    """Change fields of a job record, notifying the callback once it finished.
+
+    The callback is posted in the background, the record is returned
+    without waiting for it.
+
+    Only the process running the job writes its record after submission, so
+    reading and writing it back doesn't lose updates.
+
+    Returns:
+        dict: The updated record, None if there is no such job.
+    """
+
+    record = get_job(job_id, bucket=bucket)
+    if record is None:
+        logger.warning("Job record missing.", extra={"job": job_id})
+        return None
+
+    record.update(fields)
+
+    if record["status"] in FINISHED:
+        record["finished"] = time.time()
+
+        if record["status"] == "done" and record["hash"]:
+            record["results"] = {
+                name: "/artifacts/%s/%s" % (record["hash"], name) for name in RESULTS
+            }
+
+    save_job(record, bucket=bucket)
+
+    if record["status"] in FINISHED:
+        metrics.increment("api_jobs_%s" % record["status"])
+        if API_CALLBACK_URL:
+            callbacks.submit(notify, record)
+
+    return record
+
+
+def signature(body, secret=API_CALLBACK_SECRET):
+    return "sha256=" + hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+def notify(
+    record,
+    url=API_CALLBACK_URL,
+    retries=API_CALLBACK_RETRIES,
+    timeout=API_CALLBACK_TIMEOUT,
+):
+    """Post a finished job record to the callback url.
+
+    Failed posts are retried with exponential backoff; a callback that stays
+    down is logged and given up on, the record can still be polled. With a
+    ``API_CALLBACK_SECRET`` the body is signed in an ``X-Signature`` header,
+    the HMAC-SHA256 of the body with the secret.
+
+    Returns:
+        bool: True if the callback accepted the record.
+    """
+
+    if not url:
+        return False
+
+    body = json.dumps(record).encode()
+    headers = {"Content-Type": "application/json"}
+    if API_CALLBACK_SECRET:
+        headers["X-Signature"] = signature(body)
+
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(2 ** (attempt - 1))
+
+        request = urllib.request.Request(url, data=body, headers=headers)
+
+        try:
+            with urllib.request.urlopen(request, timeout=timeout):
+                pass
+        except (urllib.error.URLError, OSError) as e:
+            logger.warning(
+                "Job callback failed.",
+                extra={"job": record["id"], "attempt": attempt + 1, "error": str(e)},
+            )
+            continue
+
+        metrics.increment("api_callbacks")
+        return True
+
+    metrics.increment("api_callbacks_failed")
+    logger.error("Job callback given up.", extra={"job": record["id"]})
+
+    return False
@@ -0,0 +1,261 @@
+import math
+import re
+
+# lines starting with a year begin a new entry
+YEAR_START = re.compile(r"^(?:19|20)\d{2}")
+
+# a line ending like this runs on to the next one
+CONTINUED_ENDING = re.compile(
+    r"(?:[,&/(+\-–—]|\b(?:and|at|by|for|from|in|of|on|the|to|with))$", re.IGNORECASE
+)
+
+# a line ending like this finishes its entry
+FINISHED_ENDING = re.compile(r"[.!?)\]'\"’”]$")
+
+# gap between lines, in line heights, above which they are never merged
+MAX_GAP = 0.8
+
+# indentation tolerance, as a fraction of the page width
+INDENT_SLACK = 0.01
+
+# distance from the right edge of the text, as a fraction of its width, of a
+# line that was wrapped because it was full
+FULL_SLACK = 0.15
+
+# fraction of the page height at its top and bottom that headers and footers
+# are found in
+FURNITURE_BAND = 0.1
+
+# distance, as a fraction of the page height, between copies of a header or
+# footer on different pages
+FURNITURE_SLACK = 0.02
+
+# share of the pages a line must be repeated on to be a header or footer
+FURNITURE_MIN_SHARE = 0.5
+
+# page numbers and dates change from page to page, years don't
+PAGE_NUMBER = re.compile(r"\b\d{1,3}\b")
+
+
+def box(block):
+    return block.get("Geometry", {}).get("BoundingBox")
+
+
+def text_edges(lines):
+    """Left and right edge of the text of a page, ignoring stray lines."""
+
+    lefts = sorted(box(b)["Left"] for b in lines)
+    rights = sorted(box(b)["Left"] + box(b)["Width"] for b in lines)
+
+    return lefts[len(lefts) // 10], rights[len(rights) * 9 // 10]
+
+
+def is_continuation(previous, line, edges):
+    """Check whether a line continues the entry of the previous line.
+
+    Args:
+        previous (dict): Textract LINE block above.
+        line (dict): Textract LINE block to check.
+        edges (tuple): Left and right edge of the text of the page.
+
+    Returns:
+        bool: True when the line is part of the same entry.
+    """
+
+    above, below = box(previous), box(line)
+    text = previous.get("Text", "").strip()
+    next_text = line.get("Text", "").strip()
+
+    if not text or not next_text or YEAR_START.match(next_text):
+        return False
+
+    # headings start sections
+    if next_text.isupper() or next_text.endswith(":"):
+        return False
+
+    # a blank line between them
+    gap = below["Top"] - (above["Top"] + above["Height"])
+    if gap > MAX_GAP * max(above["Height"], below["Height"]):
+        return False
+
+    # outdented lines start something new
+    if below["Left"] < above["Left"] - INDENT_SLACK:
+        return False
+
+    # sentences don't start in lowercase
+    if next_text[0].islower():
+        return True
+
+    if FINISHED_ENDING.search(text):
+        return False
+
+    if CONTINUED_ENDING.search(text):
+        return True
+
+    # wrapped because it ran into the margin, under a hanging indent; full
+    # lines at the same indent are usually entries of their own, and lines
+    # indented under a year the next entries of that year
+    if YEAR_START.match(text) or below["Left"] <= above["Left"] + INDENT_SLACK:
+        return False
+
+    left, right = edges
+    return above["Left"] + above["Width"] >= right - FULL_SLACK * (right - left)
+
+
+def merge(first, rest):
+    """Join LINE blocks into one block spanning all of them."""
+
+    boxes = [box(first)] + [box(b) for b in rest]
+    left = min(b["Left"] for b in boxes)
+    top = min(b["Top"] for b in boxes)
+
+    return dict(
+        first,
+        Text=" ".join(b["Text"].strip() for b in [first] + rest),
+        Confidence=min(b.get("Confidence", 100) for b in [first] + rest),
+        Geometry=dict(
+            first["Geometry"],
+            BoundingBox={
+                "Left": left,
+                "Top": top,
+                "Width": max(b["Left"] + b["Width"] for b in boxes) - left,
+                "Height": max(b["Top"] + b["Height"] for b in boxes) - top,
+            },
+        ),
+        MergedIds=[first.get("Id")] + [b.get("Id") for b in rest],
+    )
+
+
+def merge_continuations(blocks):
+    """Merge wrapped lines into one LINE block per logical entry.
+
+    OCR returns an entry wrapped over two lines, such as "Barranco, Photospace
+    Gallery, A.N.U. School of Art," and "Canberra.", as two LINE blocks. A line
+    is merged into the one above it when it is on the same page, close below
+    it, not outdented, doesn't start with a year or look like a heading, and
+    either starts in lowercase, follows a line ending in a comma or a joining
+    word, or is indented under a line that reached the right edge of the text
+    without finishing.
+
+    Blocks without geometry are kept as they are.
+
+    Args:
+        blocks (list): Textract LINE blocks in reading order.
+
+    Returns:
+        list: LINE blocks with continuations merged.
+    """
+
+    pages = {}
+    for b in blocks:
+        if box(b):
+            pages.setdefault(b.get("Page", 1), []).append(b)
+
+    edges = {page: text_edges(lines) for page, lines in pages.items()}
+
+    merged = []
+    group = []
+
+    def flush():
+        if group:
+            merged.append(merge(group[0], group[1:]) if len(group) > 1 else group[0])
+            group.clear()
+
+    for b in blocks:
+        previous = group[-1] if group else None
+
+        if (
+            previous is not None
+            and box(previous)
+            and box(b)
+            and previous.get("Page", 1) == b.get("Page", 1)
+            and is_continuation(previous, b, edges[b.get("Page", 1)])
+        ):
+            group.append(b)
+            continue
+
+        flush()
+        group.append(b)
+
+    flush()
+
+    return merged
+
+
+def furniture_key(block):
+    """Band and normalized text of a line that may be a header or footer."""
+
+    position = box(block)
+    if position is None:
+        return None
+
+    if position["Top"] < FURNITURE_BAND:
+        band = "top"
+    elif position["Top"] + position["Height"] > 1 - FURNITURE_BAND:
+        band = "bottom"
+    else:
+        return None
+
+    text = " ".join(PAGE_NUMBER.sub("#", block.get("Text", "").lower()).split())
+
+    return (band, text) if text else None
+
+
+def remove_furniture(blocks):
+    """Drop headers and footers repeated on the pages of a CV.
+
+    Gallery CVs repeat a header and a footer on every page, such as
+    "6/4/2020 CV | Kate Shaw" and "https://www.kateshaw.org/cv 2/5", which
+    would otherwise be read as exhibitions of whatever section the page
+    break falls in. Lines in the top or bottom band of their page are keyed
+    by their text, with numbers of up to three digits left out so page
+    numbers and dates match, and a key found at about the same height on at
+    least ``FURNITURE_MIN_SHARE`` of the pages, and two of them, is dropped.
+
+    The header of the first page is kept, it usually names the artist.
+
+    Args:
+        blocks (list): Textract LINE blocks in reading order.
+
+    Returns:
+        tuple: The blocks that are kept, and the ones dropped.
+    """
+
+    pages = {b.get("Page", 1) for b in blocks if box(b)}
+    if len(pages) < 2:
+        return blocks, []
+
+    groups = {}
+    for i, b in enumerate(blocks):
+        key = furniture_key(b)
+        if key:
+            groups.setdefault(key, []).append(i)
+
+    needed = max(2, math.ceil(FURNITURE_MIN_SHARE * len(pages)))
+    first_page = min(pages)
+    dropped = set()
+
+    for (band, text), indexes in groups.items():
+        if len(indexes) < needed:
+            continue
+
+        # copies at the same height, not the same words elsewhere in the band
+        tops = sorted(box(blocks[i])["Top"] for i in indexes)
+        median = tops[len(tops) // 2]
+        aligned = [
+            i for i in indexes if abs(box(blocks[i])["Top"] - median) <= FURNITURE_SLACK
+        ]
+
+        if len({blocks[i].get("Page", 1) for i in aligned}) < needed:
+            continue
+
+        dropped.update(
+            i
+            for i in aligned
+            if band == "bottom" or blocks[i].get("Page", 1) != first_page
+        )
+
+    return (
+        [b for i, b in enumerate(blocks) if i not in dropped],
+        [b for i, b in enumerate(blocks) if i in dropped],
+    )
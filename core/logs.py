@@ -0,0 +1,57 @@
+import json
+import logging
+import sys
+
+from config import LOG_LEVEL
+
+# attributes every log record has, anything else was passed through `extra`
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class StructuredFormatter(logging.Formatter):
+    """Format log records as single line JSON objects.
+
+    Any values passed through ``extra`` are included as top-level keys, so
+    ``logger.info("OCR done.", extra={"service": "textract"})`` is written as
+    ``{"level": "INFO", "logger": ..., "message": "OCR done.", "service": "textract"}``.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str)
+
+
+def get_logger(name):
+    """Get a logger writing structured lines to stderr.
+
+    Args:
+        name (str): Logger name, usually ``__name__``.
+
+    Returns:
+        logging.Logger: The configured logger.
+    """
+
+    root = logging.getLogger("artbiogs")
+
+    # configure the package logger once
+    if not root.handlers:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(StructuredFormatter())
+        root.addHandler(handler)
+        root.setLevel(LOG_LEVEL)
+        root.propagate = False
+
+    return root.getChild(name)
@@ -0,0 +1,166 @@
+import json
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from core.aws.s3 import WriteConflict, exists_file, read_file_etag, upload_text_if
+from core.logs import get_logger
+
+from config import AWS_BUCKET_NAME
+
+MANIFEST = "manifests/{hash}.json"
+
+# manifests kept in the local index
+MAX_MANIFESTS = 1000
+
+# attempts to save a manifest other processes keep changing, and the most
+# seconds to wait before the second one
+SAVE_ATTEMPTS = 10
+SAVE_BACKOFF = 0.05
+
+logger = get_logger(__name__)
+
+
+class Manifest:
+    """Artifacts stored for one file hash and the keys they are stored at.
+
+    Artifact names are ``pdf`` and ``textract`` for the temporary upload and
+    its OCR, and ``original``, ``textract_copy``, ``parsed_json`` and
+    ``parsed_pdf`` for the published results.
+
+    Web processes and workers save the same hash's manifest at once, so a
+    manifest is only written over the version it was read at. When another
+    process saved in between, the stored artifacts are read again and the
+    ones added here are laid over them.
+    """
+
+    def __init__(self, file_hash, artifacts=None, bucket=AWS_BUCKET_NAME, etag=None):
+        self.hash = file_hash
+        self.artifacts = artifacts or {}
+        self.bucket = bucket
+
+        # version last read or written, and artifacts added since
+        self.etag = etag
+        self.added = {}
+        self.lock = threading.RLock()
+
+    def has(self, name):
+        return name in self.artifacts
+
+    def key(self, name):
+        return self.artifacts.get(name)
+
+    def add(self, name, object_name):
+        with self.lock:
+            self.artifacts[name] = object_name
+            self.added[name] = object_name
+
+    def record(self, name, object_name):
+        """Add an artifact and save the manifest, unless it is listed already."""
+
+        if self.artifacts.get(name) != object_name:
+            self.add(name, object_name)
+            self.save()
+
+    def save(self):
+        object_name = MANIFEST.format(hash=self.hash)
+
+        with self.lock:
+            for attempt in range(SAVE_ATTEMPTS):
+                text = json.dumps(
+                    {
+                        "hash": self.hash,
+                        "artifacts": self.artifacts,
+                        "updated": time.time(),
+                    }
+                )
+
+                try:
+                    self.etag = upload_text_if(
+                        text=text,
+                        bucket=self.bucket,
+                        object_name=object_name,
+                        etag=self.etag,
+                    )
+                    break
+                except WriteConflict:
+                    logger.info("Manifest changed, merging.", extra={"hash": self.hash})
+
+                # writers that collided don't collide again right away
+                time.sleep(random.uniform(0, SAVE_BACKOFF * 2**attempt))
+
+                stored, self.etag = read_file_etag(
+                    bucket=self.bucket, object_name=object_name
+                )
+                if stored is not None:
+                    self.artifacts = dict(json.loads(stored)["artifacts"], **self.added)
+            else:
+                raise WriteConflict(object_name)
+
+            self.added = {}
+
+        remember(self)
+
+
+# local index of manifests by hash, least recently used first
+manifests = OrderedDict()
+manifests_lock = threading.Lock()
+
+
+def remember(manifest):
+    with manifests_lock:
+        manifests[manifest.hash] = manifest
+        manifests.move_to_end(manifest.hash)
+
+        while len(manifests) > MAX_MANIFESTS:
+            manifests.popitem(last=False)
+
+
+def get_manifest(file_hash, required=(), bucket=AWS_BUCKET_NAME, legacy=None):
+    """Get the manifest of a file hash with a single lookup.
+
+    The local index is trusted when it already lists every ``required``
+    artifact. Otherwise the manifest is read from the bucket, since another
+    worker may have added artifacts since.
+
+    Hashes processed before manifests existed have none; their artifacts are
+    probed once at the keys in ``legacy`` and the manifest is written.
+
+    Args:
+        file_hash (str): MD5 of the file.
+        required (tuple, optional): Artifacts the caller hopes exist.
+        legacy (dict, optional): Keys to probe by artifact name.
+
+    Returns:
+        Manifest: The manifest, empty for a new file.
+    """
+
+    with manifests_lock:
+        manifest = manifests.get(file_hash)
+
+    if manifest and all(manifest.has(name) for name in required):
+        return manifest
+
+    text, etag = read_file_etag(
+        bucket=bucket, object_name=MANIFEST.format(hash=file_hash)
+    )
+
+    if text is not None:
+        manifest = Manifest(
+            file_hash, json.loads(text)["artifacts"], bucket=bucket, etag=etag
+        )
+        remember(manifest)
+        return manifest
+
+    manifest = Manifest(file_hash, bucket=bucket)
+
+    # migrate files processed before manifests
+    for name, object_name in (legacy or {}).items():
+        if exists_file(bucket=bucket, object_name=object_name):
+            manifest.add(name, object_name)
+
+    if manifest.artifacts:
+        manifest.save()
+
+    return manifest
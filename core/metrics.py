@@ -0,0 +1,56 @@
+import threading
+from collections import defaultdict
+
+lock = threading.Lock()
+
+counters = defaultdict(float)
+gauges = {}
+timings = {}
+
+
+def increment(name, value=1):
+    """Add to a counter."""
+    with lock:
+        counters[name] += value
+
+
+def gauge(name, value):
+    """Set a gauge to its current value."""
+    with lock:
+        gauges[name] = value
+
+
+def observe(name, value):
+    """Record one observation (a duration, a ratio) of a timing."""
+    with lock:
+        timing = timings.setdefault(
+            name, {"count": 0, "total": 0.0, "min": value, "max": value}
+        )
+        timing["count"] += 1
+        timing["total"] += value
+        timing["min"] = min(timing["min"], value)
+        timing["max"] = max(timing["max"], value)
+
+
+def mean(name, default=0.0):
+    with lock:
+        timing = timings.get(name)
+        return timing["total"] / timing["count"] if timing else default
+
+
+def snapshot():
+    """Get all metrics of this process.
+
+    Returns:
+        dict: Counters, gauges and timings (with their mean) by name.
+    """
+
+    with lock:
+        return {
+            "counters": dict(counters),
+            "gauges": dict(gauges),
+            "timings": {
+                name: dict(timing, mean=timing["total"] / timing["count"])
+                for name, timing in timings.items()
+            },
+        }
@@ -0,0 +1,290 @@
+import hashlib
+import json
+import re
+import sys
+import tempfile
+from functools import partial
+from pathlib import Path
+
+from core.aws.s3 import (
+    download_file,
+    exists_file,
+    list_files,
+    read_file,
+    upload_file,
+    upload_text,
+)
+from core.aws.textract import process_file
+from core.logs import get_logger
+
+from config import AWS_BUCKET_NAME
+
+logger = get_logger(__name__)
+
+# textract blocks of a single page, keyed by page fingerprint
+PAGE_BLOCKS = "tmp/pages/{fingerprint}.json"
+
+# pdf holding only the pages that still need OCR
+PAGES_FILE = "tmp/{hash}-pages-{pages}.pdf"
+
+# earlier textract output, `tmp/{hash}.json`
+TEXTRACT_JSON_KEY = re.compile(r"^tmp/([0-9a-f]{32})\.json$")
+
+
+def digest_object(digest, obj, seen):
+    """Add a PDF object, and the objects it references, to a digest.
+
+    Objects referenced again are added by the order they were first seen
+    in, not by their object number, which changes when a CV is revised.
+
+    Args:
+        digest: hashlib object to update.
+        obj: pypdf object, direct or indirect.
+        seen (dict): Order of the indirect objects added so far, by reference.
+    """
+
+    from pypdf.generic import (
+        ArrayObject,
+        DictionaryObject,
+        IndirectObject,
+        StreamObject,
+    )
+
+    if isinstance(obj, IndirectObject):
+        reference = (obj.idnum, obj.generation)
+        if reference in seen:
+            digest.update(b"R%d" % seen[reference])
+            return
+
+        seen[reference] = len(seen)
+        obj = obj.get_object()
+
+    if isinstance(obj, DictionaryObject):
+        digest.update(b"<<")
+        for name in sorted(obj):
+            # links back up the page tree would add every other page
+            if name in ("/Parent", "/P"):
+                continue
+            digest.update(name.encode())
+            digest_object(digest, obj.raw_get(name), seen)
+        digest.update(b">>")
+
+        if isinstance(obj, StreamObject):
+            digest.update(obj.get_data())
+
+    elif isinstance(obj, ArrayObject):
+        digest.update(b"[")
+        for item in obj:
+            digest_object(digest, item, seen)
+        digest.update(b"]")
+
+    else:
+        digest.update(repr(obj).encode())
+
+
+def page_fingerprints(file_path):
+    """Fingerprint every page of a PDF by its content.
+
+    A page is identified by its size, its content stream and everything its
+    resources hold: fonts, images and form XObjects with their own
+    resources. The same page in a revised CV gets the same fingerprint even
+    though the file hash changed, while pages drawn the same way with other
+    fonts or images don't.
+
+    Args:
+        file_path (str): PDF to fingerprint.
+
+    Returns:
+        list: One md5 hex digest per page, in page order.
+    """
+
+    from pypdf import PdfReader
+
+    fingerprints = []
+
+    for page in PdfReader(str(file_path)).pages:
+        digest = hashlib.md5(str(list(page.mediabox)).encode())
+
+        contents = page.get_contents()
+        if contents is not None:
+            digest.update(contents.get_data())
+
+        resources = page.get("/Resources")
+        if resources is not None:
+            digest_object(digest, resources, {})
+
+        fingerprints.append(digest.hexdigest())
+
+    return fingerprints
+
+
+def split_pages(blocks):
+    """Group textract blocks by page number.
+
+    Returns:
+        dict: Blocks by page number (1-based).
+    """
+
+    pages = {}
+
+    for b in blocks:
+        pages.setdefault(b.get("Page", 1), []).append(b)
+
+    return pages
+
+
+def renumber(blocks, page):
+    """Copy a page's blocks as page number ``page`` of a document.
+
+    Block ids are prefixed with the page number so a page reused twice in one
+    document does not produce duplicate ids.
+    """
+
+    renumbered = []
+
+    for b in blocks:
+        b = dict(b, Page=page, Id="%d-%s" % (page, b["Id"]))
+
+        if b.get("Relationships"):
+            b["Relationships"] = [
+                dict(r, Ids=["%d-%s" % (page, i) for i in r.get("Ids", [])])
+                for r in b["Relationships"]
+            ]
+
+        renumbered.append(b)
+
+    return renumbered
+
+
+def store_pages(fingerprints, pages, bucket=AWS_BUCKET_NAME):
+    """Save the blocks of every page under its fingerprint.
+
+    Args:
+        fingerprints (list): Page fingerprints of the document.
+        pages (dict): Textract blocks by page number.
+    """
+
+    for number, blocks in pages.items():
+        object_name = PAGE_BLOCKS.format(fingerprint=fingerprints[number - 1])
+
+        if exists_file(bucket=bucket, object_name=object_name):
+            continue
+
+        upload_text(
+            text=json.dumps([dict(b, Page=1) for b in blocks]),
+            bucket=bucket,
+            object_name=object_name,
+        )
+
+
+def ocr_pages(file_path, file_hash, object_name, ocr=None, bucket=AWS_BUCKET_NAME):
+    """OCR a PDF, sending only pages not seen before to Textract.
+
+    Args:
+        file_path (str): Local copy of the PDF.
+        file_hash (str): MD5 of the PDF.
+        object_name (str): S3 key of the uploaded PDF.
+        ocr (callable, optional): Textract blocks of an S3 key, e.g. one that
+            records the Textract job so a cancelled job can resume it.
+            Defaults to a new Textract job in ``bucket``.
+
+    Returns:
+        tuple: Textract blocks of the whole document and the number of pages
+            that were reused.
+    """
+
+    if ocr is None:
+        ocr = partial(process_file, bucket)
+
+    try:
+        fingerprints = page_fingerprints(file_path)
+    except Exception:
+        logger.warning("Could not fingerprint pages.", extra={"hash": file_hash})
+        return ocr(object_name), 0
+
+    # blocks of pages seen before
+    cached = {}
+    for number, fingerprint in enumerate(fingerprints, start=1):
+        page_key = PAGE_BLOCKS.format(fingerprint=fingerprint)
+        if exists_file(bucket=bucket, object_name=page_key):
+            cached[number] = json.loads(read_file(bucket=bucket, object_name=page_key))
+
+    missing = [n for n in range(1, len(fingerprints) + 1) if n not in cached]
+    ocred = {}
+
+    if len(missing) == len(fingerprints):
+        ocred = split_pages(ocr(object_name))
+
+    elif missing:
+        from pypdf import PdfReader, PdfWriter
+
+        # ocr a pdf of only the new or changed pages
+        reader = PdfReader(str(file_path))
+        writer = PdfWriter()
+        for number in missing:
+            writer.add_page(reader.pages[number - 1])
+
+        with tempfile.TemporaryDirectory() as folder:
+            pages_path = Path(folder) / "pages.pdf"
+            with open(pages_path, "wb") as f:
+                writer.write(f)
+
+            # named after its pages, a textract job resumed for it covers them
+            pages_temp = PAGES_FILE.format(
+                hash=file_hash, pages="-".join(str(n) for n in missing)
+            )
+            upload_file(file_path=pages_path, bucket=bucket, object_name=pages_temp)
+
+        pages = split_pages(ocr(pages_temp))
+        ocred = {number: pages.get(i, []) for i, number in enumerate(missing, start=1)}
+
+    # merge pages in document order
+    blocks = []
+    for number in range(1, len(fingerprints) + 1):
+        page_blocks = cached[number] if number in cached else ocred.get(number, [])
+        blocks += renumber(page_blocks, number)
+
+    store_pages(fingerprints, ocred, bucket=bucket)
+
+    return blocks, len(cached)
+
+
+def backfill(bucket=AWS_BUCKET_NAME):
+    """Build the page store from earlier `tmp/{hash}.json` textract output."""
+
+    stored = 0
+
+    for obj in list_files(bucket=bucket, prefix="tmp/"):
+        match = TEXTRACT_JSON_KEY.match(obj["Key"])
+        file_temp = "tmp/%s.pdf" % match.group(1) if match else None
+
+        if not match or not exists_file(bucket=bucket, object_name=file_temp):
+            continue
+
+        with tempfile.TemporaryDirectory() as folder:
+            file_path = Path(folder) / "cv.pdf"
+            download_file(bucket=bucket, object_name=file_temp, file_path=file_path)
+
+            try:
+                fingerprints = page_fingerprints(file_path)
+            except Exception:
+                logger.warning("Could not fingerprint pages.", extra={"key": file_temp})
+                continue
+
+        blocks = json.loads(read_file(bucket=bucket, object_name=obj["Key"]))
+        pages = split_pages(blocks)
+        store_pages(
+            fingerprints,
+            {n: pages.get(n, []) for n in range(1, len(fingerprints) + 1)},
+            bucket=bucket,
+        )
+        stored += 1
+
+    print("Documents stored by page:", stored)
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["backfill"]:
+        backfill()
+    else:
+        print(page_fingerprints(sys.argv[1]))
@@ -1,21 +1,51 @@
 import datetime
 import hashlib
 import json
+import logging
 import re
 import sys
+import tempfile
 import time
 from concurrent.futures import ThreadPoolExecutor as PoolExecutor
+from functools import partial
 from pathlib import Path
 
+from core import metrics
 from core.aws.comprehend import ExtractBirthday, ExtractExhibition, ExtractName
-from core.aws.s3 import create_bucket, exists_file, read_file, upload_file, upload_text
-from core.aws.textract import process_file
+from core.aws.s3 import (
+    copy_file,
+    download_file,
+    ensure_bucket,
+    read_file,
+    upload_file,
+    upload_text,
+)
+from core.aws.textract import get_blocks, start_job
 from core.convert import data2pdf
-
-from config import AWS_BUCKET_NAME
+from core.cancel import JobCancelled, checkpoint
+from core.classifier import cascade_report, get_cascade
+from core.events import COALESCED_CODES, EventChannel
+from core.gazetteer import get_gazetteer
+from core.layout import merge_continuations, remove_furniture
+from core.logs import get_logger
+from core.manifest import get_manifest
+from core.pages import ocr_pages
+from core.profile import Profile
+from core.search import index_result
+from core.stages import Stages, get_stages
+
+from config import (
+    AWS_BUCKET_NAME,
+    LAYOUT_FURNITURE_ENABLED,
+    LAYOUT_MERGE_ENABLED,
+    PAGE_REUSE_ENABLED,
+    PROFILE_JOBS,
+)
 
 exhibition = ExtractExhibition()
 
+logger = get_logger(__name__)
+
 
 class Parser:
 
@@ -27,10 +57,32 @@ class Parser:
     TEXTRACT_FILE = "cvs/{name}/textract.json"
     PARSED_JSON = "cvs/{name}/parsed.json"
     PARSED_PDF = "cvs/{name}/parsed.pdf"
+    PROFILE_FOLDED = "cvs/{name}/profile.folded"
+    PROFILE_JSON = "cvs/{name}/profile.json"
 
     def __init__(self, **config):
         self.emit = config.get("emit", None)
         self.meta = config.get("meta", {})
+        self.events = config.get("events", None)
+
+        # where the parsed pdf is written, next to the cv by default
+        self.output_folder = config.get("output_folder", None)
+
+        # sample the job and trace its aws calls
+        self.profile = config.get("profile", PROFILE_JOBS)
+
+        # classify wrapped exhibition lines as one
+        self.merge_lines = config.get("merge_lines", LAYOUT_MERGE_ENABLED)
+
+        # drop headers and footers repeated on every page
+        self.drop_furniture = config.get("drop_furniture", LAYOUT_FURNITURE_ENABLED)
+
+        # s3 folder of the job's results, known once the cv is hashed
+        self.folder_name = None
+
+        # plain emit callbacks still get batched frames
+        if self.events is None and self.emit:
+            self.events = EventChannel(self.emit, job_id=self.meta.get("job"))
 
     def dispatch(self, code, service, status, info=None, meta=None):
         result = {
@@ -41,14 +93,31 @@ class Parser:
             "meta": meta,
         }
 
-        # emit to socket or print
-        if self.emit:
-            self.emit("job:message", result)
+        # emit to socket
+        if self.events:
+            self.events.publish(result)
+
+        # log high frequency messages at debug level
+        level = logging.DEBUG if code in COALESCED_CODES else logging.INFO
+        logger.log(
+            level,
+            status,
+            extra={"code": code, "service": service, "info": info, "meta": meta},
+        )
+
+    def process_blocks(self, blocks, stages=None):
+        """Extract the name, dob and exhibitions of a CV from its OCR.
 
-        # print to screen
-        print(result)
+        Args:
+            blocks (list): Textract blocks of the CV.
+            stages (Stages, optional): Progress of the CV, the header, section
+                scan and lines classified in a failed run are not repeated.
 
-    def process_blocks(self, blocks):
+        Returns:
+            dict: The parsed result.
+        """
+
+        stages = stages or Stages()
 
         # default result
         result = {
@@ -64,24 +133,116 @@ class Parser:
         if not blocks:
             return result
 
-        header_text = ""
+        # page headers and footers are neither header text nor exhibitions
+        if self.drop_furniture:
+            blocks, furniture = remove_furniture(blocks)
+            metrics.increment("furniture_lines_dropped", len(furniture))
+            self.dispatch(
+                "welp",
+                "layout",
+                "Page headers and footers removed.",
+                len(furniture),
+                {"lines": sorted({b["Text"] for b in furniture})},
+            )
+
+        if stages.done("header"):
+            result.update(stages.get("header"))
+            self.dispatch("welp", "checkpoint", "Header restored from checkpoint.")
+            self.dispatch("artist:name", "script", "Name detected.", result["name"])
+            self.dispatch("artist:dob", "script", "DOB detected.", result["dob"])
+        else:
+            header_text = ""
+
+            # extract header text
+            for b in blocks:
+                if len(header_text) >= 500:
+                    break
+
+                header_text += b.get("Text", "") + ". "
+
+            self.dispatch("welp", "script", "Header extracted.", header_text)
+
+            # extract name
+            result["name"] = ExtractName(header_text)
+            self.dispatch("artist:name", "script", "Name detected.", result["name"])
+
+            # extract dob
+            result["dob"] = ExtractBirthday(header_text)
+            self.dispatch("artist:dob", "script", "DOB detected.", result["dob"])
+
+            stages.complete("header", {"name": result["name"], "dob": result["dob"]})
+
+        if stages.done("sections"):
+            lines = stages.get("sections")
+            self.dispatch(
+                "welp",
+                "checkpoint",
+                "Sections restored from checkpoint.",
+                len(stages.lines),
+                {"lines": len(lines), "classified": len(stages.lines)},
+            )
+        else:
+            lines = self.scan_sections(blocks)
+            stages.complete("sections", lines)
+
+        # lines classified before a failure are not sent again
+        for i, line in enumerate(lines):
+            if i < len(stages.lines):
+                exhibition_result = stages.lines[i]
+            else:
+                # every line costs comprehend calls
+                checkpoint()
+
+                exhibition = ExtractExhibition()
+                title = exhibition.process(year=line["year"], text=line["text"])
+
+                exhibition_result = {
+                    "year": line["year"],
+                    "title": title,
+                    "original": line["text"],
+                    "type": line["type"],
+                }
+
+                stages.add_line(exhibition_result)
+
+            if exhibition_result["title"]:
+                self.dispatch(
+                    "artist:exhibition",
+                    "comprehend",
+                    "Found exhibition: %s" % exhibition_result["title"],
+                    exhibition_result["title"],
+                    exhibition_result,
+                )
+
+            result[line["type"]].append(exhibition_result)
 
-        # extract header text
-        for b in blocks:
-            if len(header_text) >= 500:
-                break
+        stages.complete("classify")
+
+        # report local classifier savings
+        if get_cascade():
+            self.dispatch("welp", "classifier", "Classifier report.", cascade_report())
+
+        return result
 
-            header_text += b.get("Text", "") + ". "
+    def scan_sections(self, blocks):
+        """Find the exhibition lines of each section and their years.
 
-        self.dispatch("welp", "script", "Header extracted.", header_text)
+        Returns:
+            list: Lines to classify, with their ``year``, ``text`` and ``type``.
+        """
 
-        # extract name
-        result["name"] = ExtractName(header_text)
-        self.dispatch("artist:name", "script", "Name detected.", result["name"])
+        lines = []
 
-        # extract dob
-        result["dob"] = ExtractBirthday(header_text)
-        self.dispatch("artist:dob", "script", "DOB detected.", result["dob"])
+        # join wrapped lines, so each exhibition is classified once
+        if self.merge_lines:
+            count = len(blocks)
+            blocks = merge_continuations(blocks)
+            self.dispatch(
+                "welp",
+                "layout",
+                "Continuation lines merged.",
+                count - len(blocks),
+            )
 
         # extract sections
 
@@ -169,69 +330,179 @@ class Parser:
 
                 # iterate over all exhibitions between years
                 for x in range(exhibition_start_index, exhibition_end_index):
-                    text = blocks[x]
                     text = re.sub(r"^(?:19|20)\d{2}", "", blocks[x]["Text"])
                     text = text.strip()
 
                     if not text:
                         continue
 
-                    exhibition = ExtractExhibition()
-                    title = exhibition.process(year=year, text=text)
-
-                    exhibition_result = {
-                        "year": year,
-                        "title": title,
-                        "original": text,
-                        "type": section["slug"],
-                    }
-
-                    if title:
-                        self.dispatch(
-                            "artist:exhibition",
-                            "comprehend",
-                            "Found exhibition: %s" % title,
-                            title,
-                            exhibition_result,
-                        )
+                    lines.append({"year": year, "text": text, "type": section["slug"]})
 
-                    result[section["slug"]].append(exhibition_result)
+        return lines
 
-        return result
+    def textract(self, manifest, file_temp):
+        """OCR a PDF in S3, waiting on the job started earlier for it if any.
 
-    def process_cv(self, file_path):
+        The job id is recorded before waiting, so a job cancelled while
+        Textract runs picks up the same Textract job when it is retried.
+        """
 
-        # cv meta
-        meta = {"hash": None}
+        job_id = manifest.key("textract_job")
+
+        # jobs recorded before their source was are of the uploaded pdf
+        source = manifest.key("textract_source") or manifest.key("pdf")
+
+        if job_id and source == file_temp:
+            try:
+                return get_blocks(job_id)
+            except JobCancelled:
+                raise
+            except Exception:
+                logger.warning(
+                    "Textract job failed, restarting.", extra={"job": job_id}
+                )
+
+        job_id = start_job(bucket=AWS_BUCKET_NAME, object_name=file_temp)
+        manifest.add("textract_job", job_id)
+        manifest.add("textract_source", file_temp)
+        manifest.save()
+
+        return get_blocks(job_id)
+
+    def process_cv(self, file_path=None, file_hash=None):
+        """Parse a CV from a local file or from an upload already in S3.
+
+        Args:
+            file_path (str, optional): Local copy of the CV.
+            file_hash (str, optional): MD5 of a CV streamed to S3 on upload,
+                used when there is no local copy.
+
+        Returns:
+            dict: The parsed result.
+        """
+
+        if not self.profile:
+            return self.parse_cv(file_path, file_hash)
+
+        profile = Profile()
+        profile.start()
+
+        # profile failed jobs too, they are often the slow ones
+        try:
+            return self.parse_cv(file_path, file_hash)
+        finally:
+            profile.stop()
+
+            try:
+                self.save_profile(profile)
+            except Exception:
+                logger.exception("Could not save profile.", extra=self.meta)
+
+    def save_profile(self, profile):
+        if self.folder_name is None:
+            return
+
+        file_folded = self.PROFILE_FOLDED.format(name=self.folder_name)
+        file_json = self.PROFILE_JSON.format(name=self.folder_name)
 
-        print('before hashhhhhhhhhhhhhhh')
+        upload_text(
+            text=profile.folded(), bucket=AWS_BUCKET_NAME, object_name=file_folded
+        )
+        upload_text(
+            text=json.dumps(profile.summary()),
+            bucket=AWS_BUCKET_NAME,
+            object_name=file_json,
+        )
+        self.dispatch(
+            "uploaded:profile",
+            "s3",
+            "Profile uploaded to s3 bucket.",
+            file_folded,
+            {
+                "wall": round(profile.wall, 2),
+                "peak_memory": profile.peak_memory,
+                "aws": profile.summary()["aws"],
+            },
+        )
+
+    def parse_cv(self, file_path=None, file_hash=None):
 
         # identify file uniquely by content
-        file_hash = hashlib.md5(open(file_path, "rb").read()).hexdigest()
-        print('after hashhhhhhhhhhhhhhh', file_hash)
+        if file_path is not None:
+            file_hash = hashlib.md5(open(file_path, "rb").read()).hexdigest()
 
-        meta["hash"] = file_hash
+        self.folder_name = file_hash
         self.dispatch("file:hash", "hash", "File hash computed.", file_hash)
 
+        # progress of an earlier run of the same cv that failed
+        cascade = get_cascade()
+        stages = get_stages(
+            file_hash,
+            options={
+                "merge_lines": self.merge_lines,
+                "drop_furniture": self.drop_furniture,
+                "classifier": cascade.model.version if cascade else None,
+            },
+        )
+
+        if stages.last:
+            self.dispatch(
+                "welp",
+                "checkpoint",
+                "Resuming after %s." % stages.last,
+                stages.last,
+                {"lines": len(stages.lines)},
+            )
+
+        try:
+            return self.run_stages(file_path, file_hash, stages)
+        except BaseException:
+            # keep the work done for a retry, failed or cancelled
+            try:
+                stages.save()
+            except Exception:
+                logger.exception("Could not save checkpoint.", extra=self.meta)
+            raise
+
+    def run_stages(self, file_path, file_hash, stages):
+        """Run the stages of a CV not completed by an earlier run.
+
+        Ingest and OCR resume through the manifest, the rest through
+        ``stages``. Rendering resumes only when the parsed PDF is still on
+        disk, since it is written locally.
+        """
+
+        # cv meta
+        meta = {"hash": file_hash}
+
         file_temp = self.TMP_FILE.format(hash=file_hash)
+        file_textract = self.TEXTRACT_JSON.format(hash=file_hash)
 
-        # create bucket if not exists
-        if create_bucket(bucket=AWS_BUCKET_NAME):
-            self.dispatch("welp", "s3", "S3 Bucket created.", AWS_BUCKET_NAME)
+        # one lookup tells which artifacts already exist
+        manifest = get_manifest(
+            file_hash,
+            required=["pdf", "textract"],
+            legacy={"pdf": file_temp, "textract": file_textract},
+        )
 
         # check if temp file exists in s3
-        if not exists_file(bucket=AWS_BUCKET_NAME, object_name=file_temp):
+        if not manifest.has("pdf"):
             response = upload_file(
                 file_path=file_path, bucket=AWS_BUCKET_NAME, object_name=file_temp
             )
+            manifest.add("pdf", file_temp)
+            manifest.save()
             self.dispatch("welp", "s3", "PDF uploaded to s3 bucket.", response)
         else:
+            file_temp = manifest.key("pdf")
             self.dispatch("welp", "s3", "PDF exists in s3 bucket.")
 
-        file_textract = self.TEXTRACT_JSON.format(hash=file_hash)
+        stages.complete("ingest", file_temp)
+
+        checkpoint()
 
         # check if temp file already processed in s3
-        if not exists_file(bucket=AWS_BUCKET_NAME, object_name=file_textract):
+        if not manifest.has("textract"):
             self.dispatch("welp", "textract", "OCR does not exist in s3 bucket.")
 
             self.dispatch(
@@ -240,33 +511,76 @@ class Parser:
                 "Textract is detecting text. This might take a few minutes.",
             )
 
-            blocks = process_file(bucket=AWS_BUCKET_NAME, object_name=file_temp)
+            # only ocr pages not seen in earlier versions of the cv
+            if PAGE_REUSE_ENABLED:
+                with tempfile.TemporaryDirectory() as folder:
+                    local_path = file_path
+
+                    # fingerprinting pages needs a local copy of s3 uploads
+                    if local_path is None:
+                        local_path = Path(folder) / "cv.pdf"
+                        download_file(
+                            bucket=AWS_BUCKET_NAME,
+                            object_name=file_temp,
+                            file_path=local_path,
+                        )
+
+                    # the textract job is recorded like a whole document's
+                    blocks, reused = ocr_pages(
+                        file_path=local_path,
+                        file_hash=file_hash,
+                        object_name=file_temp,
+                        ocr=partial(self.textract, manifest),
+                    )
+                self.dispatch("welp", "textract", "OCR pages reused.", reused)
+            else:
+                blocks = self.textract(manifest, file_temp)
             self.dispatch("welp", "textract", "OCR text processed.")
 
             text = json.dumps(blocks)
             upload_text(text=text, bucket=AWS_BUCKET_NAME, object_name=file_textract)
+            manifest.add("textract", file_textract)
+            manifest.save()
             self.dispatch("welp", "s3", "OCR text saved to s3 bucket.")
 
         else:
             self.dispatch("welp", "s3", "OCR exists in s3 bucket.")
 
-            text = read_file(bucket=AWS_BUCKET_NAME, object_name=file_textract)
+            text = read_file(
+                bucket=AWS_BUCKET_NAME, object_name=manifest.key("textract")
+            )
             self.dispatch("welp", "s3", "OCR text loaded from s3 bucket.")
 
             blocks = json.loads(text)
 
+        stages.complete("ocr", manifest.key("textract"))
+
+        # finished ocr is cached above, a retry starts from here
+        checkpoint()
+
         self.dispatch("welp", "script", "Processing CV started.")
 
         # extract information from text
-        result = self.process_blocks(blocks)
+        result = self.process_blocks(blocks, stages)
 
         # append meta information
+        cascade = get_cascade()
+        if cascade:
+            meta["classifier"] = cascade.model.version
         result["meta"] = meta
 
+        checkpoint()
+
         # save parsed pdf
         self.dispatch("welp", "script", "Generating Parsed PDF.")
-        parsed_path = Path(file_path).parent / (Path(file_path).stem + "-parsed.pdf")
-        data2pdf(result, parsed_path)
+        parsed_name = (Path(file_path).stem if file_path else file_hash) + "-parsed.pdf"
+        parsed_path = Path(self.output_folder or Path(file_path).parent) / parsed_name
+
+        if stages.done("render") and parsed_path.is_file():
+            self.dispatch("welp", "checkpoint", "Parsed PDF restored from checkpoint.")
+        else:
+            data2pdf(result, parsed_path)
+            stages.complete("render", parsed_name)
 
         # s3 object names
         folder_name = (
@@ -275,21 +589,45 @@ class Parser:
             else file_hash
         )
 
+        self.folder_name = folder_name
+
         file_original = self.ORIGINAL_FILE.format(name=folder_name)
         file_textract = self.TEXTRACT_FILE.format(name=folder_name)
         file_parsed_json = self.PARSED_JSON.format(name=folder_name)
         file_parsed_pdf = self.PARSED_PDF.format(name=folder_name)
 
-        # upload original file
-        upload_file(
-            file_path=file_path, bucket=AWS_BUCKET_NAME, object_name=file_original
-        )
+        # uploads finished by a failed run are not repeated
+        published = stages.published
+
+        # upload original file, or copy it when it was streamed to s3
+        if published.get("original") != file_original:
+            if file_path is not None:
+                upload_file(
+                    file_path=file_path,
+                    bucket=AWS_BUCKET_NAME,
+                    object_name=file_original,
+                )
+            else:
+                copy_file(
+                    source={"Bucket": AWS_BUCKET_NAME, "Key": file_temp},
+                    bucket=AWS_BUCKET_NAME,
+                    object_name=file_original,
+                )
+            stages.publish("original", file_original)
+
+        # links to results are served through the manifest
+        manifest.record("original", file_original)
         self.dispatch("uploaded:cv", "s3", "CV uploaded to s3 bucket.", file_original)
 
         # upload textract result
-        upload_text(
-            text=json.dumps(blocks), bucket=AWS_BUCKET_NAME, object_name=file_textract
-        )
+        if published.get("textract_copy") != file_textract:
+            upload_text(
+                text=json.dumps(blocks),
+                bucket=AWS_BUCKET_NAME,
+                object_name=file_textract,
+            )
+            stages.publish("textract_copy", file_textract)
+        manifest.record("textract_copy", file_textract)
         self.dispatch(
             "uploaded:textract",
             "s3",
@@ -298,11 +636,14 @@ class Parser:
         )
 
         # upload parsed json result
-        upload_text(
-            text=json.dumps(result),
-            bucket=AWS_BUCKET_NAME,
-            object_name=file_parsed_json,
-        )
+        if published.get("parsed_json") != file_parsed_json:
+            upload_text(
+                text=json.dumps(result),
+                bucket=AWS_BUCKET_NAME,
+                object_name=file_parsed_json,
+            )
+            stages.publish("parsed_json", file_parsed_json)
+        manifest.record("parsed_json", file_parsed_json)
         self.dispatch(
             "uploaded:parsed_json",
             "s3",
@@ -310,23 +651,39 @@ class Parser:
             file_parsed_json,
         )
 
+        # learn venues and places from the new result
+        gazetteer = get_gazetteer()
+        if gazetteer:
+            gazetteer.add_result(file_parsed_json, result)
+            gazetteer.save()
+
+        # searchable right away when this process serves queries
+        index_result(file_parsed_json, result)
+
         # upload parsed pdf result
         upload_file(
             file_path=parsed_path, bucket=AWS_BUCKET_NAME, object_name=file_parsed_pdf
         )
+        manifest.record("parsed_pdf", file_parsed_pdf)
         self.dispatch(
             "uploaded:parsed_pdf",
             "s3",
             "Processed result uploaded to s3 bucket.",
             file_parsed_pdf,
-            {"filename": (Path(file_path).stem + "-parsed.pdf")},
+            {"filename": parsed_name},
         )
 
+        # nothing left to resume
+        stages.complete("publish")
+        stages.clear()
+
         self.dispatch("script:done", "script", "Processing CV complete.")
 
         return result
 
 
 if __name__ == "__main__":
+    ensure_bucket(bucket=AWS_BUCKET_NAME)
+
     parser = Parser()
     parser.process_cv(sys.argv[1])
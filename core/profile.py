@@ -0,0 +1,164 @@
+import contextvars
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+from config import PROFILE_INTERVAL, PROJECT_ROOT
+
+# profile of the job running in the current context
+current_profile = contextvars.ContextVar("profile", default=None)
+
+
+def frame_name(frame):
+    code = frame.f_code
+    path = code.co_filename
+
+    # project files by relative path, libraries by module file
+    if path.startswith(str(PROJECT_ROOT)):
+        path = os.path.relpath(path, str(PROJECT_ROOT))
+    else:
+        path = os.path.basename(path)
+
+    return "%s:%s" % (path, code.co_name)
+
+
+class Profile:
+    """Sampling profile of one job.
+
+    A background thread samples the stack of the thread that started the
+    profile every ``interval`` seconds, so time spent in Python code, waiting
+    on AWS and waiting on wkhtmltopdf all show up under the calls that caused
+    it. AWS calls made while the profile is current are traced with their
+    latency, and tracemalloc reports the peak memory.
+
+    tracemalloc is process wide, so the peak of jobs profiled at the same
+    time includes the allocations of the others.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.samples = Counter()
+        self.calls = []
+        self.peak_memory = None
+        self.started = None
+        self.wall = None
+
+        self.thread_id = None
+        self.stopped = threading.Event()
+        self.sampler = None
+        self.token = None
+        self.tracing = False
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        self.thread_id = threading.get_ident()
+        self.token = current_profile.set(self)
+
+        # leave tracemalloc to whoever started it
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.tracing = True
+        tracemalloc.reset_peak()
+
+        self.started = time.perf_counter()
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+
+    def stop(self):
+        self.wall = time.perf_counter() - self.started
+        self.stopped.set()
+        self.sampler.join()
+
+        self.peak_memory = tracemalloc.get_traced_memory()[1]
+        if self.tracing:
+            tracemalloc.stop()
+
+        current_profile.reset(self.token)
+
+    def sample(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+
+            if stack:
+                self.samples[";".join(reversed(stack))] += 1
+
+    def record(self, service, operation, start, duration, error=None):
+        self.calls.append(
+            {
+                "service": service,
+                "operation": operation,
+                "start": round(start - self.started, 4),
+                "duration": round(duration, 4),
+                "error": error,
+            }
+        )
+
+    def folded(self):
+        """Samples in the folded stack format of flamegraph.pl and speedscope."""
+
+        return "".join(
+            "%s %d\n" % (stack, count) for stack, count in self.samples.most_common()
+        )
+
+    def summary(self):
+        services = {}
+
+        for call in self.calls:
+            service = services.setdefault(call["service"], {"calls": 0, "seconds": 0})
+            service["calls"] += 1
+            service["seconds"] = round(service["seconds"] + call["duration"], 4)
+
+        return {
+            "wall": round(self.wall, 4),
+            "interval": self.interval,
+            "samples": sum(self.samples.values()),
+            "peak_memory": self.peak_memory,
+            "aws": services,
+            "calls": self.calls,
+        }
+
+
+# botocore event handlers, every client calls them in the thread of the call
+
+
+def before_call(model, context, **kwargs):
+    if current_profile.get() is not None:
+        context["profile_start"] = time.perf_counter()
+
+
+def after_call(model, context, parsed=None, http_response=None, **kwargs):
+    profile = current_profile.get()
+    start = context.get("profile_start")
+
+    if profile is None or start is None:
+        return
+
+    error = (parsed or {}).get("Error", {}).get("Code")
+    profile.record(
+        model.service_model.service_name,
+        model.name,
+        start,
+        time.perf_counter() - start,
+        error,
+    )
+
+
+def register(client):
+    """Trace the calls of a boto3 client made by profiled jobs."""
+
+    client.meta.events.register("before-call", before_call)
+    client.meta.events.register("after-call", after_call)
@@ -0,0 +1,230 @@
+import argparse
+import json
+import multiprocessing
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from core.aws.ratelimit import BATCH, priority
+from core.aws.s3 import copy_file, exists_file, list_files, read_file, upload_text
+from core.classifier import get_cascade
+from core.logs import get_logger
+from core.process import Parser
+
+from config import AWS_BUCKET_NAME, CACHE_FOLDER
+
+logger = get_logger(__name__)
+
+# stored textract output, `cvs/{name}/textract.json`
+TEXTRACT_JSON_KEY = re.compile(r"^cvs/([^/]+)/textract\.json$")
+
+PARSED_JSON = "cvs/{name}/parsed.json"
+PARSED_JSON_VERSION = "cvs/{name}/versions/parsed-{version}.json"
+
+# folder names start with the file md5
+PREFIXES = ["cvs/%x" % i for i in range(16)]
+
+
+def list_textract(bucket=AWS_BUCKET_NAME, workers=16):
+    """List stored textract output, one paginated listing per prefix in parallel.
+
+    Returns:
+        list: Object summaries sorted by key.
+    """
+
+    def list_prefix(prefix):
+        return [
+            obj
+            for obj in list_files(bucket=bucket, prefix=prefix)
+            if TEXTRACT_JSON_KEY.match(obj["Key"])
+        ]
+
+    objects = []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for listed in executor.map(list_prefix, PREFIXES):
+            objects += listed
+
+    return sorted(objects, key=lambda obj: obj["Key"])
+
+
+def diff_results(old, new):
+    """Compare the exhibitions of two parsed results.
+
+    Exhibitions are matched by section, year and original line.
+
+    Returns:
+        dict: Added, removed and re-titled exhibitions plus header changes.
+    """
+
+    def by_line(result):
+        return {
+            (e["type"], e["year"], e["original"]): e["title"]
+            for slug in ["solo_exhibitions", "group_exhibitions"]
+            for e in result.get(slug, [])
+        }
+
+    old_lines = by_line(old)
+    new_lines = by_line(new)
+
+    return {
+        "name": (
+            [old.get("name"), new.get("name")]
+            if old.get("name") != new.get("name")
+            else None
+        ),
+        "dob": (
+            [old.get("dob"), new.get("dob")]
+            if old.get("dob") != new.get("dob")
+            else None
+        ),
+        "added": [list(k) + [new_lines[k]] for k in new_lines if k not in old_lines],
+        "removed": [list(k) + [old_lines[k]] for k in old_lines if k not in new_lines],
+        "changed": [
+            list(k) + [old_lines[k], new_lines[k]]
+            for k in new_lines
+            if k in old_lines and old_lines[k] != new_lines[k]
+        ],
+    }
+
+
+def reparse(key, bucket=AWS_BUCKET_NAME, version=None, dry_run=False):
+    """Re-run the parsing stage on stored textract output.
+
+    The current ``parsed.json`` is copied to ``versions/`` before it is
+    replaced. Textract is never called.
+
+    Returns:
+        dict: The key, whether anything changed and the diff.
+    """
+
+    name = TEXTRACT_JSON_KEY.match(key).group(1)
+    file_parsed_json = PARSED_JSON.format(name=name)
+
+    blocks = json.loads(read_file(bucket=bucket, object_name=key))
+
+    old = {}
+    if exists_file(bucket=bucket, object_name=file_parsed_json):
+        old = json.loads(read_file(bucket=bucket, object_name=file_parsed_json))
+
+    # leave comprehend capacity to interactive jobs
+    with priority(BATCH):
+        result = Parser().process_blocks(blocks)
+
+    # mark results of the classifier like parses do, so they aren't collected
+    # as training examples; the old marker is of the old parse
+    meta = dict(old.get("meta", {}), reparsed=version)
+    meta.pop("classifier", None)
+    cascade = get_cascade()
+    if cascade:
+        meta["classifier"] = cascade.model.version
+    result["meta"] = meta
+
+    diff = diff_results(old, result)
+    changed = any(diff.values())
+
+    if changed and not dry_run:
+        if old:
+            copy_file(
+                source="%s/%s" % (bucket, file_parsed_json),
+                bucket=bucket,
+                object_name=PARSED_JSON_VERSION.format(name=name, version=version),
+            )
+        upload_text(
+            text=json.dumps(result), bucket=bucket, object_name=file_parsed_json
+        )
+
+    return {"key": key, "changed": changed, "diff": diff}
+
+
+def reprocess(run, bucket=AWS_BUCKET_NAME, workers=4, dry_run=False, report=None):
+    """Re-parse the whole archive, resuming a previous run of the same name.
+
+    Args:
+        run (str): Run name, also used as the version of replaced results.
+        workers (int, optional): Parsing processes. Defaults to 4.
+        dry_run (bool, optional): Only report what would change.
+        report (str, optional): Path of a JSON lines report of every diff.
+    """
+
+    state_path = CACHE_FOLDER / ("reprocess-%s.json" % run)
+    state = json.loads(state_path.read_text()) if state_path.is_file() else {}
+
+    objects = list_textract(bucket=bucket)
+    pending = [obj["Key"] for obj in objects if state.get(obj["Key"]) != obj["ETag"]]
+    etags = {obj["Key"]: obj["ETag"] for obj in objects}
+
+    logger.info(
+        "Reprocessing started.",
+        extra={"run": run, "total": len(objects), "pending": len(pending)},
+    )
+
+    start = time.monotonic()
+    done = changed = failed = 0
+    report_file = open(report, "a") if report else None
+
+    # spawn so every worker builds its own AWS clients
+    context = multiprocessing.get_context("spawn")
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        futures = {
+            executor.submit(reparse, key, bucket, run, dry_run): key for key in pending
+        }
+
+        for future in as_completed(futures):
+            key = futures[future]
+            done += 1
+
+            try:
+                outcome = future.result()
+            except Exception:
+                failed += 1
+                logger.exception("Reparse failed.", extra={"key": key})
+                continue
+
+            changed += outcome["changed"]
+
+            if report_file and outcome["changed"]:
+                report_file.write(json.dumps(outcome) + "\n")
+
+            # remember finished keys so an interrupted run resumes
+            if not dry_run:
+                state[key] = etags[key]
+                state_path.parent.mkdir(parents=True, exist_ok=True)
+                state_path.write_text(json.dumps(state))
+
+            elapsed = time.monotonic() - start
+            logger.info(
+                "Reprocessing progress.",
+                extra={
+                    "done": done,
+                    "pending": len(pending),
+                    "changed": changed,
+                    "failed": failed,
+                    "rate": done / elapsed if elapsed else None,
+                },
+            )
+
+    if report_file:
+        report_file.close()
+
+    print("Reparsed:", done - failed, "Changed:", changed, "Failed:", failed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Re-parse stored textract output without calling Textract."
+    )
+    parser.add_argument(
+        "--run",
+        default=time.strftime("%Y%m%d"),
+        help="Run name. Re-using a name resumes that run.",
+    )
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--report", help="Write changed results as JSON lines.")
+    args = parser.parse_args()
+
+    reprocess(
+        run=args.run, workers=args.workers, dry_run=args.dry_run, report=args.report
+    )
@@ -0,0 +1,558 @@
+import argparse
+import base64
+import bisect
+import json
+import threading
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+from core.aws.s3 import list_files, read_file
+from core.gazetteer import PARSED_JSON_KEY, exhibition_fragments, tokenize
+from core.logs import get_logger
+
+from config import AWS_BUCKET_NAME, SEARCH_INDEX_PATH, SEARCH_REFRESH_INTERVAL
+
+logger = get_logger(__name__)
+
+SECTIONS = ["solo_exhibitions", "group_exhibitions"]
+
+# fields free text is searched in
+FIELDS = ["title", "venue", "city"]
+
+# folder names start with the file md5
+PREFIXES = ["cvs/%x" % i for i in range(16)]
+
+# source of the exhibitions of removed or replaced results until the next save
+REMOVED = 0xFFFFFFFF
+
+EMPTY = array("I")
+
+
+def encode_postings(ids):
+    """Encode sorted ids as varint gaps, a byte or two per id in practice."""
+
+    data = bytearray()
+    last = 0
+
+    for doc in ids:
+        gap = doc - last
+        last = doc
+
+        while gap >= 0x80:
+            data.append(gap & 0x7F | 0x80)
+            gap >>= 7
+        data.append(gap)
+
+    return base64.b64encode(bytes(data)).decode("ascii")
+
+
+def decode_postings(text):
+    ids = array("I")
+    last = gap = shift = 0
+
+    for byte in base64.b64decode(text):
+        gap |= (byte & 0x7F) << shift
+        shift += 7
+
+        if not byte & 0x80:
+            last += gap
+            ids.append(last)
+            gap = shift = 0
+
+    return ids
+
+
+def contains(postings, doc):
+    i = bisect.bisect_left(postings, doc)
+    return i < len(postings) and postings[i] == doc
+
+
+def intersect(groups):
+    """Ids in at least one of the sorted postings of every group.
+
+    Groups are taken from the smallest. Ids left are looked up by binary
+    search in much larger postings, and intersected as sets with the rest, so
+    the cost depends on the rarest term rather than the most common one.
+    """
+
+    groups = sorted(groups, key=lambda group: sum(map(len, group)))
+    ids = set().union(*groups[0])
+
+    for group in groups[1:]:
+        if not ids:
+            break
+
+        if sum(map(len, group)) > 16 * len(ids):
+            ids = {doc for doc in ids if any(contains(p, doc) for p in group)}
+        else:
+            ids = set().union(*(ids.intersection(p) for p in group))
+
+    return array("I", sorted(ids))
+
+
+def parse_years(value):
+    """Years of a ``2018`` or ``2015-2018`` query.
+
+    Raises:
+        ValueError: The value is not a year or a range of years.
+    """
+
+    start, _, end = str(value).partition("-")
+
+    if not start.isdigit() or not (end or start).isdigit():
+        raise ValueError("Invalid year %s." % value)
+
+    start, end = int(start), int(end or start)
+
+    if not 0 < start <= end < 10000 or end - start > 200:
+        raise ValueError("Invalid year range %s." % value)
+
+    return range(start, end + 1)
+
+
+def exhibition_terms(exhibition):
+    """Terms an exhibition is found by.
+
+    Tokens are prefixed with their field. The first fragment after the title
+    is the venue and the last the city, a single fragment counts as both.
+    """
+
+    title, fragments = exhibition_fragments(exhibition)
+    title = exhibition.get("title") or title or ""
+
+    terms = {"section:%s" % exhibition.get("type")}
+
+    if str(exhibition.get("year") or "").isdigit():
+        terms.add("year:%d" % int(exhibition["year"]))
+
+    terms.update("title:" + token for token in tokenize(title))
+
+    if fragments:
+        for fragment in fragments[:-1] or fragments:
+            terms.update("venue:" + token for token in tokenize(fragment))
+        terms.update("city:" + token for token in tokenize(fragments[-1]))
+
+    return terms
+
+
+class SearchIndex:
+    """Inverted index of the exhibitions of parsed results.
+
+    Exhibitions get consecutive ids as results are added, so every posting
+    list stays sorted by appending. Results are tracked by ETag like in the
+    gazetteer; a replaced result only marks its old exhibitions removed, and
+    ids are compacted when the index is saved.
+    """
+
+    def __init__(self, path=SEARCH_INDEX_PATH):
+        self.path = path
+
+        # results by key with their etag, hash, name and range of ids
+        self.sources = {}
+        self.keys = []
+
+        # exhibitions by id
+        self.doc_source = array("I")
+        self.doc_year = array("H")
+        self.doc_section = array("B")
+        self.doc_title = []
+        self.doc_original = []
+
+        self.postings = {}
+        self.refreshed_at = 0
+        self.refreshing = False
+        self.lock = threading.RLock()
+
+    def add_result(self, key, result, etag=None):
+        """Index (or re-index) the exhibitions of one parsed result."""
+
+        with self.lock:
+            self.remove(key)
+
+            number = len(self.keys)
+            first = len(self.doc_source)
+            self.keys.append(key)
+
+            for section in SECTIONS:
+                for exhibition in result.get(section, []):
+                    doc = len(self.doc_source)
+                    year = str(exhibition.get("year") or "")
+
+                    self.doc_source.append(number)
+                    self.doc_year.append(int(year) if year.isdigit() else 0)
+                    self.doc_section.append(SECTIONS.index(section))
+                    self.doc_title.append(exhibition.get("title"))
+                    self.doc_original.append(exhibition.get("original"))
+
+                    for term in exhibition_terms(dict(exhibition, type=section)):
+                        self.postings.setdefault(term, array("I")).append(doc)
+
+            self.sources[key] = {
+                "etag": etag,
+                "hash": result.get("meta", {}).get("hash"),
+                "name": result.get("name"),
+                "number": number,
+                "first": first,
+                "end": len(self.doc_source),
+            }
+
+    def remove(self, key):
+        with self.lock:
+            source = self.sources.pop(key, None)
+
+            if source is None:
+                return
+
+            self.keys[source["number"]] = None
+
+            for doc in range(source["first"], source["end"]):
+                self.doc_source[doc] = REMOVED
+
+    def search(
+        self, text=None, title=None, venue=None, city=None, year=None, section=None
+    ):
+        """Find exhibitions matching every given criterion.
+
+        Args:
+            text (str, optional): Words in the title, venue or city.
+            title (str, optional): Words in the title.
+            venue (str, optional): Words in the venue.
+            city (str, optional): Words in the city.
+            year (str, optional): Year or range of years, e.g. ``2015-2018``.
+            section (str, optional): ``solo`` or ``group``.
+
+        Raises:
+            ValueError: No criterion was given or one is invalid.
+
+        Returns:
+            array: Matching exhibition ids in index order.
+        """
+
+        groups = []
+
+        for field, value in [("title", title), ("venue", venue), ("city", city)]:
+            for token in tokenize(value or ""):
+                groups.append(["%s:%s" % (field, token)])
+
+        for token in tokenize(text or ""):
+            groups.append(["%s:%s" % (field, token) for field in FIELDS])
+
+        if year:
+            groups.append(["year:%d" % y for y in parse_years(year)])
+
+        if section:
+            section = section if section in SECTIONS else "%s_exhibitions" % section
+            if section not in SECTIONS:
+                raise ValueError("Invalid section %s." % section)
+            groups.append(["section:" + section])
+
+        if not groups:
+            raise ValueError("Nothing to search for.")
+
+        with self.lock:
+            ids = intersect(
+                [[self.postings.get(term, EMPTY) for term in g] for g in groups]
+            )
+
+            return array("I", (d for d in ids if self.doc_source[d] != REMOVED))
+
+    def exhibition(self, doc):
+        with self.lock:
+            source = self.sources[self.keys[self.doc_source[doc]]]
+
+            return {
+                "hash": source["hash"],
+                "name": source["name"],
+                "year": self.doc_year[doc] or None,
+                "type": SECTIONS[self.doc_section[doc]],
+                "title": self.doc_title[doc],
+                "original": self.doc_original[doc],
+            }
+
+    def artists(self, ids):
+        """Group exhibition ids by result.
+
+        Returns:
+            list: Hash, name and number of matching exhibitions per result.
+        """
+
+        counts = {}
+
+        with self.lock:
+            for doc in ids:
+                number = self.doc_source[doc]
+                counts[number] = counts.get(number, 0) + 1
+
+            return [
+                {
+                    "hash": self.sources[self.keys[number]]["hash"],
+                    "name": self.sources[self.keys[number]]["name"],
+                    "exhibitions": count,
+                }
+                for number, count in counts.items()
+            ]
+
+    def search_exhibitions(self, offset=0, limit=None, **criteria):
+        """Search and look up a page of the matching exhibitions.
+
+        Exhibition ids are only valid until the next :meth:`compact`, so they
+        are looked up under the same lock they were found under.
+
+        Returns:
+            tuple: Number of matching exhibitions and the page of them.
+        """
+
+        end = None if limit is None else offset + limit
+
+        with self.lock:
+            ids = self.search(**criteria)
+
+            return len(ids), [self.exhibition(doc) for doc in ids[offset:end]]
+
+    def search_artists(self, offset=0, limit=None, **criteria):
+        """Search and look up a page of the results with matching exhibitions.
+
+        Returns:
+            tuple: Number of matching results and the page of them.
+        """
+
+        end = None if limit is None else offset + limit
+
+        with self.lock:
+            artists = self.artists(self.search(**criteria))
+
+        return len(artists), artists[offset:end]
+
+    def compact(self):
+        """Drop removed exhibitions and renumber the rest."""
+
+        with self.lock:
+            ids = array("I", [REMOVED]) * len(self.doc_source)
+            numbers = {}
+            alive = 0
+
+            # results keep their order, and so do their exhibitions
+            for number, key in enumerate(self.sources):
+                source = self.sources[key]
+                numbers[source["number"]] = number
+                source["number"] = number
+
+                first = alive
+                for doc in range(source["first"], source["end"]):
+                    ids[doc] = alive
+                    alive += 1
+                source["first"], source["end"] = first, alive
+
+            kept = [d for d in range(len(ids)) if ids[d] != REMOVED]
+
+            self.doc_source = array("I", (numbers[self.doc_source[d]] for d in kept))
+            self.doc_year = array("H", (self.doc_year[d] for d in kept))
+            self.doc_section = array("B", (self.doc_section[d] for d in kept))
+            self.doc_title = [self.doc_title[d] for d in kept]
+            self.doc_original = [self.doc_original[d] for d in kept]
+
+            postings = {}
+            for term, docs in self.postings.items():
+                docs = array("I", (ids[d] for d in docs if ids[d] != REMOVED))
+                if docs:
+                    postings[term] = docs
+
+            self.postings = postings
+            self.keys = list(self.sources)
+
+    def load(self):
+        if not self.path.is_file():
+            return
+
+        with open(self.path) as f:
+            data = json.load(f)
+
+        with self.lock:
+            self.sources = data["sources"]
+            self.keys = list(self.sources)
+            self.doc_source = array("I", data["docs"]["source"])
+            self.doc_year = array("H", data["docs"]["year"])
+            self.doc_section = array("B", data["docs"]["section"])
+            self.doc_title = data["docs"]["title"]
+            self.doc_original = data["docs"]["original"]
+            self.postings = {
+                term: decode_postings(text) for term, text in data["postings"].items()
+            }
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        with self.lock:
+            self.compact()
+
+            data = json.dumps(
+                {
+                    "sources": self.sources,
+                    "docs": {
+                        "source": self.doc_source.tolist(),
+                        "year": self.doc_year.tolist(),
+                        "section": self.doc_section.tolist(),
+                        "title": self.doc_title,
+                        "original": self.doc_original,
+                    },
+                    "postings": {
+                        term: encode_postings(docs)
+                        for term, docs in self.postings.items()
+                    },
+                }
+            )
+
+        # replace atomically so readers never see a partial file
+        tmp_path = self.path.with_suffix(".tmp")
+        tmp_path.write_text(data)
+        tmp_path.replace(self.path)
+
+    def refresh(self, bucket=AWS_BUCKET_NAME, workers=16):
+        """Index parsed results in the bucket that are new or changed.
+
+        Listing and reading run in parallel and results are added one at a
+        time, so queries keep being answered while the index is refreshed.
+
+        Returns:
+            int: Number of results (re-)indexed or removed.
+        """
+
+        def list_prefix(prefix):
+            return [
+                obj
+                for obj in list_files(bucket=bucket, prefix=prefix)
+                if PARSED_JSON_KEY.match(obj["Key"])
+            ]
+
+        def read(obj):
+            try:
+                return json.loads(read_file(bucket=bucket, object_name=obj["Key"]))
+            except ValueError:
+                logger.warning("Skipping unreadable result.", extra={"key": obj["Key"]})
+                return None
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            listed = [
+                obj for objs in executor.map(list_prefix, PREFIXES) for obj in objs
+            ]
+
+            with self.lock:
+                changed = [
+                    obj
+                    for obj in listed
+                    if self.sources.get(obj["Key"], {}).get("etag") != obj["ETag"]
+                ]
+                deleted = set(self.sources) - {obj["Key"] for obj in listed}
+
+            for obj, result in zip(changed, executor.map(read, changed)):
+                if result is not None:
+                    self.add_result(obj["Key"], result, etag=obj["ETag"])
+
+        for key in deleted:
+            self.remove(key)
+
+        self.refreshed_at = time.time()
+
+        if changed or deleted:
+            self.save()
+
+        logger.info(
+            "Search index refreshed.",
+            extra={
+                "indexed": len(changed),
+                "removed": len(deleted),
+                "results": len(self.sources),
+                "exhibitions": len(self.doc_source),
+            },
+        )
+
+        return len(changed) + len(deleted)
+
+
+# process-wide instance
+search_index = None
+search_index_lock = threading.Lock()
+
+
+def refresh_in_background(index):
+    try:
+        index.refresh()
+    except Exception:
+        # keep answering from what is already indexed
+        logger.exception("Search index refresh failed.")
+        index.refreshed_at = time.time()
+    finally:
+        index.refreshing = False
+
+
+def get_search_index():
+    """Get the shared search index, refreshing it in the background when stale.
+
+    Returns:
+        SearchIndex: The shared instance, empty until the first refresh of a
+            new cache folder finished.
+    """
+
+    global search_index
+
+    with search_index_lock:
+        if search_index is None:
+            search_index = SearchIndex()
+            search_index.load()
+
+        stale = time.time() - search_index.refreshed_at >= SEARCH_REFRESH_INTERVAL
+
+        if stale and not search_index.refreshing:
+            search_index.refreshing = True
+            threading.Thread(
+                target=refresh_in_background, args=(search_index,), daemon=True
+            ).start()
+
+    return search_index
+
+
+def index_result(key, result):
+    """Make a new result searchable right away in a process that serves queries.
+
+    The index is saved with its next refresh.
+    """
+
+    if search_index is not None:
+        search_index.add_result(key, result)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Refresh the search index and query exhibitions."
+    )
+    parser.add_argument("text", nargs="?", help="Words in the title, venue or city.")
+    parser.add_argument("--title")
+    parser.add_argument("--venue")
+    parser.add_argument("--city")
+    parser.add_argument("--year", help="Year or range of years, e.g. 2015-2018.")
+    parser.add_argument("--section", choices=["solo", "group"])
+    parser.add_argument("--limit", type=int, default=20)
+    args = parser.parse_args()
+
+    index = SearchIndex()
+    index.load()
+    index.refresh()
+
+    criteria = dict(
+        text=args.text,
+        title=args.title,
+        venue=args.venue,
+        city=args.city,
+        year=args.year,
+        section=args.section,
+    )
+
+    if any(criteria.values()):
+        start = time.perf_counter()
+        total, exhibitions = index.search_exhibitions(limit=args.limit, **criteria)
+        took = time.perf_counter() - start
+
+        for exhibition in exhibitions:
+            print(json.dumps(exhibition))
+        print("%d exhibitions in %.1fms" % (total, took * 1000))
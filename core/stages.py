@@ -0,0 +1,172 @@
+import json
+import time
+
+from core.aws.s3 import delete_file, read_file_if_exists, upload_text
+from core.logs import get_logger
+
+from config import AWS_BUCKET_NAME, CHECKPOINT_INTERVAL, CHECKPOINTS_ENABLED
+
+logger = get_logger(__name__)
+
+CHECKPOINT = "checkpoints/{hash}.json"
+
+# pipeline stages of a cv, in order
+STAGES = ["ingest", "ocr", "header", "sections", "classify", "render", "publish"]
+
+
+class Stages:
+    """Progress of one file hash through the pipeline stages.
+
+    A stage is completed with the output later stages need, such as the name
+    and dob found in the header or the lines the section scan found, and
+    classification records every line as it is decided. A retry of a failed
+    job starts after the last completed stage and the last classified line.
+
+    Progress is saved to the bucket when the job fails or is cancelled, and
+    every ``interval`` seconds while lines are classified, so a worker that
+    dies loses at most that much work. Jobs that succeed without failing
+    never write one, and the checkpoint is deleted once results are published.
+
+    Results depend on the parser ``options``; a checkpoint saved with other
+    options is ignored.
+    """
+
+    def __init__(
+        self,
+        file_hash=None,
+        options=None,
+        bucket=AWS_BUCKET_NAME,
+        interval=CHECKPOINT_INTERVAL,
+        enabled=CHECKPOINTS_ENABLED,
+    ):
+        self.hash = file_hash
+        self.options = options or {}
+        self.bucket = bucket
+        self.interval = interval
+
+        # kept in memory only without a hash
+        self.enabled = enabled and file_hash is not None
+
+        # output by completed stage, and exhibitions classified so far
+        self.stages = {}
+        self.lines = []
+        self.published = {}
+
+        # checkpoint in the bucket, and unsaved progress
+        self.stored = False
+        self.changed = False
+        self.saved = time.monotonic()
+
+    def done(self, stage):
+        return stage in self.stages
+
+    def get(self, stage, default=None):
+        return self.stages.get(stage, default)
+
+    def complete(self, stage, output=None):
+        self.stages[stage] = output
+        self.changed = True
+
+    def add_line(self, exhibition):
+        """Record a classified line, saving when enough time has passed."""
+
+        self.lines.append(exhibition)
+        self.changed = True
+
+        if time.monotonic() - self.saved >= self.interval:
+            self.save()
+
+    def publish(self, name, object_name):
+        self.published[name] = object_name
+        self.changed = True
+
+    @property
+    def last(self):
+        """Last completed stage."""
+
+        completed = [stage for stage in STAGES if stage in self.stages]
+        return completed[-1] if completed else None
+
+    def save(self):
+        self.saved = time.monotonic()
+
+        if not self.enabled or not self.changed:
+            return
+
+        upload_text(
+            text=json.dumps(
+                {
+                    "hash": self.hash,
+                    "options": self.options,
+                    "stages": self.stages,
+                    "lines": self.lines,
+                    "published": self.published,
+                    "updated": time.time(),
+                }
+            ),
+            bucket=self.bucket,
+            object_name=CHECKPOINT.format(hash=self.hash),
+        )
+
+        self.stored = True
+        self.changed = False
+
+        logger.debug(
+            "Checkpoint saved.",
+            extra={"hash": self.hash, "stage": self.last, "lines": len(self.lines)},
+        )
+
+    def clear(self):
+        """Forget the progress once the job is done."""
+
+        if self.enabled and self.stored:
+            delete_file(
+                bucket=self.bucket, object_name=CHECKPOINT.format(hash=self.hash)
+            )
+
+        self.stored = False
+        self.changed = False
+
+
+def get_stages(file_hash, options=None, bucket=AWS_BUCKET_NAME):
+    """Load the checkpoint of a file hash, or start a new one.
+
+    Args:
+        file_hash (str): MD5 of the file.
+        options (dict, optional): Parser options the results depend on.
+
+    Returns:
+        Stages: Progress of the file, empty when there is nothing to resume.
+    """
+
+    stages = Stages(file_hash, options=options, bucket=bucket)
+
+    if not stages.enabled:
+        return stages
+
+    text = read_file_if_exists(
+        bucket=bucket, object_name=CHECKPOINT.format(hash=file_hash)
+    )
+
+    if text is None:
+        return stages
+
+    checkpoint = json.loads(text)
+    stages.stored = True
+
+    if checkpoint.get("options") != stages.options:
+        logger.info(
+            "Checkpoint options changed, starting over.", extra={"hash": file_hash}
+        )
+        return stages
+
+    stages.stages = checkpoint["stages"]
+    stages.lines = checkpoint["lines"]
+    stages.published = checkpoint["published"]
+
+    logger.info(
+        "Checkpoint loaded.",
+        extra={"hash": file_hash, "stage": stages.last, "lines": len(stages.lines)},
+    )
+
+    return stages
@@ -0,0 +1,164 @@
+import hashlib
+import io
+import uuid
+
+from core.aws.s3 import (
+    abort_multipart,
+    complete_multipart,
+    delete_file,
+    start_multipart,
+    upload_binary,
+    upload_part,
+)
+from core.aws.textract import start_job
+from core.logs import get_logger
+from core.manifest import get_manifest
+
+from config import (
+    AWS_BUCKET_NAME,
+    PAGE_REUSE_ENABLED,
+    UPLOAD_MAX_SIZE,
+    UPLOAD_PART_SIZE,
+)
+
+logger = get_logger(__name__)
+
+# browser uploads, renamed by hash in the manifest once complete
+UPLOAD_FILE = "uploads/{id}.pdf"
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class S3UploadStream(io.RawIOBase):
+    """Writable stream that uploads to S3 while it is written.
+
+    Data is hashed as it arrives and sent as multipart upload parts of
+    ``part_size`` bytes, so at most one part is held in memory. Files smaller
+    than one part are sent with a single PUT on :meth:`complete`.
+    """
+
+    def __init__(
+        self,
+        bucket=AWS_BUCKET_NAME,
+        object_name=None,
+        max_size=UPLOAD_MAX_SIZE,
+        part_size=UPLOAD_PART_SIZE,
+    ):
+        self.bucket = bucket
+        self.object_name = object_name or UPLOAD_FILE.format(id=uuid.uuid4().hex)
+        self.max_size = max_size
+        self.part_size = part_size
+
+        self.md5 = hashlib.md5()
+        self.size = 0
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.size += len(data)
+
+        if self.size > self.max_size:
+            self.abort()
+            raise UploadTooLarge("Upload exceeds %d bytes." % self.max_size)
+
+        self.md5.update(data)
+        self.buffer += data
+
+        while len(self.buffer) >= self.part_size:
+            self.send_part(bytes(self.buffer[: self.part_size]))
+            del self.buffer[: self.part_size]
+
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        # the form parser rewinds finished files, nothing to rewind here
+        return self.size
+
+    def send_part(self, binary):
+        if self.upload_id is None:
+            self.upload_id = start_multipart(
+                bucket=self.bucket, object_name=self.object_name
+            )
+
+        self.parts.append(
+            upload_part(
+                binary,
+                bucket=self.bucket,
+                object_name=self.object_name,
+                upload_id=self.upload_id,
+                number=len(self.parts) + 1,
+            )
+        )
+
+    def complete(self):
+        """Finish the upload.
+
+        Returns:
+            str: MD5 hex digest of the uploaded file.
+        """
+
+        if self.upload_id is None:
+            upload_binary(
+                bytes(self.buffer), bucket=self.bucket, object_name=self.object_name
+            )
+        else:
+            if self.buffer:
+                self.send_part(bytes(self.buffer))
+            complete_multipart(
+                bucket=self.bucket,
+                object_name=self.object_name,
+                upload_id=self.upload_id,
+                parts=self.parts,
+            )
+
+        # a complete upload is kept, aborting it does nothing
+        self.upload_id = None
+        self.buffer = bytearray()
+
+        return self.md5.hexdigest()
+
+    def abort(self):
+        if self.upload_id is not None:
+            abort_multipart(
+                bucket=self.bucket,
+                object_name=self.object_name,
+                upload_id=self.upload_id,
+            )
+            self.upload_id = None
+
+        self.buffer = bytearray()
+
+
+def register_upload(file_hash, object_name, legacy=None, bucket=AWS_BUCKET_NAME):
+    """Record a completed upload in the manifest of its hash.
+
+    A file uploaded before keeps its earlier copy and the new one is removed.
+    Unless pages are reused (which needs the file locally to fingerprint
+    them), the Textract job is started right away.
+
+    Returns:
+        Manifest: The manifest of the file.
+    """
+
+    manifest = get_manifest(file_hash, required=["pdf"], legacy=legacy, bucket=bucket)
+
+    if manifest.has("pdf"):
+        delete_file(bucket=bucket, object_name=object_name)
+        return manifest
+
+    manifest.add("pdf", object_name)
+
+    if not PAGE_REUSE_ENABLED and not manifest.has("textract"):
+        manifest.add("textract_job", start_job(bucket=bucket, object_name=object_name))
+        manifest.add("textract_source", object_name)
+        logger.info("Textract started on upload.", extra={"hash": file_hash})
+
+    manifest.save()
+
+    return manifest
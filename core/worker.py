@@ -0,0 +1,222 @@
+import argparse
+import importlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from core.broker import client_manager, job_queue
+from core.cancel import CancelToken, JobCancelled, current_token
+from core.events import EventChannel
+from core.logs import get_logger
+
+from config import JOB_THREADS, MESSAGE_QUEUE, PROFILE_JOBS
+
+logger = get_logger(__name__)
+
+# ids of jobs cancelled before a worker took them that are remembered
+MAX_CANCELLED = 1000
+
+
+def process_job(job, events):
+    """Parse the CV of a job.
+
+    Args:
+        job (dict): ``filename`` of the job, and the local ``path`` of the CV,
+            the ``file_hash`` of a CV uploaded to S3 or the ``url`` of a CV to
+            fetch. ``profile`` asks for a profile of the job.
+        events (EventChannel): Channel the job's messages are published on.
+
+    Returns:
+        dict: The parsed result.
+    """
+
+    # the parser pulls in the aws modules, other handlers may not need them
+    from core.process import Parser
+
+    path = job.get("path")
+    if path and not os.path.isfile(path):
+        path = None
+
+    with tempfile.TemporaryDirectory() as folder:
+        # web cvs are fetched by the worker, not the process that took the job
+        if job.get("url") and not path and not job.get("file_hash"):
+            path = fetch_source(job["url"], Path(folder) / "cv.pdf")
+
+        parser = Parser(
+            events=events,
+            meta={"job": job["filename"]},
+            output_folder=job.get("output_folder") or folder,
+            profile=job.get("profile") or PROFILE_JOBS,
+        )
+        return parser.process_cv(path, file_hash=job.get("file_hash"))
+
+
+def fetch_source(url, path):
+    """Write the PDF of a web CV, rendering web pages in Chrome."""
+
+    from core.crawl import fetch, render_source
+
+    response = fetch(url)
+    if response["status"] >= 400:
+        raise IOError("%s answered %d." % (url, response["status"]))
+
+    return str(render_source(url, response, path))
+
+
+def run_job(job, emit, handler=process_job, token=None):
+    """Run a job and close its channel with the outcome.
+
+    Args:
+        job (dict): The job.
+        emit (callable): Emits an event and its data to the job's room.
+        handler (callable, optional): Does the work of the job.
+        token (CancelToken, optional): Stops the job when cancelled.
+    """
+
+    filename = job["filename"]
+    events = EventChannel(emit, job_id=filename)
+    logger.info("Job started.", extra={"job": filename})
+
+    # jobs submitted through the api keep their record up to date
+    def record(status, **fields):
+        if job.get("api"):
+            record_job(job, status, **fields)
+
+    record("running")
+
+    context = current_token.set(token)
+
+    try:
+        result = handler(job, events)
+    except JobCancelled:
+        logger.info("Job cancelled.", extra={"job": filename})
+        events.close("%s cancelled." % filename, failed=True)
+        record("cancelled", message="%s cancelled." % filename)
+        return
+    except Exception as e:
+        logger.exception("Job failed.", extra={"job": filename})
+        events.close("%s failed." % filename, failed=True)
+        record("failed", message="%s failed: %s" % (filename, e))
+        return
+    finally:
+        current_token.reset(context)
+
+    # file processing done
+    events.close("%s processed." % filename)
+    record("done", result=result, message="%s processed." % filename)
+
+
+def record_job(job, status, result=None, message=None):
+    """Update the api record of a job, without failing the job."""
+
+    from core.jobs import update_job
+
+    fields = {"status": status, "message": message}
+
+    # custom handlers may not return a parsed result
+    if isinstance(result, dict) and "meta" in result:
+        fields.update(hash=result["meta"]["hash"], name=result["name"])
+
+    try:
+        update_job(job["id"], **fields)
+    except Exception:
+        logger.exception("Could not update job record.", extra={"job": job["filename"]})
+
+
+def work(url=MESSAGE_QUEUE, threads=JOB_THREADS, handler=process_job):
+    """Take jobs from the queue until interrupted.
+
+    Job messages are emitted to the job's Socket.IO room through the same
+    queue, so the client receives them whichever web process it is connected
+    to. Start as many workers, on as many hosts, as the load needs, e.g.
+    ``MESSAGE_QUEUE=redis://localhost:6379/0 python -m core.worker --threads 4``.
+
+    A job is only taken when a thread is free to run it, so idle workers pick
+    up the jobs busy ones would otherwise hold.
+    """
+
+    queue = job_queue(url)
+    manager = client_manager(url, write_only=True)
+    slots = threading.Semaphore(threads)
+
+    # tokens of running jobs, and jobs cancelled before they were taken
+    running = {}
+    cancelled = OrderedDict()
+    lock = threading.Lock()
+
+    def listen():
+        for job_id in queue.cancelled():
+            with lock:
+                token = running.get(job_id)
+                if token is None:
+                    cancelled[job_id] = True
+                    while len(cancelled) > MAX_CANCELLED:
+                        cancelled.popitem(last=False)
+
+            if token is not None:
+                token.cancel()
+
+    threading.Thread(target=listen, daemon=True).start()
+
+    def run(job):
+        token = CancelToken()
+
+        with lock:
+            running[job.get("id")] = token
+            if cancelled.pop(job.get("id"), None):
+                token.cancel()
+
+        try:
+            run_job(
+                job,
+                lambda event, data: manager.emit(event, data, room=job["filename"]),
+                handler=handler,
+                token=token,
+            )
+        finally:
+            with lock:
+                running.pop(job.get("id"), None)
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        while True:
+            slots.acquire()
+            job = queue.get(timeout=1)
+
+            if job is None:
+                slots.release()
+                continue
+
+            executor.submit(run, job)
+
+
+def load_handler(name):
+    """Import a `module:function` job handler."""
+
+    module, function = name.split(":")
+    return getattr(importlib.import_module(module), function)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Run CV jobs submitted by the web processes."
+    )
+    parser.add_argument("--url", default=MESSAGE_QUEUE, help="Message queue url.")
+    parser.add_argument("--threads", type=int, default=JOB_THREADS)
+    parser.add_argument(
+        "--handler",
+        default="core.worker:process_job",
+        help="Job handler as module:function.",
+    )
+    args = parser.parse_args()
+
+    if not args.url:
+        parser.error("MESSAGE_QUEUE is not set.")
+
+    try:
+        work(args.url, threads=args.threads, handler=load_handler(args.handler))
+    except KeyboardInterrupt:
+        pass
@@ -1,24 +1,70 @@
+from config import SOCKETIO_ASYNC_MODE
+
+# green thread servers need the standard library patched before it is used
+if SOCKETIO_ASYNC_MODE == "eventlet":
+    import eventlet
+
+    eventlet.monkey_patch()
+elif SOCKETIO_ASYNC_MODE == "gevent":
+    from gevent import monkey
+
+    monkey.patch_all()
+
+import hashlib
+import io
+import json
 import os
+import re
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from flask import (
     Flask,
+    Request,
     Response,
     abort,
+    jsonify,
     redirect,
     render_template,
     request,
+    send_file,
     session,
     url_for,
 )
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
 
+from core import metrics
+from core.artifacts import IMMUTABLE, LocalStore, artifact_cache, sweep_in_background
+from core.aws.ratelimit import rate_limiter
+from core.aws.s3 import ensure_bucket, upload_file
+from core.broker import client_manager, job_queue
+from core.cancel import CancelToken
 from core.convert import web2pdf
+from core.events import RELAY_ROOM, get_buffer, relay, replay
+from core.jobs import get_job, new_job, save_job
+from core.logs import get_logger
+from core.manifest import get_manifest
 from core.process import Parser
-from flask_socketio import SocketIO, emit
+from core.search import get_search_index
+from core.upload import UPLOAD_FILE, S3UploadStream, UploadTooLarge, register_upload
+from core.worker import run_job
+from flask_socketio import SocketIO, emit, join_room, rooms
 
-from config import AWS_BUCKET_NAME, AWS_REGION_NAME
+from config import (
+    API_MAX_JOBS,
+    API_MAX_SIZE,
+    ARTIFACT_MAX_AGE,
+    AWS_BUCKET_NAME,
+    JOB_CANCEL_GRACE,
+    JOB_THREADS,
+    MESSAGE_QUEUE,
+    SEARCH_MAX_LIMIT,
+    UPLOAD_MAX_SIZE,
+    UPLOADS_BUDGET,
+)
 
 # Static variables
 STATIC_FOLDER = "static"
@@ -32,9 +78,100 @@ if not os.path.isdir(UPLOAD_FOLDER):
     os.makedirs(UPLOAD_FOLDER)
 
 
+# Jobs are named by file hash, their parsed pdf gets a suffix
+HASH_FILENAME = re.compile(r"^([0-9a-f]{32})(-parsed)?\.pdf$")
+
+
+def in_bucket(path):
+    """Check whether a web cv or parsed pdf is stored in S3 too."""
+
+    match = HASH_FILENAME.match(path.name)
+    if not match:
+        return False
+
+    artifact = "parsed_pdf" if match.group(2) else "pdf"
+    return get_manifest(match.group(1), required=[artifact]).has(artifact)
+
+
+# Local copies of web cvs and parsed pdfs, by hash, within a size budget
+uploads = LocalStore("uploads", UPLOAD_FOLDER, UPLOADS_BUDGET, in_bucket=in_bucket)
+
+# Api jobs and file hashes are hex uuids and md5s
+HEX_ID = re.compile(r"^[0-9a-f]{32}$")
+
+# Sources the api fetches
+WEB_URL = re.compile(r"^https?://[^/\s]+", re.IGNORECASE)
+
+# S3 requests made at once by an api request
+API_CONCURRENCY = 16
+
+
+logger = get_logger(__name__)
+
+
+class UploadRequest(Request):
+    """Request that streams uploaded files to S3 while the body is parsed.
+
+    Each file is limited to ``UPLOAD_MAX_SIZE`` while it streams, the whole
+    request to ``MAX_CONTENT_LENGTH``, or ``API_MAX_SIZE`` for bulk
+    submissions of many files.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # streams of the files read so far
+        self.upload_streams = []
+
+    @property
+    def max_content_length(self):
+        if self.method == "POST" and self.path == "/api/jobs":
+            return API_MAX_SIZE
+
+        return super().max_content_length
+
+    def _get_file_stream(
+        self, total_content_length, content_type, filename=None, content_length=None
+    ):
+        # an empty file field
+        if not filename:
+            return io.BytesIO()
+
+        stream = S3UploadStream()
+        self.upload_streams.append(stream)
+
+        return stream
+
+    def abort_uploads(self):
+        """Abort the uploads of the request's files that were not completed."""
+
+        for stream in self.upload_streams:
+            try:
+                stream.abort()
+            except Exception:
+                logger.exception(
+                    "Upload abort failed.", extra={"object": stream.object_name}
+                )
+
+
 # Declare flask
 app = Flask(__name__)
 app.static_folder = STATIC_FOLDER
+app.request_class = UploadRequest
+app.config["MAX_CONTENT_LENGTH"] = UPLOAD_MAX_SIZE
+
+
+def legacy_keys(file_hash):
+    return {
+        "pdf": Parser.TMP_FILE.format(hash=file_hash),
+        "textract": Parser.TEXTRACT_JSON.format(hash=file_hash),
+    }
+
+
+# Uploads a request didn't complete, e.g. because it failed, are not kept
+@app.teardown_request
+def abort_uploads(e=None):
+    request.abort_uploads()
 
 
 # Homepage
@@ -49,56 +186,470 @@ def save():
     cv = request.files["cv"]
     url = request.form["url"]
 
-    # save pdf cv
+    # pdf cv was streamed to s3 while the form was read
     if cv:
-        filename = secure_filename(cv.filename)
-        filepath = FILE_PATH.format(filename=filename)
-        cv.save(filepath)
+        file_hash = cv.stream.complete()
+        register_upload(file_hash, cv.stream.object_name, legacy=legacy_keys(file_hash))
+        filename = file_hash + ".pdf"
 
     # save web cv
     else:
-        filename = secure_filename(url) + ".pdf"
-        filepath = FILE_PATH.format(filename=filename)
+        filepath = FILE_PATH.format(filename=secure_filename(url) + ".pdf")
         web2pdf(url, filepath)
 
+        # name it by hash like uploads
+        file_hash = hashlib.md5(open(filepath, "rb").read()).hexdigest()
+        filename = file_hash + ".pdf"
+        filepath = uploads.add(filepath, filename)
+
+        # job workers may run on other hosts
+        if MESSAGE_QUEUE:
+            object_name = UPLOAD_FILE.format(id=uuid.uuid4().hex)
+            upload_file(
+                file_path=str(filepath),
+                bucket=AWS_BUCKET_NAME,
+                object_name=object_name,
+            )
+            register_upload(file_hash, object_name, legacy=legacy_keys(file_hash))
+
     return redirect(url_for("process", filename=filename))
 
 
+# Rejected while streaming, files read before it are aborted with the request
+@app.errorhandler(UploadTooLarge)
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(e):
+    message = str(e) if isinstance(e, UploadTooLarge) else "Request too large."
+    if request.path.startswith("/api/"):
+        return api_error(message, 413)
+
+    return message, 413
+
+
+# Published artifacts by their name in the results folder
+ARTIFACTS = {
+    "cv.pdf": "original",
+    "textract.json": "textract_copy",
+    "parsed.json": "parsed_json",
+    "parsed.pdf": "parsed_pdf",
+}
+
+
+def send_artifact(file_hash, artifact):
+    """Send an artifact of a file hash from the local cache.
+
+    The ETag is the file hash and the version of the artifact. Artifacts that
+    never change for a hash are cached by browsers for a year, results that
+    can be re-parsed for ``ARTIFACT_MAX_AGE`` and revalidated after.
+    """
+
+    manifest = get_manifest(file_hash, required=[artifact])
+
+    if not manifest.has(artifact):
+        abort(404)
+
+    object_name = manifest.key(artifact)
+    immutable = artifact in IMMUTABLE
+    path, version = artifact_cache.get(object_name, immutable=immutable)
+
+    response = send_file(
+        path,
+        mimetype=(
+            "application/json" if object_name.endswith(".json") else "application/pdf"
+        ),
+        conditional=True,
+        etag="%s-%s" % (file_hash, version),
+        max_age=31536000 if immutable else ARTIFACT_MAX_AGE,
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = immutable
+
+    return response
+
+
+# Uploaded file, local or from s3
+@app.route("/uploads/<filename>", methods=["GET"])
+def upload(filename):
+    path = uploads.find(secure_filename(filename))
+    if path is not None:
+        return send_file(path)
+
+    match = HASH_FILENAME.match(filename)
+    if not match:
+        abort(404)
+
+    return send_artifact(match.group(1), "parsed_pdf" if match.group(2) else "pdf")
+
+
+# Published results, e.g. /artifacts/{hash}/parsed.json
+@app.route("/artifacts/<file_hash>/<name>", methods=["GET"])
+def artifact(file_hash, name):
+    if not HEX_ID.match(file_hash) or name not in ARTIFACTS:
+        abort(404)
+
+    return send_artifact(file_hash, ARTIFACTS[name])
+
+
 # Process file
 @app.route("/process/<filename>", methods=["GET"])
 def process(filename):
     return render_template(
         "result.jinja2",
         filename=filename,
-        bucket_name=AWS_BUCKET_NAME,
-        bucket_region=AWS_REGION_NAME,
+        profile=request.args.get("profile") == "1",
+    )
+
+
+# Process metrics
+@app.route("/metrics", methods=["GET"])
+def process_metrics():
+    return jsonify(dict(metrics.snapshot(), rate_limits=rate_limiter.stats()))
+
+
+def search_request():
+    """Read the search criteria and paging of a query string.
+
+    Raises:
+        ValueError: Paging is invalid.
+
+    Returns:
+        dict: Criteria, offset and limit to search the index with.
+    """
+
+    return dict(
+        text=request.args.get("q"),
+        title=request.args.get("title"),
+        venue=request.args.get("venue"),
+        city=request.args.get("city"),
+        year=request.args.get("year"),
+        section=request.args.get("section"),
+        offset=max(int(request.args.get("offset", 0)), 0),
+        limit=min(max(int(request.args.get("limit", 50)), 0), SEARCH_MAX_LIMIT),
+    )
+
+
+# Search exhibitions, e.g. ?venue=flinders lane&year=2018
+@app.route("/search/exhibitions", methods=["GET"])
+def search_exhibitions():
+    start = time.perf_counter()
+
+    try:
+        total, exhibitions = get_search_index().search_exhibitions(**search_request())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify(
+        {
+            "total": total,
+            "results": exhibitions,
+            "took_ms": round((time.perf_counter() - start) * 1000, 2),
+        }
+    )
+
+
+# Search artists by their exhibitions, with the same filters
+@app.route("/search/artists", methods=["GET"])
+def search_artists():
+    start = time.perf_counter()
+
+    try:
+        total, artists = get_search_index().search_artists(**search_request())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify(
+        {
+            "total": total,
+            "results": artists,
+            "took_ms": round((time.perf_counter() - start) * 1000, 2),
+        }
     )
 
 
-# Declare socket
-socketio = SocketIO(app)
+# Keep local files within their budgets
+sweep_in_background([uploads, artifact_cache.store])
+
+
+# Declare socket, emits go through the message queue when there is one
+socketio = SocketIO(
+    app, client_manager=client_manager(), async_mode=SOCKETIO_ASYNC_MODE
+)
+
+# Jobs run in separate worker processes when there is a message queue
+queue = job_queue() if MESSAGE_QUEUE else None
+
+# relay job messages from the start instead of from the first client on, so
+# clients reconnecting to this process can be caught up on any job
+if queue is not None:
+    socketio.server.manager_initialized = True
+    socketio.server.manager.initialize()
+
+# Cancel tokens of jobs running in this process, ids of jobs submitted to workers
+tokens = {}
+submitted = {}
 
 
 # Process job
 @socketio.on("job:start")
 def job_start(job):
     filename = job.get("filename")
-    filepath = UPLOAD_FOLDER / filename
+    filepath = uploads.find(secure_filename(filename))
+    file_hash = None
+
+    # files streamed on upload, and evicted ones, only exist in s3
+    if filepath is None:
+        match = HASH_FILENAME.match(filename)
+
+        if (
+            match
+            and not match.group(2)
+            and get_manifest(match.group(1), required=["pdf"]).has("pdf")
+        ):
+            file_hash = match.group(1)
+        else:
+            emit("job:done", {"status": "%s does not exist." % filename})
+            return
 
-    # check if file exists
-    if not os.path.isfile(filepath):
-        emit("job:done", {"status": "%s does not exist." % filename})
+    # every client of a job listens on the same room
+    join_room(filename)
+
+    task = {
+        "filename": filename,
+        "path": str(filepath) if filepath else None,
+        "file_hash": file_hash,
+        "profile": bool(job.get("profile")),
+    }
+
+    if queue is not None:
+        buffer = get_buffer(filename)
+        failed = buffer is not None and (buffer.done or {}).get("failed")
+
+        # one job per file hash: catch up on a job submitted, running or
+        # finished, from the messages relayed through this process
+        if buffer is not None and not failed:
+            messages, done = replay(filename, since=job.get("since") or 0)
+            emit("job:batch", {"job": filename, "messages": messages})
+            if done:
+                emit("job:done", done)
+        else:
+            # a failed job is submitted again
+            task["id"] = submitted[filename] = uuid.uuid4().hex
+            announce("job:submitted", {"job": filename, "id": task["id"]})
+            queue.put(task)
+            logger.info("Job submitted.", extra={"job": filename})
+
+        announce("job:watch", {"job": filename, "sid": request.sid})
         return
 
-    # parse cv
-    parser = Parser(emit=emit)
-    print ('FILEEEEEEEEEEEEEPATH:', filepath)
-    print ('EMITTTTTTTTTTTT:', emit)
-    parser.process_cv(filepath)
+    # catch up a reconnecting client on a running or finished job
+    if get_buffer(filename) is not None:
+        messages, done = replay(filename, since=job.get("since") or 0)
+        emit("job:batch", {"job": filename, "messages": messages})
+        if done:
+            emit("job:done", done)
+        return
+
+    # parse cv in this process
+    token = tokens[filename] = CancelToken()
+
+    try:
+        run_job(
+            dict(task, output_folder=str(uploads.path(filename).parent)),
+            lambda event, data: socketio.emit(event, data, room=filename),
+            token=token,
+        )
+    finally:
+        tokens.pop(filename, None)
+
+
+def announce(event, data):
+    """Tell every web process about a job run by the workers."""
+
+    relay(data["job"], event, data)
+    socketio.emit(event, data, room=RELAY_ROOM)
+
+
+# Stop jobs nobody is waiting for
+@socketio.on("disconnect")
+def job_leave(*args):
+    for room in rooms():
+        if room != request.sid:
+            if queue is not None:
+                announce("job:unwatch", {"job": room, "sid": request.sid})
+            socketio.start_background_task(cancel_abandoned, room, request.sid)
+
+
+def cancel_abandoned(filename, sid):
+    # give a reloading page time to rejoin
+    socketio.sleep(JOB_CANCEL_GRACE)
+
+    # clients of queued jobs may have rejoined through another web process
+    if queue is not None:
+        buffer = get_buffer(filename)
+        if buffer is None or buffer.watchers or buffer.done:
+            return
+
+        task_id = buffer.task_id or submitted.get(filename)
+        if task_id is None:
+            return
+
+        queue.cancel(task_id)
+        submitted.pop(filename, None)
+        logger.info("Job cancelled, no clients left.", extra={"job": filename})
+        return
+
+    participants = socketio.server.manager.get_participants("/", filename)
+    if any(participant != sid for participant, _ in participants):
+        return
+
+    if filename in tokens:
+        tokens[filename].cancel()
+    else:
+        return
+
+    logger.info("Job cancelled, no clients left.", extra={"job": filename})
+
+
+# Jobs submitted through the api without a message queue, run a few at a time
+executor = ThreadPoolExecutor(max_workers=JOB_THREADS) if queue is None else None
+
 
-    # file processing done
-    emit("job:done", {"status": "%s processed." % filename})
+def submit_api_job(record, task):
+    """Save the record of an api job and run it, or queue it for a worker."""
+
+    save_job(record)
+
+    task = dict(task, id=record["id"], filename=record["id"], api=True)
+
+    if queue is not None:
+        queue.put(task)
+    else:
+        executor.submit(
+            run_job,
+            task,
+            lambda event, data: socketio.emit(event, data, room=task["filename"]),
+        )
+
+    logger.info("Api job submitted.", extra={"job": record["id"]})
+
+
+def api_error(message, status=400):
+    return jsonify({"error": message}), status
+
+
+# Submit cvs in bulk: `cv` files and `url` fields of a form, or a json body
+# with a list of `urls`
+@app.route("/api/jobs", methods=["POST"])
+def api_submit():
+    if request.is_json:
+        body = request.get_json(silent=True)
+        urls = body.get("urls") if isinstance(body, dict) else None
+        files = []
+
+        if not isinstance(urls, list):
+            return api_error("Expected a JSON object with a list of urls.")
+    else:
+        urls = request.form.getlist("url")
+        files = [cv for cv in request.files.getlist("cv") if cv]
+
+    urls = [url.strip() for url in urls if isinstance(url, str) and url.strip()]
+    invalid = [url for url in urls if not WEB_URL.match(url)]
+
+    error = None
+    if invalid:
+        error = api_error("Not a web url: %s" % ", ".join(invalid[:10]))
+    elif not files and not urls:
+        error = api_error("No CVs or urls to parse.")
+    elif len(files) + len(urls) > API_MAX_JOBS:
+        error = api_error(
+            "At most %d CVs can be submitted at once." % API_MAX_JOBS, 413
+        )
+
+    # files streamed while the form was read are aborted with the request
+    if error:
+        return error
+
+    jobs = []
+
+    for cv in files:
+        file_hash = cv.stream.complete()
+        register_upload(file_hash, cv.stream.object_name, legacy=legacy_keys(file_hash))
+        jobs.append(
+            (
+                new_job(file_hash=file_hash, name=secure_filename(cv.filename)),
+                {"path": None, "file_hash": file_hash},
+            )
+        )
+
+    for url in urls:
+        jobs.append((new_job(url=url), {"path": None, "url": url}))
+
+    # every record is saved before the response, so every id can be polled
+    with ThreadPoolExecutor(max_workers=API_CONCURRENCY) as pool:
+        list(pool.map(lambda job: submit_api_job(*job), jobs))
+
+    return jsonify({"jobs": [record for record, _ in jobs]}), 202
+
+
+def job_result(record):
+    """Add the parsed result of a finished job to its record."""
+
+    if record["status"] != "done" or not record.get("hash"):
+        return record
+
+    manifest = get_manifest(record["hash"], required=["parsed_json"])
+    if not manifest.has("parsed_json"):
+        return record
+
+    path, _ = artifact_cache.get(manifest.key("parsed_json"))
+
+    return dict(record, result=json.loads(Path(path).read_text()))
+
+
+# Status of an api job, with the parsed result once done
+@app.route("/api/jobs/<job_id>", methods=["GET"])
+def api_job(job_id):
+    record = get_job(job_id) if HEX_ID.match(job_id) else None
+
+    if record is None:
+        return api_error("No such job.", 404)
+
+    return jsonify(job_result(record))
+
+
+# Status of many api jobs, e.g. ?id=...&id=... or ?ids=...,...
+@app.route("/api/jobs", methods=["GET"])
+def api_jobs():
+    ids = request.args.getlist("id") + [
+        job_id for ids in request.args.getlist("ids") for job_id in ids.split(",")
+    ]
+    ids = list(dict.fromkeys(job_id.strip() for job_id in ids if job_id.strip()))
+
+    if not ids:
+        return api_error("No job ids.")
+    if len(ids) > API_MAX_JOBS:
+        return api_error("At most %d jobs can be polled at once." % API_MAX_JOBS)
+
+    with ThreadPoolExecutor(max_workers=API_CONCURRENCY) as pool:
+        records = list(
+            pool.map(
+                lambda job_id: get_job(job_id) if HEX_ID.match(job_id) else None, ids
+            )
+        )
+
+    return jsonify(
+        {
+            "jobs": [record for record in records if record is not None],
+            "missing": [
+                job_id for job_id, record in zip(ids, records) if record is None
+            ],
+        }
+    )
 
 
 if __name__ == "__main__":
+    # provision storage once instead of on every job
+    if ensure_bucket(bucket=AWS_BUCKET_NAME):
+        logger.info("S3 Bucket created.", extra={"bucket": AWS_BUCKET_NAME})
+
     socketio.run(app, host="0.0.0.0", port=os.environ.get("PORT", 5000))